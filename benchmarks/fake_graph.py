@@ -0,0 +1,431 @@
+"""Local stand-in for the Graph endpoints used by the processor, serving synthetic mailboxes and Sharepoint rules workbooks"""
+import io
+import re
+import json
+import time
+import uuid
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_PAGE_SIZE = 10
+# attachment content is generated from this block on the fly, so large mailboxes do not need the memory to hold them
+CONTENT_BLOCK = bytes(range(256)) * 256
+SITE_ID = 'bench-site'
+DRIVE_ID = 'bench-drive'
+FOLDER_ID = 'bench-rules-folder'
+GRAPH_ROOT = 'https://graph.microsoft.com'
+
+def build_workbook(conditions):
+    """Return the content of a Sharepoint rules .xlsx file holding 'conditions', a list of (name, sender, subject, body, attachments, recipients, forward body) rows"""
+    import openpyxl
+
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.title = 'Email Rules'
+    worksheet.append(['Name', 'Sender', 'Subject', 'Body', 'Attachments', 'Recipients', 'Forward Body'])
+    for condition in conditions:
+        worksheet.append(list(condition))
+
+    content = io.BytesIO()
+    workbook.save(content)
+    return content.getvalue()
+
+class FakeGraphState:
+    """Mailboxes, Sharepoint files and request counts shared by the request handlers"""
+
+    def __init__(self, throttle_every=0, throttle_retry_after=0, throttle_concurrency=0, latency=0):
+        self.mailboxes = {}
+        self.attachments = {}
+        self.workbooks = {}
+        self.folder_name = 'Rules'
+        # throttling simulator: every Nth request, and every request beyond 'throttle_concurrency' being handled at the same time, is answered with 429
+        self.throttle_every = int(throttle_every)
+        self.throttle_retry_after = throttle_retry_after
+        self.throttle_concurrency = int(throttle_concurrency)
+        # seconds every request takes, so concurrent requests overlap
+        self.latency = latency
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.throttled = 0
+        # status codes returned instead of handling a route, eg {'sharepoint_files': 503}.  A list of statuses is used up one request at a time, and a status of 0 closes the connection without answering
+        self.failing_routes = {}
+        # statuses returned for a batched request, by url, before it is handled normally
+        self.batch_failures = {}
+        self.batch_sizes = []
+        # change notification subscriptions by id, created once their notification url has passed the validation handshake
+        self.subscriptions = {}
+        # every added or changed message gets the next sequence number, which the delta tokens refer to
+        self.sequence = 0
+        self.changes = {}
+        self.counts = Counter()
+        self.bytes_served = 0
+        self.forwards = 0
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def add_message(self, user_id, message, attachments=()):
+        """Add a message to a mailbox, along with the metadata (name, size) of its attachments"""
+        with self._lock:
+            self.mailboxes.setdefault(user_id, {})[message['id']] = message
+            self.changed(user_id, message['id'])
+            self.attachments[(user_id, message['id'])] = [
+                {'@odata.type': '#microsoft.graph.fileAttachment', 'id': f"{message['id']}-att{i}", 'name': name, 'size': size, 'contentType': 'application/octet-stream'}
+                for i, (name, size) in enumerate(attachments)
+            ]
+
+    def changed(self, user_id, message_id):
+        """Record a change to a message, so the next delta round returns it.  Called while holding the lock"""
+        self.sequence += 1
+        self.changes[(user_id, message_id)] = self.sequence
+
+    def notify(self, subscription_id, message_id=None, lifecycle_event=None, client_state=None):
+        """Send a change notification for a new message, or a lifecycle notification, to the url of a subscription the way Graph does.  'client_state' overrides the one the subscription was created with.  Returns the status code of the answer"""
+        with self._lock:
+            subscription = dict(self.subscriptions[subscription_id])
+        notification = {'subscriptionId': subscription_id, 'clientState': subscription['clientState'] if client_state is None else client_state, 'tenantId': 'fake-tenant'}
+        if lifecycle_event is not None:
+            notification['lifecycleEvent'] = lifecycle_event
+        else:
+            notification.update({'changeType': 'created', 'resource': f"{subscription['resource']}('{message_id}')", 'resourceData': {'@odata.type': '#Microsoft.Graph.Message', 'id': message_id}})
+        url = subscription['lifecycleNotificationUrl'] if lifecycle_event is not None else subscription['notificationUrl']
+        return requests.post(url, json={'value': [notification]}, timeout=10).status_code
+
+    def add_workbook(self, name, content):
+        """Add a rules .xlsx file to the Sharepoint rules folder"""
+        with self._lock:
+            self.workbooks[name] = content
+
+    def mark_all_unread(self):
+        """Reset every message to unread, so the same mailboxes can be processed again"""
+        with self._lock:
+            for mailbox in self.mailboxes.values():
+                for message in mailbox.values():
+                    message['isRead'] = False
+
+    def read_count(self):
+        """Return the number of messages marked as read"""
+        with self._lock:
+            return sum(message['isRead'] for mailbox in self.mailboxes.values() for message in mailbox.values())
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts.clear()
+            self.throttled = 0
+            self.peak_in_flight = 0
+            self.bytes_served = 0
+            self.forwards = 0
+
+    def count(self, route):
+        """Count a request that is starting, returning True when it should be throttled.  Every call is followed by a call to finish()"""
+        with self._lock:
+            self.counts[route] += 1
+            self._requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            throttled = (bool(self.throttle_every) and self._requests % self.throttle_every == 0) or (bool(self.throttle_concurrency) and self.in_flight > self.throttle_concurrency)
+            self.throttled += throttled
+            return throttled
+
+    def finish(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def failure(self, route):
+        """Return the simulated failure status for a request to a route, or None to handle it"""
+        with self._lock:
+            failure = self.failing_routes.get(route)
+            if isinstance(failure, list):
+                return failure.pop(0) if failure else None
+            return failure
+
+def page(items, query, headers, next_url):
+    """Return a page of 'items' in the Graph collection format, with an @odata.nextLink while more are left"""
+    page_size = DEFAULT_PAGE_SIZE
+    match = re.search(r'odata\.maxpagesize=(\d+)', headers.get('Prefer', ''))
+    if match:
+        page_size = int(match.group(1))
+    skip = int(query.get('$skiptoken', ['0'])[0])
+
+    result = {'value': items[skip:skip + page_size]}
+    if skip + page_size < len(items):
+        result['@odata.nextLink'] = f'{next_url}?$skiptoken={skip + page_size}'
+    return result
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    """Handles the subset of Graph the processor uses: listing, reading and batch updates of mail, change notification subscriptions, and the Sharepoint lookups for rules files"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    @property
+    def base_url(self):
+        return f'http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        path = url.path[len('/v1.0'):] if url.path.startswith('/v1.0/') else url.path
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        route, handler = self.route(method, path)
+        throttled = self.state.count(route)
+        try:
+            if self.state.latency:
+                time.sleep(self.state.latency)
+            if throttled:
+                self.send_json(429, {'error': {'code': 'TooManyRequests', 'message': 'Simulated throttling'}}, {'Retry-After': str(self.state.throttle_retry_after)})
+                return
+            failure = self.state.failure(route)
+            if failure == 0:
+                # the request was received, but the connection is lost before the answer
+                self.close_connection = True
+                return
+            if failure is not None:
+                headers = {'Retry-After': str(self.state.throttle_retry_after)} if failure == 429 else {}
+                self.send_json(failure, {'error': {'code': 'SimulatedFailure', 'message': 'Simulated failure'}}, headers)
+                return
+            if handler is None:
+                self.send_json(404, {'error': {'code': 'NotFound', 'message': f'{method} {path} is not simulated'}})
+                return
+            handler(path, query, body)
+        finally:
+            self.state.finish()
+
+    def route(self, method, path):
+        """Return the name the request is counted under and the method handling it"""
+        routes = [
+            ('GET', r'/users/[^/]+/mail[fF]olders/inbox/messages/delta', 'list_delta', self.list_delta),
+            ('GET', r'/users/[^/]+/mail[fF]olders/inbox/messages', 'list_messages', self.list_messages),
+            ('GET', r'/users/[^/]+/messages/[^/]+/attachments/[^/]+/\$value', 'download_attachment', self.download_attachment),
+            ('GET', r'/users/[^/]+/messages/[^/]+/attachments', 'list_attachments', self.list_attachments),
+            ('GET', r'/users/[^/]+/messages/[^/]+', 'get_message', self.get_message),
+            ('POST', r'/\$batch', 'batch', self.batch),
+            ('POST', r'/subscriptions', 'create_subscription', self.create_subscription),
+            ('PATCH', r'/subscriptions/[^/]+', 'renew_subscription', self.renew_subscription),
+            ('DELETE', r'/subscriptions/[^/]+', 'delete_subscription', self.delete_subscription),
+            ('GET', r'/sites/[^/]+:/sites/[^/]+', 'sharepoint_site', self.get_site),
+            ('GET', rf'/sites/{SITE_ID}/drives', 'sharepoint_drives', self.list_drives),
+            ('GET', rf'/drives/{DRIVE_ID}/root/children', 'sharepoint_folders', self.list_root),
+            ('GET', rf'/drives/{DRIVE_ID}/items/{FOLDER_ID}/children', 'sharepoint_files', self.list_files),
+            ('GET', r'/download/[^/]+', 'sharepoint_download', self.download_workbook),
+        ]
+        for route_method, pattern, name, handler in routes:
+            if route_method == method and re.fullmatch(pattern, path):
+                return name, handler
+        return 'unknown', None
+
+    def send_json(self, status, payload, headers=None):
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def list_messages(self, path, query, body):
+        user_id = path.split('/')[2]
+        with self.state._lock:
+            messages = [dict(message) for message in self.state.mailboxes.get(user_id, {}).values() if not message['isRead']]
+        messages.sort(key=lambda message: message['receivedDateTime'], reverse=True)
+        self.send_json(200, page(messages, query, self.headers, f'{self.base_url}/v1.0{path}'))
+
+    def list_delta(self, path, query, body):
+        # a round started from a deltaLink returns the messages added or changed since the round that handed it out
+        user_id = path.split('/')[2]
+        since = int(query.get('$deltatoken', ['0'])[0])
+        with self.state._lock:
+            messages = [dict(message) for message in self.state.mailboxes.get(user_id, {}).values() if self.state.changes[(user_id, message['id'])] > since]
+            sequence = self.state.sequence
+        # the token a round ends with is fixed when it starts, so changes made while paging through it are returned by the next round
+        since = int(query.get('since', [sequence])[0])
+        result = page(messages, query, self.headers, f'{self.base_url}/v1.0{path}')
+        if '@odata.nextLink' in result:
+            result['@odata.nextLink'] += f'&since={since}' + (f'&$deltatoken={query["$deltatoken"][0]}' if '$deltatoken' in query else '')
+        else:
+            result['@odata.deltaLink'] = f'{self.base_url}/v1.0{path}?$deltatoken={since}'
+        self.send_json(200, result)
+
+    def get_message(self, path, query, body):
+        _, _, user_id, _, message_id = path.split('/')
+        with self.state._lock:
+            message = self.state.mailboxes.get(user_id, {}).get(message_id)
+            message = dict(message) if message is not None else None
+        if message is None:
+            self.send_json(404, {'error': {'code': 'ErrorItemNotFound', 'message': 'Not found'}})
+        else:
+            self.send_json(200, message)
+
+    def list_attachments(self, path, query, body):
+        _, _, user_id, _, message_id, _ = path.split('/')
+        self.send_json(200, {'value': self.state.attachments.get((user_id, message_id), [])})
+
+    def download_attachment(self, path, query, body):
+        _, _, user_id, _, message_id, _, attachment_id, _ = path.split('/')
+        attachment = next((attachment for attachment in self.state.attachments.get((user_id, message_id), []) if attachment['id'] == attachment_id), None)
+        if attachment is None:
+            self.send_json(404, {'error': {'code': 'ErrorItemNotFound', 'message': 'Not found'}})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(attachment['size']))
+        self.end_headers()
+        left = attachment['size']
+        while left > 0:
+            chunk = CONTENT_BLOCK[:min(left, len(CONTENT_BLOCK))]
+            self.wfile.write(chunk)
+            left -= len(chunk)
+        with self.state._lock:
+            self.state.bytes_served += attachment['size']
+
+    def batch(self, path, query, body):
+        responses = []
+        with self.state._lock:
+            self.state.batch_sizes.append(len(body['requests']))
+        for request in body['requests']:
+            parts = request['url'].strip('/').split('/')
+            status = 404
+            with self.state._lock:
+                failures = self.state.batch_failures.get(request['url'])
+                if failures:
+                    status = failures.pop(0)
+                    self.state.counts[f"batch_{request['method'].lower()}_failed"] += 1
+                    headers = {'Retry-After': str(self.state.throttle_retry_after)} if status == 429 else {}
+                    responses.append({'id': request['id'], 'status': status, 'headers': headers, 'body': {'error': {'code': 'SimulatedFailure', 'message': 'Simulated failure'}}})
+                    continue
+                mailbox = self.state.mailboxes.get(parts[1], {}) if len(parts) >= 4 and parts[0] == 'users' else {}
+                message = mailbox.get(parts[3]) if mailbox else None
+                if message is not None and request['method'] == 'PATCH' and len(parts) == 4:
+                    message.update(request.get('body') or {})
+                    self.state.changed(parts[1], parts[3])
+                    status = 200
+                elif message is not None and request['method'] == 'POST' and parts[4:] == ['forward']:
+                    self.state.forwards += 1
+                    status = 202
+                self.state.counts[f"batch_{request['method'].lower()}"] += 1
+            responses.append({'id': request['id'], 'status': status, 'headers': {}, 'body': {}})
+        self.send_json(200, {'responses': responses})
+
+    def create_subscription(self, path, query, body):
+        # Graph only creates the subscription once the notification url has echoed a validation token back within 10 seconds
+        token = f'validation {uuid.uuid4()} &?'
+        for url in {body['notificationUrl'], body.get('lifecycleNotificationUrl', body['notificationUrl'])}:
+            try:
+                validation = requests.post(url, params={'validationToken': token}, timeout=10)
+                validated = validation.status_code == 200 and validation.text == token
+            except requests.RequestException:
+                validated = False
+            if not validated:
+                self.send_json(400, {'error': {'code': 'ValidationError', 'message': f'Subscription validation request failed for {url}'}})
+                return
+
+        subscription = dict(body, id=str(uuid.uuid4()))
+        with self.state._lock:
+            self.state.subscriptions[subscription['id']] = subscription
+        self.send_json(201, {key: value for key, value in subscription.items() if key != 'clientState'})
+
+    def renew_subscription(self, path, query, body):
+        subscription_id = path.rsplit('/', 1)[1]
+        with self.state._lock:
+            subscription = self.state.subscriptions.get(subscription_id)
+            if subscription is not None:
+                subscription.update(body)
+                subscription = dict(subscription)
+        if subscription is None:
+            self.send_json(404, {'error': {'code': 'ResourceNotFound', 'message': 'The object was not found'}})
+        else:
+            self.send_json(200, {key: value for key, value in subscription.items() if key != 'clientState'})
+
+    def delete_subscription(self, path, query, body):
+        with self.state._lock:
+            self.state.subscriptions.pop(path.rsplit('/', 1)[1], None)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def get_site(self, path, query, body):
+        self.send_json(200, {'id': SITE_ID})
+
+    def list_drives(self, path, query, body):
+        self.send_json(200, {'value': [{'id': DRIVE_ID, 'name': 'Documents'}]})
+
+    def list_root(self, path, query, body):
+        self.send_json(200, {'value': [{'id': FOLDER_ID, 'name': self.state.folder_name, 'folder': {}}]})
+
+    def list_files(self, path, query, body):
+        with self.state._lock:
+            names = list(self.state.workbooks)
+        files = [{'id': f'workbook-{i}', 'name': name, 'cTag': f'"c:{{{i}}},1"', '@microsoft.graph.downloadUrl': f'{self.base_url}/download/workbook-{i}'} for i, name in enumerate(names)]
+        self.send_json(200, {'value': files})
+
+    def download_workbook(self, path, query, body):
+        index = int(path.rsplit('-', 1)[1])
+        with self.state._lock:
+            content = list(self.state.workbooks.values())[index]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class LocalGraphSession(requests.Session):
+    """Session sending every Graph request to the fake server, in place of the authenticated msgraph client"""
+
+    def __init__(self, base_url, pool_size=10):
+        super().__init__()
+        self.base_url = base_url
+        self.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(GRAPH_ROOT):
+            url = self.base_url + url[len(GRAPH_ROOT):]
+        elif url.startswith('/'):
+            url = f'{self.base_url}/v1.0{url}'
+        return super().request(method, url, *args, **kwargs)
+
+class FakeGraphServer:
+    """Serves a FakeGraphState on a local port from a background thread"""
+
+    def __init__(self, state, host='127.0.0.1', port=0):
+        self.state = state
+        self.server = ThreadingHTTPServer((host, port), FakeGraphHandler)
+        self.server.daemon_threads = True
+        self.server.state = state
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, name='fake-graph', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,140 @@
+"""Count the Graph requests a processing cycle makes for growing mailboxes, using an in-process mocked Graph client"""
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'o365-email-attachment-processor')
+ATTACHMENT_CONTENT = b'id,value\n1,2\n'
+
+class MockResponse:
+    """The parts of a requests.Response the processor uses"""
+
+    def __init__(self, status_code, payload=None, content=b''):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {}
+        self.payload = payload
+        self.content = content
+
+    def json(self):
+        return self.payload
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise OSError(f'status {self.status_code}')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class MockGraphClient:
+    """Stands in for the msgraph client, answering from an in-memory mailbox and counting every request by route and the messages returned by listings"""
+
+    def __init__(self, user_id, messages, matching):
+        self.user_id = user_id
+        self.messages = {}
+        for number in range(messages):
+            sender = 'reports@vendor.example' if number < matching else 'news@unrelated.example'
+            self.messages[f'msg{number}'] = {
+                'id': f'msg{number}', 'subject': f'daily report #{number}', 'from': {'emailAddress': {'address': sender}},
+                'toRecipients': [], 'receivedDateTime': f'2023-01-01T00:{number // 60 % 60:02d}:{number % 60:02d}Z',
+                'hasAttachments': True, 'isRead': False, 'body': {'contentType': 'text', 'content': f'report body {number}'}
+            }
+        self.requests = Counter()
+        self.messages_listed = 0
+
+    def get(self, url, headers=None, **kwargs):
+        # msgraph adds its middleware options to the headers it is given
+        if headers is not None:
+            headers['middleware_control'] = '{}'
+        path = urlparse(url).path
+        query = parse_qs(urlparse(url).query)
+        if path.endswith('/mailfolders/inbox/messages'):
+            self.requests['list_messages'] += 1
+            page_size = int(re.search(r'maxpagesize=(\d+)', headers['Prefer']).group(1))
+            unread = [dict(message) for message in self.messages.values() if not message['isRead']]
+            skip = int(query.get('$skiptoken', ['0'])[0])
+            payload = {'value': unread[skip:skip + page_size]}
+            if skip + page_size < len(unread):
+                payload['@odata.nextLink'] = f"{path}?$skiptoken={skip + page_size}"
+            self.messages_listed += len(payload['value'])
+            return MockResponse(200, payload)
+        if path.endswith('/attachments'):
+            self.requests['list_attachments'] += 1
+            message_id = path.split('/')[-2]
+            return MockResponse(200, {'value': [{'id': f'{message_id}-att', 'name': f'{message_id}.csv', 'size': len(ATTACHMENT_CONTENT)}]})
+        if path.endswith('/$value'):
+            self.requests['download_attachment'] += 1
+            return MockResponse(200, content=ATTACHMENT_CONTENT)
+        self.requests['other'] += 1
+        return MockResponse(404, {})
+
+    def post(self, url, json=None, headers=None, **kwargs):
+        self.requests['batch'] += 1
+        responses = []
+        for request in json['requests']:
+            self.requests[f"batch_{request['method'].lower()}"] += 1
+            message = self.messages.get(request['url'].split('/')[4])
+            if message is not None and request['method'] == 'PATCH':
+                message.update(request['body'])
+            responses.append({'id': request['id'], 'status': 200 if message is not None else 404, 'headers': {}, 'body': {}})
+        return MockResponse(200, {'responses': responses})
+
+def run_cycle(main, GraphRequestClient, messages, matching, work_dir):
+    """Process a mailbox of 'messages' unread emails, 'matching' of them with an attachment to deliver, returning the mocked client"""
+    run_dir = tempfile.mkdtemp(prefix='cycle-', dir=work_dir)
+    rules = {'conditions': [{'name': 'reports', 'pattern': {'sender': '@vendor.example', 'subject': ['report'], 'body': [''], 'attachments': [{'filename': ['.csv']}]},
+                             'delivery': {'target': 'local', 'path': os.path.join(run_dir, 'delivered')}}]}
+    with open(os.path.join(run_dir, 'default_email_rules.json'), 'w', encoding='utf-8') as f:
+        json.dump(rules, f)
+    os.chdir(run_dir)
+    main.rule_indexes.clear()
+
+    settings = main.load_settings({'settings': {'ledger_file': os.path.join(run_dir, 'delivery_ledger.db')}})
+    client = MockGraphClient('bench-user', messages, matching)
+    main.authenticate = lambda tenant_id, client_id, client_secret, settings, purpose='email': GraphRequestClient(client, tenant_id, settings)
+    account = {'password_method': 'custom', 'email_account': {'account_name': 'bench', 'o365_user_id': 'bench-user', 'o365_tenant_id': 'bench-tenant', 'o365_client_id': 'bench-client', 'o365_password_key': 'bench-password'}}
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        main.process_account(account, settings)
+    return client
+
+def main_benchmark(args):
+    sys.path.insert(0, SRC_DIR)
+    # pylint: disable=import-error
+    import main
+    from utils.graph_request import GraphRequestClient
+    # pylint: enable=import-error
+
+    work_dir = tempfile.mkdtemp(prefix='o365-request-count-')
+    current_dir = os.getcwd()
+    print(f"{'messages':>9} {'requests':>9} {'per message':>12} {'messages listed':>16}  by route")
+    try:
+        for messages in args.messages:
+            client = run_cycle(main, GraphRequestClient, messages, round(messages * args.match_ratio), work_dir)
+            total = sum(count for route, count in client.requests.items() if not route.startswith('batch_'))
+            print(f'{messages:>9} {total:>9} {total / messages:>12.2f} {client.messages_listed:>16}  {dict(sorted(client.requests.items()))}')
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, nargs='+', default=[10, 100, 1000], help='mailbox sizes to process, one cycle each')
+    parser.add_argument('--match-ratio', type=float, default=0.5, help='share of emails with an attachment to deliver')
+    main_benchmark(parser.parse_args())
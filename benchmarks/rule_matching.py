@@ -0,0 +1,115 @@
+"""Microbenchmark of rule matching: the compiled rule index against the linear scan of every condition it replaced, on synthetic rules and messages"""
+import os
+import sys
+import time
+import random
+import argparse
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'o365-email-attachment-processor')
+WORDS = ['invoice', 'report', 'daily', 'weekly', 'statement', 'remittance', 'order', 'shipment', 'payroll', 'summary', 'export', 'backup']
+
+def linear_match(email_rules, email_from, email_subject, email_body, attachment_names):
+    """The original matching loop: every condition is checked in order, lowercasing the patterns and the email at every check.  Returns the name of the first condition met and the attachments it matched, or (None, [])"""
+    for condition in email_rules['conditions']:
+        condition_name = condition['name']
+        if condition_name == 'example_entry_will_be_ignored':
+            continue
+        pattern = condition['pattern']
+        if not ('attachments' in pattern or 'sender' in pattern or 'subject' in pattern or 'body' in pattern):
+            continue
+        if 'sender' in pattern and pattern['sender'].lower() not in email_from:
+            continue
+        if 'subject' in pattern and not [keyword for keyword in pattern['subject'] if keyword.lower() in email_subject.lower()]:
+            continue
+        if 'body' in pattern and not [keyword for keyword in pattern['body'] if keyword.lower() in email_body.lower()]:
+            continue
+        matched = []
+        if 'attachments' in pattern:
+            filename_patterns = [keyword.lower() for keyword in pattern['attachments'][0]['filename']]
+            matched = [name for name in attachment_names if all(keyword in name.lower() for keyword in filename_patterns)]
+            if not matched:
+                continue
+        return condition_name, matched
+    return None, []
+
+def compiled_match(rule_index, email_from, email_subject, email_body, attachment_names):
+    """The same as linear_match, using a compiled rule index the way the fetch and match stages do"""
+    attachment_keywords = [rule_index.attachment_keywords(name.lower()) for name in attachment_names]
+    for compiled in rule_index.candidates(email_from.lower(), email_subject.lower(), email_body.lower()):
+        matched = []
+        if compiled.filename is not None:
+            matched = [name for name, found_keywords in zip(attachment_names, attachment_keywords) if compiled.matches_attachment(found_keywords)]
+            if not matched:
+                continue
+        return compiled.name, matched
+    return None, []
+
+def synthetic_rules(conditions, rng):
+    """Return a rules dict with 'conditions' conditions spread over one sender domain per ten conditions"""
+    rules = []
+    for number in range(conditions):
+        rules.append({
+            'name': f'condition_{number}',
+            'pattern': {
+                'sender': f'@vendor{number // 10}.example',
+                'subject': [f'{rng.choice(WORDS)} {number}', f'{rng.choice(WORDS).upper()} #{number}'],
+                'body': [rng.choice(WORDS)],
+                'attachments': [{'filename': [f'_{number}', rng.choice(['.csv', '.xlsx', '.pdf'])]}]
+            },
+            'delivery': {'target': 'local', 'path': f'/data/condition_{number}'}
+        })
+    return {'conditions': rules}
+
+def synthetic_messages(email_rules, messages, body_words, match_ratio, rng):
+    """Return (sender, subject, body, attachment names) tuples, 'match_ratio' of them written to meet a condition"""
+    result = []
+    for number in range(messages):
+        body = ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet']) for _ in range(body_words))
+        if rng.random() < match_ratio:
+            target = rng.randrange(len(email_rules['conditions']))
+            pattern = email_rules['conditions'][target]['pattern']
+            body = f"{body} {pattern['body'][0]}"
+            filename = ''.join(reversed(pattern['attachments'][0]['filename']))
+            result.append((f'reports{pattern["sender"]}', f"Your {rng.choice(pattern['subject'])} is ready", body, [f'data{filename}', f'data_{target}.txt']))
+        else:
+            result.append((f'news@unrelated{number}.example', f'Newsletter {number}', body, [f'image{number}.png']))
+    return result
+
+def run_benchmark(args):
+    sys.path.insert(0, SRC_DIR)
+    # pylint: disable=import-error
+    from utils.rule_index import compile_rules
+    # pylint: enable=import-error
+
+    rng = random.Random(args.seed)
+    email_rules = synthetic_rules(args.conditions, rng)
+
+    start = time.perf_counter()
+    rule_index = compile_rules(email_rules)
+    print(f'compiling {args.conditions} conditions took {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    # message bodies range from a few lines to long threads with quoted replies, which is where the cost of searching them shows
+    for body_words in args.body_words:
+        messages = synthetic_messages(email_rules, args.messages, body_words, args.match_ratio, rng)
+        print(f'bodies of {body_words} words:')
+        results = {}
+        for name, match in (('linear', lambda message: linear_match(email_rules, message[0].lower(), *message[1:])),
+                            ('compiled', lambda message: compiled_match(rule_index, *message))):
+            start = time.perf_counter()
+            results[name] = [match(message) for message in messages]
+            elapsed = time.perf_counter() - start
+            print(f'  {name:9} {len(messages) / elapsed:10.0f} messages/s  ({elapsed:.3f} s for {len(messages)} messages)')
+
+        matched = sum(condition_name is not None for condition_name, _ in results['compiled'])
+        print(f'  {matched} of {len(messages)} messages matched a condition')
+        if results['linear'] != results['compiled']:
+            raise SystemExit('the compiled rule index matched differently from the linear scan')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--conditions', type=int, default=500, help='number of conditions in the rules')
+    parser.add_argument('--messages', type=int, default=2000, help='number of messages matched against them')
+    parser.add_argument('--body-words', type=int, nargs='+', default=[300, 8000], help='words in each message body, running the benchmark once per value given')
+    parser.add_argument('--match-ratio', type=float, default=0.3, help='share of messages meant to meet a condition')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the synthetic rules and messages')
+    run_benchmark(parser.parse_args())
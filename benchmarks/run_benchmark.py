@@ -0,0 +1,278 @@
+"""Measure the throughput of a full processing run against a local fake Graph server, synthetic mailboxes and local delivery targets"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+# pylint: disable=import-error
+from fake_graph import FakeGraphState, FakeGraphServer, LocalGraphSession, build_workbook
+# pylint: enable=import-error
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'o365-email-attachment-processor')
+S3_REGION = 'us-east-1'
+S3_BUCKET = 'o365-benchmark'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--accounts', type=int, default=2, help='number of email accounts')
+    parser.add_argument('--tenants', type=int, default=1, help='number of tenants the accounts are spread over')
+    parser.add_argument('--messages', type=int, default=200, help='unread messages per account')
+    parser.add_argument('--attachments', type=int, default=2, help='attachments per message')
+    parser.add_argument('--attachment-kb', type=int, default=256, help='size of every attachment')
+    parser.add_argument('--body-kb', type=float, default=4, help='size of every message body')
+    parser.add_argument('--conditions', type=int, default=20, help='delivery conditions in default_email_rules.json')
+    parser.add_argument('--match-ratio', type=float, default=0.5, help='share of messages matching a delivery condition')
+    parser.add_argument('--workbooks', type=int, default=1, help='Sharepoint rules workbooks, 0 to leave out the Sharepoint account')
+    parser.add_argument('--workbook-conditions', type=int, default=50, help='forwarding conditions per workbook')
+    parser.add_argument('--forward-ratio', type=float, default=0.1, help='share of messages matching a forwarding condition')
+    parser.add_argument('--target', choices=['local', 's3'], default='local', help='delivery target, s3 is simulated with moto')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth request with 429, 0 to never throttle')
+    parser.add_argument('--throttle-retry-after', type=float, default=0, help='Retry-After seconds sent with throttled responses')
+    parser.add_argument('--throttle-concurrency', type=int, default=0, help='answer requests beyond this many at the same time with 429, 0 for no limit')
+    parser.add_argument('--latency-ms', type=float, default=0, help='time the fake server takes to answer every request')
+    parser.add_argument('--settings', default='{}', help='JSON object of settings overriding the defaults, eg \'{"scan_mode": "delta"}\'')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the processor, which is hidden by default')
+    parser.add_argument('--runs', type=int, default=1, help='number of runs, each on freshly unread mailboxes')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with a JSON file written by an earlier --output')
+    return parser.parse_args()
+
+def measure_import_time():
+    """Return the seconds taken to import main.py in a fresh interpreter"""
+    code = 'import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)'
+    result = subprocess.run([sys.executable, '-c', code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process in MB, or None where it cannot be measured"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and in KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def build_mailboxes(state, args):
+    """Fill the fake server with the synthetic mailboxes, returning the email accounts"""
+    body = 'lorem ipsum dolor sit amet ' * max(1, int(args.body_kb * 1024 / 27))
+    attachment_size = args.attachment_kb * 1024
+    accounts = []
+    for account_number in range(args.accounts):
+        user_id = f'bench-user-{account_number}'
+        accounts.append({
+            'account_name': f'bench_account_{account_number}',
+            'o365_username': f'{user_id}@bench.example',
+            'o365_user_id': user_id,
+            'o365_tenant_id': f'bench-tenant-{account_number % max(1, args.tenants)}',
+            'o365_client_id': 'bench-client',
+            'o365_password_key': 'bench-password'
+        })
+        # matching messages are spread evenly instead of grouped at the start
+        delivered_count = forwarded_count = 0
+        for message_number in range(args.messages):
+            delivered = delivered_count < round((message_number + 1) * args.match_ratio)
+            forwarded = not delivered and bool(args.workbooks) and forwarded_count < round((message_number + 1) * args.forward_ratio)
+            delivered_count += delivered
+            forwarded_count += forwarded
+            condition_number = message_number % max(1, args.conditions)
+            workbook_condition_number = message_number % max(1, args.workbook_conditions)
+            if delivered:
+                sender, subject = f'reports@vendor{condition_number}.example', f'daily report {condition_number} #{message_number}'
+            elif forwarded:
+                sender, subject = f'billing@partner{workbook_condition_number}.example', f'invoice {workbook_condition_number} #{message_number}'
+            else:
+                sender, subject = 'newsletter@unrelated.example', f'weekly news #{message_number}'
+            extension = 'pdf' if forwarded else 'csv'
+            message_id = f'{user_id}-msg{message_number}'
+            received = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 3600 + message_number))
+            state.add_message(user_id, {
+                'id': message_id,
+                'subject': subject,
+                'from': {'emailAddress': {'address': sender}},
+                'toRecipients': [{'emailAddress': {'address': f'{user_id}@bench.example'}}],
+                'receivedDateTime': received,
+                'hasAttachments': bool(args.attachments),
+                'isRead': False,
+                'body': {'contentType': 'text', 'content': body}
+            }, [(f'data_{message_number}_{i}.{extension}', attachment_size) for i in range(args.attachments)])
+    return accounts
+
+def build_rules(state, args, work_dir):
+    """Write default_email_rules.json with the delivery conditions and add the forwarding workbooks to the fake Sharepoint folder"""
+    conditions = []
+    for condition_number in range(args.conditions):
+        if args.target == 's3':
+            delivery = {'target': 's3', 'region': S3_REGION, 'bucket': S3_BUCKET, 'subfolder': f'condition{condition_number}/'}
+        else:
+            delivery = {'target': 'local', 'path': os.path.join(work_dir, 'delivered', f'condition{condition_number}')}
+        conditions.append({
+            'name': f'bench_delivery_{condition_number}',
+            'pattern': {'sender': f'@vendor{condition_number}.example', 'subject': [f'daily report {condition_number} #'], 'body': ['lorem'], 'attachments': [{'filename': ['.csv']}]},
+            'delivery': delivery
+        })
+    with open(os.path.join(work_dir, 'default_email_rules.json'), 'w', encoding='utf-8') as f:
+        json.dump({'conditions': conditions}, f, indent=2)
+
+    for workbook_number in range(args.workbooks):
+        rows = [(f'bench_forward_{workbook_number}_{i}', f'@partner{i}.example', f'invoice {i} #', 'lorem', '.pdf', f'accounts{i}@bench.example', 'Forwarded by the benchmark')
+                for i in range(workbook_number, args.workbook_conditions, max(1, args.workbooks))]
+        state.add_workbook(f'bench_rules_{workbook_number}.xlsx', build_workbook(rows))
+
+def s3_stand_in(args):
+    """Return a context mocking S3 with moto when S3 delivery is benchmarked"""
+    if args.target != 's3':
+        return contextlib.nullcontext()
+    try:
+        from moto import mock_aws
+    except ImportError:
+        # moto before 5.0
+        from moto import mock_s3 as mock_aws
+    return mock_aws()
+
+def summarise_stages(metrics_summary):
+    """Return the count and total seconds of every instrumented stage, slowest first"""
+    stages = {}
+    for histogram in metrics_summary['histograms']:
+        if histogram['name'] != 'stage_duration_seconds':
+            continue
+        stage = stages.setdefault(histogram['labels']['stage'], {'count': 0, 'seconds': 0.0})
+        stage['count'] += histogram['count']
+        stage['seconds'] += histogram['sum']
+    return dict(sorted(stages.items(), key=lambda item: item[1]['seconds'], reverse=True))
+
+def run_once(main, metrics, state, args, accounts, work_dir):
+    """Process every synthetic mailbox once, returning the measurements of the run"""
+    settings_overrides = json.loads(args.settings)
+    o365_accounts = {'settings': settings_overrides, 'o365_accounts': []}
+    for email_account in accounts:
+        account = {'password_method': 'custom', 'email_account': email_account}
+        if args.workbooks:
+            account['sharepoint_account'] = {
+                'account_name': 'bench_sharepoint',
+                'o365_username': 'sharepoint@bench.example',
+                'o365_site_address': 'bench.sharepoint.com',
+                'o365_site_name': 'bench',
+                'o365_site_folderpath': f'Documents/{state.folder_name}',
+                'o365_user_id': 'bench-sharepoint-user',
+                'o365_tenant_id': email_account['o365_tenant_id'],
+                'o365_client_id': 'bench-client',
+                'o365_password_key': 'bench-password'
+            }
+        o365_accounts['o365_accounts'].append(account)
+    # every run starts from cold caches and an empty ledger, the same as a fresh start of main.py.  Ledgers are cached by path, so each run gets its own absolute path
+    run_dir = tempfile.mkdtemp(prefix='run-', dir=work_dir)
+    for setting, filename in (('state_file', 'processor_state.json'), ('rules_cache_file', 'rules_cache.json'), ('ledger_file', 'delivery_ledger.db')):
+        settings_overrides.setdefault(setting, os.path.join(run_dir, filename))
+    settings = main.load_settings(o365_accounts)
+
+    shutil.copy(os.path.join(work_dir, 'default_email_rules.json'), run_dir)
+    os.chdir(run_dir)
+    main.rule_indexes.clear()
+    state.mark_all_unread()
+    state.reset_counts()
+    metrics.registry.reset()
+    before = main.get_request_counters()
+
+    with open(os.devnull, 'w', encoding='utf-8') as devnull:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            start = time.perf_counter()
+            main.run_accounts(o365_accounts, settings)
+            elapsed = time.perf_counter() - start
+
+    after = main.get_request_counters()
+    client_counters = {counter: sum(counters[counter] for counters in after.values()) - sum(counters[counter] for counters in before.values()) for counter in ('requests', 'throttled', 'retried', 'failed')}
+    messages = state.read_count()
+    return {
+        'seconds': round(elapsed, 3),
+        'messages': messages,
+        'messages_per_second': round(messages / elapsed, 2),
+        'attachment_bytes': state.bytes_served,
+        'bytes_per_second': round(state.bytes_served / elapsed),
+        'forwards': state.forwards,
+        'peak_rss_mb': peak_rss_mb(),
+        'server_requests': dict(sorted(state.counts.items())),
+        'client_requests': client_counters,
+        'stages': summarise_stages(metrics.registry.to_json())
+    }
+
+def print_results(results, baseline=None):
+    """Print the results of every run, comparing the headline numbers with a baseline when given"""
+    print(f"main.py import time: {results['import_seconds']:.3f} s")
+    for number, run in enumerate(results['runs'], start=1):
+        print(f'\nRun {number}: {run["messages"]} messages in {run["seconds"]} s')
+        for key, label in (('messages_per_second', 'messages/s'), ('bytes_per_second', 'attachment bytes/s'), ('peak_rss_mb', 'peak RSS MB')):
+            line = f'  {label:20} {run[key]}'
+            if baseline and baseline['runs'] and run[key] and baseline['runs'][-1].get(key):
+                previous = baseline['runs'][-1][key]
+                line += f'  ({(run[key] - previous) / previous * 100:+.1f}% on baseline {previous})'
+            print(line)
+        print(f"  forwards sent        {run['forwards']}")
+        print(f"  Graph requests       {sum(run['server_requests'].values())} {run['server_requests']}")
+        print(f"  client side          {run['client_requests']}")
+        print('  slowest stages (count, total seconds across threads):')
+        for stage, timing in list(run['stages'].items())[:8]:
+            print(f"    {stage:28} {timing['count']:7} {timing['seconds']:9.3f}")
+
+def run_benchmark(args):
+    import_seconds = measure_import_time()
+
+    sys.path.insert(0, SRC_DIR)
+    # pylint: disable=import-error
+    import main
+    from utils import metrics
+    from utils.graph_request import GraphRequestClient
+    # pylint: enable=import-error
+
+    state = FakeGraphState(args.throttle_every, args.throttle_retry_after, args.throttle_concurrency, args.latency_ms / 1000)
+    server = FakeGraphServer(state)
+    server.start()
+    pool_size = max(10, args.accounts * 8)
+    clients = {}
+
+    def authenticate(tenant_id, client_id, client_secret, settings, purpose='email'):
+        # the only part of the processor replaced, as there is no identity platform to sign in to
+        if (tenant_id, purpose) not in clients:
+            clients[(tenant_id, purpose)] = GraphRequestClient(LocalGraphSession(server.url, pool_size), tenant_id, settings)
+        return clients[(tenant_id, purpose)]
+
+    main.authenticate = authenticate
+
+    work_dir = tempfile.mkdtemp(prefix='o365-benchmark-')
+    current_dir = os.getcwd()
+    results = {'arguments': vars(args), 'import_seconds': round(import_seconds, 3), 'runs': []}
+    try:
+        accounts = build_mailboxes(state, args)
+        build_rules(state, args, work_dir)
+        with s3_stand_in(args):
+            if args.target == 's3':
+                import boto3
+                boto3.client('s3', region_name=S3_REGION).create_bucket(Bucket=S3_BUCKET)
+            for _ in range(args.runs):
+                clients.clear()
+                results['runs'].append(run_once(main, metrics, state, args, accounts, work_dir))
+    finally:
+        os.chdir(current_dir)
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+        print(f'\nResults written to {args.output}')
+
+if __name__ == '__main__':
+    # moto and boto3 need credentials to sign requests with, even though nothing leaves the machine
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    run_benchmark(parse_args())
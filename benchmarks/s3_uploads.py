@@ -0,0 +1,81 @@
+"""Measure S3 uploads per second with a new client and secret lookups for every upload, as transmit_files used to make them, against the pooled clients and cached secrets it uses now.  S3 is simulated by moto"""
+import io
+import os
+import sys
+import time
+import argparse
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'o365-email-attachment-processor')
+REGION = 'us-east-1'
+BUCKET = 'o365-upload-benchmark'
+
+class SlowSecretBackend:
+    """Password backend taking 'latency' seconds per lookup, like a round trip to a secret store"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lookups = 0
+
+    def get_password(self, account_name, password_key):
+        self.lookups += 1
+        time.sleep(self.latency)
+        return f'{account_name}-{password_key}'
+
+def upload_with_new_clients(backend, uploads, content):
+    """The previous transmit_files: two secret lookups and a fresh boto3 client for every upload"""
+    import boto3
+
+    for number in range(uploads):
+        s3_access_key = backend.get_password('bench_condition', 'S3AccessKey')
+        s3_secret_key = backend.get_password('bench_condition', 'S3SecretKey')
+        s3 = boto3.client('s3', aws_access_key_id=s3_access_key, aws_secret_access_key=s3_secret_key, region_name=REGION, use_ssl=True)
+        s3.put_object(Body=content, Bucket=BUCKET, Key=f'before/{number}.csv')
+
+def upload_with_pooled_clients(main, backend, uploads, content):
+    """transmit_files with the cached secret provider and the pooled client registry"""
+    # pylint: disable=import-error
+    from utils.secret_provider import SecretProvider
+    # pylint: enable=import-error
+
+    settings = dict(main.DEFAULT_SETTINGS)
+    pw = SecretProvider(backend, settings['secret_cache_ttl_seconds'], settings['secret_cache_max_entries'])
+    delivery_details = {'target': 's3', 'region': REGION, 'bucket': BUCKET, 'subfolder': 'after/'}
+    for number in range(uploads):
+        main.transmit_files(pw, 'bench_condition', 's3', delivery_details, '2023-01-01T00:00:00Z', f'{number}.csv', io.BytesIO(content), settings)
+
+def run_benchmark(args):
+    import boto3
+    from moto import mock_aws
+
+    sys.path.insert(0, SRC_DIR)
+    # pylint: disable=import-error
+    import main
+    from utils.delivery_clients import clear_delivery_clients
+    # pylint: enable=import-error
+
+    content = os.urandom(args.size_kb * 1024)
+    with mock_aws():
+        boto3.client('s3', region_name=REGION).create_bucket(Bucket=BUCKET)
+        results = {}
+        for name in ('before', 'after'):
+            backend = SlowSecretBackend(args.secret_latency_ms / 1000)
+            clear_delivery_clients()
+            start = time.perf_counter()
+            if name == 'before':
+                upload_with_new_clients(backend, args.uploads, content)
+            else:
+                upload_with_pooled_clients(main, backend, args.uploads, content)
+            elapsed = time.perf_counter() - start
+            results[name] = args.uploads / elapsed
+            print(f'{name:7} {args.uploads} uploads in {elapsed:.2f} s, {results[name]:.1f} uploads/s, {backend.lookups} secret lookups')
+    print(f"speedup {results['after'] / results['before']:.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--uploads', type=int, default=200, help='number of attachments uploaded by each variant')
+    parser.add_argument('--size-kb', type=int, default=64, help='size of each attachment')
+    parser.add_argument('--secret-latency-ms', type=float, default=20, help='time taken by each secret store lookup')
+    # moto and boto3 need credentials to sign requests with, even though nothing leaves the machine
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    run_benchmark(parser.parse_args())
@@ -0,0 +1,302 @@
+"""Run the processor as a long-running service, checking each O365 account on its own poll interval instead of once per process"""
+#%%
+import os
+import time
+import heapq
+import random
+import signal
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# pylint: disable=import-error
+import main
+from utils.notification_listener import NotificationListener
+from utils import metrics
+from utils.profiler import ThreadProfiler
+# pylint: enable=import-error
+
+#%%
+
+# the entries every email account needs to be polled and scheduled
+REQUIRED_ACCOUNT_KEYS = ('o365_user_id', 'o365_tenant_id', 'o365_client_id', 'o365_password_key')
+
+def get_poll_interval(account, settings, subscribed=False):
+    """Return the poll interval of an account, which can override the 'poll_interval_seconds' setting.  Accounts receiving change notifications are only polled every 'webhook_fallback_poll_seconds', to catch anything the notifications missed"""
+    if subscribed:
+        return float(settings['webhook_fallback_poll_seconds'])
+    return float(account['email_account'].get('poll_interval_seconds', settings['poll_interval_seconds']))
+
+def next_run_time(account, settings, subscribed=False):
+    """Return the time.monotonic() value at which an account is next due, spread by a random jitter so accounts with the same interval do not all poll at once"""
+    jitter = float(settings['poll_jitter_seconds'])
+    return time.monotonic() + max(0, get_poll_interval(account, settings, subscribed) + random.uniform(-jitter, jitter))
+
+def get_mtime(filename):
+    """Return the modification time of a file, or None while it does not exist (eg while an editor is replacing it)"""
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+def index_accounts(o365_accounts):
+    """Return the configured accounts keyed by account name"""
+    return {account['email_account']['account_name']: account for account in o365_accounts['o365_accounts']}
+
+def load_config(o365_accounts):
+    """Return the settings and the accounts keyed by account name of a loaded accounts file, prefetching their secrets.  Raises an error if an account is missing a required entry or uses an unsupported password method, so a broken accounts file is not run"""
+    settings = main.load_settings(o365_accounts)
+    accounts = index_accounts(o365_accounts)
+    for account_name, account in accounts.items():
+        missing = [key for key in REQUIRED_ACCOUNT_KEYS if key not in account['email_account']]
+        if missing:
+            raise ValueError(f"{account_name}: missing {', '.join(missing)}")
+        main.get_password_method(account['password_method'], settings)
+    if settings['prefetch_secrets']:
+        main.prefetch_account_secrets(list(accounts.values()), settings)
+    return settings, accounts
+
+class PushState:
+    """Subscriptions per account and the message ids their notifications have reported, shared between the notification listener and the scheduler"""
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.subscriptions = {}
+        self.message_ids = {}
+        self.resync = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, account, settings, force_renewal=False):
+        """Create or renew the subscription of an account, returning whether it is receiving notifications"""
+        account_name = account['email_account']['account_name']
+        try:
+            subscription = main.ensure_subscription(account, settings, force_renewal)
+        except Exception as e:
+            print(f'{account_name}: Error subscribing to notifications, falling back to polling: {e}')
+            subscription = None
+        with self._lock:
+            self.subscriptions = {subscription_id: entry for subscription_id, entry in self.subscriptions.items() if entry[0] != account_name}
+            if subscription is not None:
+                self.subscriptions[subscription['id']] = (account_name, subscription['client_state'])
+        return subscription is not None
+
+    def is_subscribed(self, account_name):
+        """Return whether notifications are being received for an account"""
+        with self._lock:
+            return any(entry[0] == account_name for entry in self.subscriptions.values())
+
+    def on_notification(self, notification):
+        """Queue the message reported by a notification.  Lifecycle notifications (subscription removed, missed notifications, reauthorization required) queue a poll and renewal of the account instead"""
+        with self._lock:
+            entry = self.subscriptions.get(notification.get('subscriptionId'))
+            # notifications for unknown subscriptions or with the wrong client state did not come from our subscriptions
+            if entry is None or notification.get('clientState') != entry[1]:
+                return
+            account_name = entry[0]
+            if 'lifecycleEvent' in notification:
+                self.resync.add(account_name)
+            else:
+                message_id = (notification.get('resourceData') or {}).get('id')
+                if message_id is None:
+                    return
+                # dict keys keep the arrival order while dropping repeated notifications
+                self.message_ids.setdefault(account_name, {})[message_id] = None
+        self.wake.set()
+
+    def pending_accounts(self):
+        """Return the names of the accounts with queued message ids"""
+        with self._lock:
+            return list(self.message_ids)
+
+    def take_message_ids(self, account_name):
+        """Return and forget the message ids queued for an account"""
+        with self._lock:
+            return list(self.message_ids.pop(account_name, {}))
+
+    def take_resync(self):
+        """Return and forget the accounts a lifecycle notification has asked to poll and renew"""
+        with self._lock:
+            resync, self.resync = self.resync, set()
+            return resync
+
+def poll_account(account, settings, stop_event, push_state, force_renewal):
+    """Scheduled check of an account, renewing its subscription first when notifications are enabled.  Returns whether the account is receiving notifications"""
+    subscribed = push_state is not None and push_state.subscribe(account, settings, force_renewal)
+    main.run_account(account, settings, stop_event)
+    return subscribed
+
+def process_notified_messages(account, settings, message_ids, stop_event):
+    """Process the messages reported by change notifications, recording their metrics under the account"""
+    with metrics.labelled(account=account['email_account']['account_name']), metrics.timer('process_notified_messages'):
+        main.process_message_ids(account, settings, message_ids, stop_event)
+
+def export_metrics(settings):
+    """Write the metrics file, without letting a failed write stop the daemon"""
+    try:
+        metrics.export(settings['metrics_file'], settings['metrics_format'])
+    except OSError as e:
+        print(f"Error writing metrics to {settings['metrics_file']}: {e}")
+
+def run_daemon(stop_event):
+    """Poll the configured accounts until 'stop_event' is set, then wait for the accounts being processed to finish.  Changes to the accounts file are picked up without a restart, and rules files are checked for changes on every poll.  When 'webhook_url' is set, new messages are also processed as soon as their change notification arrives"""
+    o365_accounts, accounts_filename = main.load_accounts()
+    accounts_mtime = get_mtime(accounts_filename)
+    try:
+        settings, accounts = load_config(o365_accounts)
+    except Exception as e:
+        # nothing is polled until the accounts file is fixed, which is picked up like any other change to it
+        print(f'Error in {accounts_filename}, no accounts are polled until it is fixed: {e!r}')
+        settings, accounts = main.load_settings(o365_accounts), {}
+
+    # set when a notification arrives, so the scheduler does not wait for its next tick
+    wake = threading.Event()
+    push_state = None
+    listener = None
+    # the listener and pool are set up once, so changes to max_workers and the webhook settings need a restart
+    if settings['webhook_url']:
+        push_state = PushState(wake)
+        listener = NotificationListener(settings['webhook_listen_host'], settings['webhook_listen_port'], push_state.on_notification)
+        listener.start()
+        print(f'Listening for change notifications on port {listener.port}')
+    max_workers = int(settings['max_workers'])
+
+    # the next poll of every account not being polled right now.  The schedule heap can hold outdated entries, which are skipped when they do not match
+    next_runs = {}
+    schedule = []
+    for account_name in accounts:
+        next_runs[account_name] = time.monotonic() + random.uniform(0, float(settings['poll_jitter_seconds']))
+        heapq.heappush(schedule, (next_runs[account_name], account_name))
+    # accounts whose next poll also renews their subscription, whether or not it is due
+    force_renewal = set()
+    # future: (account name, tenant id, whether it is a scheduled poll)
+    running = {}
+    running_per_tenant = {}
+
+    def can_start(account_name):
+        tenant_id = accounts[account_name]['email_account']['o365_tenant_id']
+        if len(running) >= max_workers or any(entry[0] == account_name for entry in running.values()):
+            return False
+        return running_per_tenant.get(tenant_id, 0) < max(1, int(settings['max_workers_per_tenant']))
+
+    def start(account_name, is_poll, job, *args):
+        tenant_id = accounts[account_name]['email_account']['o365_tenant_id']
+        running_per_tenant[tenant_id] = running_per_tenant.get(tenant_id, 0) + 1
+        running[executor.submit(job, accounts[account_name], settings, *args)] = (account_name, tenant_id, is_poll)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while not stop_event.is_set():
+            # reload the accounts file when it changes, keeping the previous accounts if it cannot be read
+            mtime = get_mtime(accounts_filename)
+            if mtime is not None and mtime != accounts_mtime:
+                accounts_mtime = mtime
+                try:
+                    o365_accounts, accounts_filename = main.load_accounts()
+                    new_settings, new_accounts = load_config(o365_accounts)
+                except Exception as e:
+                    print(f'Error reloading {accounts_filename}, keeping the current accounts: {e!r}')
+                else:
+                    added = [account_name for account_name in new_accounts if account_name not in accounts]
+                    settings, accounts = new_settings, new_accounts
+                    print(f'Reloaded {accounts_filename}: {len(accounts)} accounts, {len(added)} new')
+                    for account_name in added:
+                        next_runs[account_name] = time.monotonic()
+                        heapq.heappush(schedule, (next_runs[account_name], account_name))
+                    for account_name in [account_name for account_name in next_runs if account_name not in accounts]:
+                        del next_runs[account_name]
+
+            # put finished polls back on the schedule
+            finished = [future for future in running if future.done()]
+            for future in finished:
+                account_name, tenant_id, is_poll = running.pop(future)
+                running_per_tenant[tenant_id] -= 1
+                try:
+                    subscribed = future.result()
+                except Exception as e:
+                    # notified messages that failed are left to the next poll, which still finds them
+                    print(f'{account_name}: Error processing account: {e}')
+                    subscribed = push_state is not None and push_state.is_subscribed(account_name)
+                # accounts removed from the accounts file are dropped here
+                if is_poll and account_name in accounts:
+                    next_runs[account_name] = next_run_time(accounts[account_name], settings, subscribed)
+                    heapq.heappush(schedule, (next_runs[account_name], account_name))
+            # the metrics file is refreshed whenever work finishes, so it can be scraped between polls
+            if finished and settings['metrics_file']:
+                export_metrics(settings)
+
+            if push_state is not None:
+                # lifecycle notifications bring the poll of an account forward
+                for account_name in push_state.take_resync():
+                    force_renewal.add(account_name)
+                    if account_name in next_runs:
+                        next_runs[account_name] = time.monotonic()
+                        heapq.heappush(schedule, (next_runs[account_name], account_name))
+                # process notified messages straight away, unless the account is already being worked on
+                for account_name in push_state.pending_accounts():
+                    if account_name not in accounts:
+                        push_state.take_message_ids(account_name)
+                    elif can_start(account_name):
+                        start(account_name, False, process_notified_messages, push_state.take_message_ids(account_name), stop_event)
+
+            # start the accounts that are due.  Those that cannot start yet keep their place, so they go first once there is capacity
+            deferred = []
+            while schedule and schedule[0][0] <= time.monotonic():
+                run_at, account_name = heapq.heappop(schedule)
+                if next_runs.get(account_name) != run_at:
+                    continue
+                if not can_start(account_name):
+                    deferred.append((run_at, account_name))
+                    continue
+                del next_runs[account_name]
+                start(account_name, True, poll_account, stop_event, push_state, account_name in force_renewal)
+                force_renewal.discard(account_name)
+            for item in deferred:
+                heapq.heappush(schedule, item)
+
+            # sleep until the next account is due, waking up regularly to check on running accounts and the accounts file
+            wait_seconds = min(1.0, schedule[0][0] - time.monotonic()) if schedule else 1.0
+            wake.wait(max(0.05, wait_seconds))
+            wake.clear()
+
+        if running:
+            print(f'Waiting for {len(running)} accounts to finish')
+
+    for future, (account_name, _, _) in running.items():
+        try:
+            future.result()
+        except Exception as e:
+            print(f'{account_name}: Error processing account: {e}')
+    if settings['metrics_file']:
+        export_metrics(settings)
+    if listener is not None:
+        listener.stop()
+    print('Daemon stopped')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the configured O365 accounts continuously, each on its own poll interval')
+    parser.add_argument('--profile', metavar='FILE', help='profile the daemon with cProfile until it stops, writing the stats of all threads to FILE')
+    args = parser.parse_args()
+    profile_file = os.path.abspath(args.profile) if args.profile else None
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(current_dir)
+
+    shutdown = threading.Event()
+
+    def request_shutdown(signum, frame):
+        """Stop scheduling accounts, letting the accounts being processed finish their current message"""
+        print(f'Received signal {signum}, shutting down')
+        shutdown.set()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    profiler = None
+    if profile_file:
+        profiler = ThreadProfiler()
+        profiler.start()
+    try:
+        run_daemon(shutdown)
+    finally:
+        if profiler is not None:
+            profiler.dump(profile_file)
+
+# %%
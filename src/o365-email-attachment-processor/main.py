@@ -5,12 +5,27 @@ import datetime
 import io
 import json
 import base64
+import time
+import threading
+import shutil
+import tempfile
+import secrets
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-from azure.identity import ClientSecretCredential
-from msgraph.core import GraphClient
-import openpyxl
-import boto3
-# import pysftp
+# pylint: disable=import-error
+from utils.state_store import load_state, save_state
+from utils.delivery_clients import get_s3_client, sftp_connection
+from utils.secret_provider import SecretProvider
+from utils.rule_index import compile_rules
+from utils.graph_batch import GraphBatch
+from utils.graph_request import GraphRequestClient, GraphRequestError, get_request_counters
+from utils.graph_auth import get_graph_client
+from utils.delivery_ledger import get_ledger
+from utils.pipeline import ByteBudget, SharedFile, Stage
+from utils import metrics
+from utils.profiler import ThreadProfiler
+# pylint: enable=import-error
 # import configparser
 # pylint: disable=import-error
 # from utils.password import get_password as pw
@@ -18,24 +33,132 @@ import boto3
 
 #%%
 
-def authenticate(tenant_id, client_id, client_secret):
-    """Authenticate with the O365 server to return a client object"""
+DEFAULT_SETTINGS = {
+    "max_workers": 4,
+    "max_workers_per_tenant": 2,
+    "account_timeout_seconds": 600,
+    "scan_mode": "unread",
+    "delta_initial_days": 30,
+    "state_file": "processor_state.json",
+    "attachment_chunk_size_mb": 1,
+    "attachment_spool_mb": 16,
+    "s3_part_size_mb": 8,
+    "s3_max_concurrency": 4,
+    "s3_max_pool_connections": 20,
+    "sftp_pool_size": 4,
+    "sftp_timeout_seconds": 30,
+    "secret_cache_ttl_seconds": 300,
+    "secret_cache_max_entries": 1024,
+    "prefetch_secrets": True,
+    "rules_cache_file": "rules_cache.json",
+    "graph_batch_size": 20,
+    "graph_max_retries": 5,
+    "graph_backoff_base_seconds": 1,
+    "graph_backoff_max_seconds": 60,
+    "graph_max_concurrency_per_tenant": 8,
+    "poll_interval_seconds": 60,
+    "poll_jitter_seconds": 10,
+    "webhook_url": "",
+    "webhook_listen_host": "0.0.0.0",
+    "webhook_listen_port": 8080,
+    "webhook_subscription_minutes": 4200,
+    "webhook_renewal_minutes": 1440,
+    "webhook_fallback_poll_seconds": 900,
+    "ledger_file": "delivery_ledger.db",
+    "ledger_retention_days": 30,
+    "max_delivery_attempts": 5,
+    "pipeline_fetch_workers": 4,
+    "pipeline_match_workers": 1,
+    "pipeline_delivery_workers": 4,
+    "pipeline_queue_size": 50,
+    "pipeline_memory_mb": 64,
+    "metrics_file": "",
+    "metrics_format": "prometheus"
+}
+
+MB = 1024 * 1024
+
+# one secret provider per password method, shared by all accounts using it
+secret_providers = {}
+secret_providers_lock = threading.Lock()
+
+# compiled rules per account, along with the version of the rules files they were compiled from
+rule_indexes = {}
+rule_indexes_lock = threading.Lock()
+
+# everything needed to evaluate the rules is requested with the message listing, so no per-message requests are needed before matching
+MESSAGE_FIELDS = 'id,subject,from,toRecipients,receivedDateTime,hasAttachments,isRead,body'
+MESSAGE_PAGE_SIZE = 50
+# ask for plain text bodies, matching rules against the text rather than the html markup.  msgraph adds its middleware options to the headers it is given, so every request gets a copy
+MESSAGE_HEADERS = {'Prefer': f'odata.maxpagesize={MESSAGE_PAGE_SIZE}, outlook.body-content-type="text"'}
 
-    # Create a ClientSecretCredential object
-    credential = ClientSecretCredential(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
+# subscriptions only report new mail arriving in the inbox, the same mail the polling scans look at
+SUBSCRIPTION_RESOURCE = "/users/{}/mailFolders('inbox')/messages"
+SUBSCRIPTION_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
-    # Create a GraphClient object
-    client = GraphClient(credential=credential)
 
-    return client
+def authenticate(tenant_id, client_id, client_secret, settings, purpose='email'):
+    """Authenticate with the O365 server to return a client object.  Clients are cached per app registration and purpose, sharing access tokens between them.  All requests made with them go through the shared request layer, which retries throttled requests and limits the concurrency per tenant"""
+
+    def build_client(credential):
+        # the Graph library is imported when first needed to keep startup fast
+        from msgraph.core import GraphClient
+
+        # Create a GraphClient object.  GraphClient is normally a singleton that swaps its session on every construction, so accounts and purposes would overwrite each other's sessions.  Build a dedicated instance instead
+        # retries are handled by GraphRequestClient, so the retry middleware of the library is disabled to avoid retrying twice
+        client = object.__new__(GraphClient)
+        client.__init__(credential=credential, max_retries=0)
+
+        return GraphRequestClient(client, tenant_id, settings)
+
+    return get_graph_client(tenant_id, client_id, client_secret, purpose, build_client)
+
+def get_password_method(password_method, settings):
+    """Return the cached secret provider for the configured password method.  Accounts using the same method share the provider and its cache"""
+    password_method = password_method.lower()
+    with secret_providers_lock:
+        if password_method not in secret_providers:
+            # pylint: disable=import-error
+            if password_method == 'keyring':
+                from utils import password_keyring as backend
+            elif password_method == 'secretsmanager':
+                from utils import password_aws as backend
+            elif password_method == 'ssm':
+                from utils import password_ssm as backend
+            elif password_method == 'custom':
+                from utils import password_custom as backend
+            else:
+                raise ValueError(f"Unsupported password_method: {password_method}")
+            # pylint: enable=import-error
+            secret_providers[password_method] = SecretProvider(backend, settings['secret_cache_ttl_seconds'], settings['secret_cache_max_entries'])
+
+        return secret_providers[password_method]
+
+def prefetch_account_secrets(accounts, settings):
+    """Load the email and Sharepoint passwords of all accounts up front, using one bulk lookup per password method where the backend supports it.  Prefetching is only an optimisation, so errors are reported and left for the accounts to run into themselves, where they only stop the accounts concerned"""
+    keys_by_method = {}
+    for account in accounts:
+        try:
+            keys = keys_by_method.setdefault(account['password_method'].lower(), [])
+            for account_type in ('email_account', 'sharepoint_account'):
+                if account_type in account:
+                    keys.append((account[account_type]['account_name'], account[account_type]['o365_password_key']))
+        except Exception as e:
+            print(f"Error reading the passwords to prefetch for an account: {e!r}")
+
+    for password_method, keys in keys_by_method.items():
+        try:
+            get_password_method(password_method, settings).prefetch(keys)
+        except Exception as e:
+            print(f"Error prefetching passwords for password_method {password_method}: {e!r}")
 
 def get_sharepoint_folder(sharepoint_client, o365_site_address, o365_site_name, o365_site_folderpath):
     """Retrieve the address of the Sharepoint folder holding rules definitions"""
     
     try:
-        site_id = sharepoint_client.get(f'https://graph.microsoft.com/v1.0/sites/{o365_site_address}:/sites/{o365_site_name}').json()['id']
+        site_id = sharepoint_client.get_json(f'https://graph.microsoft.com/v1.0/sites/{o365_site_address}:/sites/{o365_site_name}')['id']
 
-        folder_list = sharepoint_client.get(f'https://graph.microsoft.com/v1.0/sites/{site_id}/drives?$select=id,name').json()['value']
+        folder_list = sharepoint_client.get_json(f'https://graph.microsoft.com/v1.0/sites/{site_id}/drives?$select=id,name')['value']
         folder_id = ''
         path_folders = o365_site_folderpath.split("/")
 
@@ -44,7 +167,7 @@ def get_sharepoint_folder(sharepoint_client, o365_site_address, o365_site_name,
             if folder['name'] == 'Documents':
                 documents_folder_id = folder['id']
 
-        folder_list = sharepoint_client.get(f'https://graph.microsoft.com/v1.0/drives/{documents_folder_id}/root/children?$select=folder,name,id').json()['value']
+        folder_list = sharepoint_client.get_json(f'https://graph.microsoft.com/v1.0/drives/{documents_folder_id}/root/children?$select=folder,name,id')['value']
         
         # traverse through underlying subfolders
         for path_folder in path_folders[1:]:
@@ -52,111 +175,190 @@ def get_sharepoint_folder(sharepoint_client, o365_site_address, o365_site_name,
                 if folder['name'] == path_folder:
                     folder_id = folder['id']
                     # folder_name = folder['name']
-                    folder_list = sharepoint_client.get(f'https://graph.microsoft.com/v1.0/drives/{documents_folder_id}/items/{folder_id}/children').json()['value']
+                    folder_list = sharepoint_client.get_json(f'https://graph.microsoft.com/v1.0/drives/{documents_folder_id}/items/{folder_id}/children')['value']
 
         return f'https://graph.microsoft.com/v1.0/drives/{documents_folder_id}/items/{folder_id}/children'
-    except:
+    except Exception as e:
+        print(f'Error locating Sharepoint folder {o365_site_folderpath} on site {o365_site_name}: {e}')
         return None
 
-def retrieve_rules(email_account_name):
-    """Retrieve the pattern and delivery rules from local JSON and optional Sharepoint .xlsx files"""
-    global account
+def parse_rules_workbook(file_content):
+    """Return the conditions defined in the 'Email Rules' sheet of a Sharepoint rules .xlsx file"""
+    import openpyxl
+
+    conditions = []
+    file_obj = io.BytesIO(file_content)
+    # load the Excel workbook from file_obj.  read_only streams the rows instead of building the whole workbook in memory
+    workbook = openpyxl.load_workbook(file_obj, read_only=True)
+    try:
+        # get the active sheet (i.e., the first sheet)
+        # worksheet = workbook.active
+        worksheet = workbook['Email Rules']
+        # print the value in cell A1
+        # print(sheet['A1'].value)
+
+        for row in worksheet.iter_rows(min_row=2, values_only=True):
+            # create a new condition dictionary
+            condition = {}
+            
+            # add the name
+            condition["name"] = row[0]
+            
+            # add the pattern dictionary
+            condition["pattern"] = {}
+            
+            # add the sender
+            condition["pattern"]["sender"] = row[1]
+            
+            # add the subject as a list
+            subject_list = row[2]
+            subject_list = subject_list.replace("\n", "|").replace("||", "|")
+            condition["pattern"]["subject"] = [x.strip() for x in subject_list.split("|")]
+            
+            # add the body as a list
+            body_list = row[3]
+            body_list = body_list.replace("\n", "|").replace("||", "|")
+            condition["pattern"]["body"] = [x.strip() for x in body_list.split("|")]
+            
+            # add the attachments filename as a list
+            attachments_list = row[4]
+            attachments_list = attachments_list.replace("\n", "|").replace("||", "|")
+            condition["pattern"]["attachments"] = [{"filename": [x.strip()]} for x in attachments_list.split("|")]
+            
+            # add the recipients as a list
+            recipients_list = row[5]
+            recipients_list = recipients_list.replace("\n", "|").replace("||", "|")
+            condition["delivery"] = {"target": "email_forward", "recipients": [x.strip() for x in recipients_list.split("|")], "body": row[6]}
+        
+            # add the condition to the output list
+            conditions.append(condition)
+    finally:
+        workbook.close()
+
+    return conditions
+
+def retrieve_sharepoint_rules(sharepoint_account, pw, settings):
+    """Return the conditions from the Sharepoint .xlsx rules files, and a version string that changes whenever any of the files change.  The folder address and the parsed files are cached, so only new or changed files are downloaded"""
+    sharepoint_account_name = sharepoint_account['account_name']
+    # o365_sharepoint_username = sharepoint_account['o365_username']
+    o365_site_address = sharepoint_account['o365_site_address']
+    o365_site_name = sharepoint_account['o365_site_name']
+    o365_site_folderpath = sharepoint_account['o365_site_folderpath']
+    # o365_sharepoint__user_id = sharepoint_account['o365_user_id']
+    o365_sharepoint_tenant_id = sharepoint_account['o365_tenant_id']
+    o365_sharepoint_client_id = sharepoint_account['o365_client_id']
+    sharepoint_password_key = sharepoint_account['o365_password_key']
+    with metrics.timer('get_password'):
+        o365_sharepointpassword = pw(sharepoint_account_name, sharepoint_password_key)
+    with metrics.timer('authenticate', purpose='sharepoint'):
+        sharepoint_client = authenticate(o365_sharepoint_tenant_id, o365_sharepoint_client_id, o365_sharepointpassword, settings, 'sharepoint')
+
+    cache_key = f'{o365_site_address}:/sites/{o365_site_name}/{o365_site_folderpath}'
+    rules_cache = load_state(settings['rules_cache_file'], cache_key)
+    cached_workbooks = rules_cache.get('workbooks', {})
+    cache_changed = False
+
+    files_list = None
+    try:
+        if 'folder_endpoint' in rules_cache:
+            response = sharepoint_client.get(rules_cache['folder_endpoint'])
+            if response.status_code == 200:
+                files_list = response.json()['value']
+            elif response.status_code != 404:
+                # only a missing folder means it has been moved, other failures are usually transient
+                raise GraphRequestError('GET', rules_cache['folder_endpoint'], response)
+        if files_list is None:
+            # the folder has not been looked up yet, or has been moved since
+            with metrics.timer('get_sharepoint_folder'):
+                sharepoint_folder = get_sharepoint_folder(sharepoint_client, o365_site_address, o365_site_name, o365_site_folderpath)
+            if sharepoint_folder is None:
+                raise LookupError(f'folder {o365_site_folderpath} not found')
+            rules_cache['folder_endpoint'] = sharepoint_folder
+            cache_changed = True
+            files_list = sharepoint_client.get_json(sharepoint_folder)['value']
+
+        workbooks = {}
+        for item in files_list:
+            # check if the item is an Excel file
+            if not item['name'].endswith('.xlsx'):
+                continue
+            # the cTag only changes when the content of the file changes, unlike the eTag which also changes with its metadata
+            item_tag = item.get('cTag', item.get('eTag'))
+            cached_workbook = cached_workbooks.get(item['id'])
+            if cached_workbook is not None and cached_workbook['tag'] == item_tag:
+                workbooks[item['id']] = cached_workbook
+                continue
+
+            # get the download URL
+            download_url = item['@microsoft.graph.downloadUrl']
+            # access the file content
+            with metrics.timer('download_rules_file'):
+                response = sharepoint_client.get(download_url)
+            if not response.ok:
+                raise GraphRequestError('GET', item['name'], response)
+            file_content = response.content
+            with metrics.timer('parse_rules_workbook'):
+                workbooks[item['id']] = {'name': item['name'], 'tag': item_tag, 'conditions': parse_rules_workbook(file_content)}
+            cache_changed = True
+    except Exception as e:
+        # keep using the last known rules rather than dropping them
+        print(f'{sharepoint_account_name}: Error reading Sharepoint rules, using the last known rules: {e}')
+        workbooks = cached_workbooks
+
+    if cache_changed or set(workbooks) != set(cached_workbooks):
+        rules_cache['workbooks'] = workbooks
+        save_state(settings['rules_cache_file'], cache_key, rules_cache)
+
+    conditions = [condition for workbook in workbooks.values() for condition in workbook['conditions']]
+    rules_version = '|'.join(f"{item_id}:{workbook['tag']}" for item_id, workbook in workbooks.items())
+
+    return conditions, rules_version
+
+def retrieve_rules(account, pw, settings):
+    """Retrieve the pattern and delivery rules from local JSON and optional Sharepoint .xlsx files.  Returns the rules along with a version string that changes whenever any of the rules files change"""
+    email_account_name = account['email_account']['account_name']
     json_filename = f'{email_account_name}_email_rules.json'
+    if not os.path.exists(json_filename):
+        json_filename = 'default_email_rules.json'
 
-    if os.path.exists(json_filename):
-        with open(json_filename, mode='rb') as f:
-            content = f.read().decode('utf-8').replace('\\', '\\\\')
-            email_rules = json.loads(content)
-    elif os.path.exists('default_email_rules.json'):
-        with open('default_email_rules.json', mode='rb') as f:
-            content = f.read().decode('utf-8').replace('\\', '\\\\')
-            email_rules = json.loads(content)
-    else:
-        pass
+    with open(json_filename, mode='rb') as f:
+        content = f.read().decode('utf-8').replace('\\', '\\\\')
+        email_rules = json.loads(content)
+    rules_version = f'{json_filename}:{os.path.getmtime(json_filename)}'
 
     if 'sharepoint_account' in account:
-        sharepoint_account = account['sharepoint_account']
-        sharepoint_account_name = sharepoint_account['account_name']
-        # o365_sharepoint_username = sharepoint_account['o365_username']
-        o365_site_address = sharepoint_account['o365_site_address']
-        o365_site_name = sharepoint_account['o365_site_name']
-        o365_site_folderpath = sharepoint_account['o365_site_folderpath']
-        # o365_sharepoint__user_id = sharepoint_account['o365_user_id']
-        o365_sharepoint_tenant_id = sharepoint_account['o365_tenant_id']
-        o365_sharepoint_client_id = sharepoint_account['o365_client_id']
-        sharepoint_password_key = sharepoint_account['o365_password_key']
-        o365_sharepointpassword = pw(sharepoint_account_name, sharepoint_password_key)
-        sharepoint_client = authenticate(o365_sharepoint_tenant_id, o365_sharepoint_client_id, o365_sharepointpassword)
+        sharepoint_conditions, sharepoint_version = retrieve_sharepoint_rules(account['sharepoint_account'], pw, settings)
+        email_rules['conditions'].extend(sharepoint_conditions)
+        rules_version = f'{rules_version}|{sharepoint_version}'
+        # print(json.dumps(email_rules, indent=4))
 
-        sharepoint_folder = get_sharepoint_folder(sharepoint_client, o365_site_address, o365_site_name, o365_site_folderpath)
-        
-        if sharepoint_folder is not None:
-            try:
-                files_list = sharepoint_client.get(sharepoint_folder).json()['value']
-
-                for item in files_list:
-                    # check if the item is an Excel file
-                    if item['name'].endswith('.xlsx'):
-                        # get the download URL
-                        download_url = item['@microsoft.graph.downloadUrl']
-                        # access the file content
-                        file_content = sharepoint_client.get(download_url).content
-                        # print(item['@microsoft.graph.downloadUrl'])
-                        # print(item['name'])
-                        file_obj = io.BytesIO(file_content)
-                        # load the Excel workbook from file_obj
-                        workbook = openpyxl.load_workbook(file_obj)
-                        # get the active sheet (i.e., the first sheet)
-                        # worksheet = workbook.active
-                        worksheet = workbook['Email Rules']
-                        # print the value in cell A1
-                        # print(sheet['A1'].value)
-
-                        for row in worksheet.iter_rows(min_row=2, values_only=True):
-                            # create a new condition dictionary
-                            condition = {}
-                            
-                            # add the name
-                            condition["name"] = row[0]
-                            
-                            # add the pattern dictionary
-                            condition["pattern"] = {}
-                            
-                            # add the sender
-                            condition["pattern"]["sender"] = row[1]
-                            
-                            # add the subject as a list
-                            subject_list = row[2]
-                            subject_list = subject_list.replace("\n", "|").replace("||", "|")
-                            condition["pattern"]["subject"] = [x.strip() for x in subject_list.split("|")]
-                            
-                            # add the body as a list
-                            body_list = row[3]
-                            body_list = body_list.replace("\n", "|").replace("||", "|")
-                            condition["pattern"]["body"] = [x.strip() for x in body_list.split("|")]
-                            
-                            # add the attachments filename as a list
-                            attachments_list = row[4]
-                            attachments_list = attachments_list.replace("\n", "|").replace("||", "|")
-                            condition["pattern"]["attachments"] = [{"filename": [x.strip()]} for x in attachments_list.split("|")]
-                            
-                            # add the recipients as a list
-                            recipients_list = row[5]
-                            recipients_list = recipients_list.replace("\n", "|").replace("||", "|")
-                            condition["delivery"] = {"target": "email_forward", "recipients": [x.strip() for x in recipients_list.split("|")], "body": row[6]}
-                        
-                            # add the condition to the output dictionary
-                            email_rules["conditions"].append(condition)
-
-                # print(json.dumps(email_rules, indent=4))
-            except:
-                return email_rules
-    
-    return email_rules
+    return email_rules, rules_version
+
+def get_rule_index(account, pw, settings):
+    """Return the compiled rules for an account, only recompiling them when a rules file has changed"""
+    email_account_name = account['email_account']['account_name']
+    with metrics.timer('retrieve_rules'):
+        email_rules, rules_version = retrieve_rules(account, pw, settings)
+
+    with rule_indexes_lock:
+        if email_account_name in rule_indexes and rule_indexes[email_account_name][0] == rules_version:
+            return rule_indexes[email_account_name][1]
 
-def transmit_files(condition_name, target, delivery_details, email_date, attachment_name, attachment_content):
-    """Transmit files to an target location"""
+    with metrics.timer('compile_rules'):
+        rule_index = compile_rules(email_rules)
+    with rule_indexes_lock:
+        rule_indexes[email_account_name] = (rules_version, rule_index)
+
+    return rule_index
+
+def transmit_files(pw, condition_name, target, delivery_details, email_date, attachment_name, attachment_content, settings):
+    """Transmit files to an target location.  'attachment_content' can be bytes or a readable file object, which is streamed to the target in chunks"""
     # attachment_content = part.get_payload(decode=True)
+    if isinstance(attachment_content, bytes):
+        attachment_content = io.BytesIO(attachment_content)
+    attachment_content.seek(0)
+    chunk_size = int(float(settings['attachment_chunk_size_mb']) * MB)
+
     if 'append_datetime' in delivery_details and str(delivery_details['append_datetime'].lower()) == 'true':
         # datetime_string = datetime.datetime.fromtimestamp(datetime.datetime.now().timestamp()).strftime("%Y-%m-%d_%H%M%S")
         datetime_obj = datetime.datetime.strptime(email_date, "%Y-%m-%dT%H:%M:%SZ")
@@ -168,11 +370,11 @@ def transmit_files(condition_name, target, delivery_details, email_date, attachm
     
     if target == 'local':
         delivery_path = delivery_details['path']
-        if not os.path.exists(delivery_path):
-            os.makedirs(delivery_path)
+        # deliveries running in parallel can create the same folder at the same time
+        os.makedirs(delivery_path, exist_ok=True)
         filepath = Path(delivery_path) / attachment_name
         with open(filepath, 'wb') as f:
-            f.write(attachment_content)
+            shutil.copyfileobj(attachment_content, f, chunk_size)
 
     if target == 's3':
         bucket_region = delivery_details['region']
@@ -180,40 +382,36 @@ def transmit_files(condition_name, target, delivery_details, email_date, attachm
         if 'subfolder' in delivery_details:
             subfolder_name = delivery_details['subfolder']
             attachment_name = subfolder_name + attachment_name
-        s3_access_key = pw(condition_name, "S3AccessKey")
-        s3_secret_key = pw(condition_name, "S3SecretKey")
-
-        # Create an S3 client using the access key and secret key
-        s3 = boto3.client('s3', aws_access_key_id=s3_access_key, aws_secret_access_key=s3_secret_key, region_name=bucket_region, use_ssl=True)
-
-        s3.put_object(Body=attachment_content, Bucket=bucket_name, Key=attachment_name)
-
-    # if target == 'sftp':
-    #     sftp_hostname = delivery_details['hostname']
-    #     sftp_port = int(delivery_details['port'])
-    #     sftp_username = delivery_details['username']
-    #     sftp_password_key = delivery_details['password_key']
-    #     if 'subfolder' in delivery_details:
-    #         sftp_subfolder = delivery_details['subfolder']
-    #     sftp_password = pw(condition_name, sftp_password_key)
-        
-    #     cnopts = pysftp.CnOpts()
-    #     cnopts.hostkeys = None
+        s3 = get_s3_client(pw, condition_name, bucket_region, settings['s3_max_pool_connections'])
 
-    #     with pysftp.Connection(host=sftp_hostname, username=sftp_username, password=sftp_password, cnopts=cnopts) as sftp:
-    #         # Change to the remote directory
-    #         sftp.chdir(sftp_subfolder)
-            
-    #         # Get a list of files in the directory
-    #         file_list = sftp.listdir()
+        from boto3.s3.transfer import TransferConfig
+        # files larger than a single part are sent as a multipart upload, with the parts uploaded in parallel
+        part_size = int(float(settings['s3_part_size_mb']) * MB)
+        transfer_config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=int(settings['s3_max_concurrency']), io_chunksize=chunk_size)
+        s3.upload_fileobj(attachment_content, bucket_name, attachment_name, Config=transfer_config)
 
-    #         # Print the file names
-    #         for file_name in file_list:
-    #             print(file_name)
+    if target == 'sftp':
+        remote_path = attachment_name
+        if 'subfolder' in delivery_details:
+            remote_path = delivery_details['subfolder'] + attachment_name
+        with sftp_connection(pw, condition_name, delivery_details, settings['sftp_pool_size'], float(settings['sftp_timeout_seconds'])) as sftp:
+            sftp.putfo(attachment_content, remote_path)
 
-def forward_email(message, delivery_details):
-    """Forward the email to any number of recipients"""
-    global email_client, o365_email_user_id
+def get_delivery_key(delivery_details):
+    """Return the name a delivery is recorded under in the ledger.  It includes the destination, so a condition can deliver to several targets of the same type"""
+    target = delivery_details['target']
+    if target == 'local':
+        return f"local:{delivery_details['path']}"
+    if target == 's3':
+        return f"s3:{delivery_details['bucket']}/{delivery_details.get('subfolder', '')}"
+    if target == 'sftp':
+        return f"sftp:{delivery_details['hostname']}:{delivery_details.get('port', 22)}/{delivery_details.get('subfolder', '')}"
+    if target == 'email_forward':
+        return f"email_forward:{','.join(delivery_details['recipients'])}"
+    return target
+
+def forward_email(email_client, o365_email_user_id, message, delivery_details, on_complete=None):
+    """Forward the email to any number of recipients.  'email_client' can be a GraphBatch, in which case the forward is queued and 'on_complete' is called with its status once sent"""
     message_id = message['id']
     recipients = delivery_details['recipients']
     # custom_subject = delivery_details.get('subject', '') # have not been able to get overwriting the subject line working
@@ -234,182 +432,638 @@ def forward_email(message, delivery_details):
     #     payload['subject'] = custom_subject
 
     # Forward the email
-    email_client.post(forward_endpoint, json=payload)
+    if on_complete is None:
+        email_client.post(forward_endpoint, json=payload)
+    else:
+        email_client.post(forward_endpoint, json=payload, on_complete=on_complete)
 
+def get_email_body(message):
+    """Return the lowercase body text of a message retrieved with the 'body' field selected"""
+    body = message.get('body') or {}
+    email_body = body.get('content') or ''
 
-current_dir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(current_dir)
+    # check if the email is multipart
+    if 'multipart' in body.get('contentType', '') and isinstance(email_body, list):
+        for part in email_body:
+            # Check if the part contains plain text
+            if 'text/plain' in part['contentType']:
+                email_body = part['content']
+                break
+        else:
+            email_body = ''
 
-if os.path.exists('o365_accounts_local.json'):
-    with open('o365_accounts_local.json', encoding='utf-8') as f:
-        o365_accounts = json.load(f)
-else:
-    with open('o365_accounts.json', encoding='utf-8') as f:
-        o365_accounts = json.load(f)
+    # decode the email body if it is base64 encoded
+    if 'base64' in body:
+        email_body = base64.b64decode(email_body).decode()
 
-#%%
-for account in o365_accounts['o365_accounts']:
+    # convert the email body to lowercase
+    return email_body.lower()
+
+def list_attachments(email_client, o365_email_user_id, message_id):
+    """Return the metadata (id, name, size and contentType) of the file attachments of a message, without their content"""
+    attachment_endpoint = f"/users/{o365_email_user_id}/messages/{message_id}/attachments?$select=id,name,size,contentType"
+    attachments = email_client.get_json(attachment_endpoint).get('value', [])
+
+    # embedded emails and calendar items have no file content to deliver
+    return [attachment for attachment in attachments if attachment.get('@odata.type', '#microsoft.graph.fileAttachment') == '#microsoft.graph.fileAttachment']
+
+def download_attachment(email_client, o365_email_user_id, message_id, attachment_id, settings):
+    """Stream the raw content of a single attachment into a temporary file and return it, positioned at the start.  Small attachments stay in memory, larger ones are spooled to disk"""
+    attachment_endpoint = f"/users/{o365_email_user_id}/messages/{message_id}/attachments/{attachment_id}/$value"
+    chunk_size = int(float(settings['attachment_chunk_size_mb']) * MB)
+
+    attachment_file = tempfile.SpooledTemporaryFile(max_size=int(float(settings['attachment_spool_mb']) * MB))
+    try:
+        with email_client.get(attachment_endpoint, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                attachment_file.write(chunk)
+    except Exception:
+        attachment_file.close()
+        raise
+    attachment_file.seek(0)
+
+    return attachment_file
+
+def fetch_message(email_client, o365_email_user_id, rule_index, message):
+    """Fetch stage of the message pipeline.  Returns the email with the conditions whose sender, subject and body patterns match it, along with the metadata of its attachments when one of those conditions needs it"""
+    # extract relevant fields from the email message
+    email_subject = message['subject'].lower()
+    if 'undeliverable' in email_subject:
+        return message, [], []
+
+    email_from = message['from']['emailAddress']['address'].lower()
+    email_body = get_email_body(message)
+
+    # check if email meets any of the defined patterns.  Conditions whose sender, subject or body patterns do not match are already filtered out by the rule index
+    with metrics.timer('rule_evaluation'):
+        candidates = list(rule_index.candidates(email_from, email_subject, email_body))
+
+    # attachment metadata is only retrieved when a condition needs it
+    attachments = []
+    if message['hasAttachments'] and any(compiled.filename is not None for compiled in candidates):
+        with metrics.timer('list_attachments'):
+            attachments = list_attachments(email_client, o365_email_user_id, message['id'])
+
+    return message, candidates, attachments
+
+def match_message(o365_email_user_id, rule_index, message, candidates, attachments, ledger, max_attempts=0):
+    """Match stage of the message pipeline.  Returns the attachments to deliver, as (attachment, compiled condition, delivery targets) tuples, and the forwards to send, as (condition name, delivery details) pairs.  Targets the ledger shows as already delivered to, or as given up on after 'max_attempts' attempts, are left out"""
+    email_id = message['id']
+
+    def start_delivery(attachment_id, name, condition_name, delivery_details):
+        delivery_key = get_delivery_key(delivery_details)
+        status = ledger.start_delivery(o365_email_user_id, email_id, attachment_id, condition_name, delivery_key, max_attempts)
+        if status == 'failed':
+            # reported rather than retried forever, so the email can still be completed
+            print(f"Giving up on delivering {name} for {condition_name} to {delivery_key} after {max_attempts} attempts")
+            metrics.inc('deliveries_failed_total', condition=condition_name, target=delivery_details['target'])
+        return status == 'pending'
+
+    attachment_keywords = [rule_index.attachment_keywords(attachment['name'].lower()) for attachment in attachments]
+    deliveries = []
+    forwards = []
+
+    for compiled in candidates:
+        condition_name = compiled.name
+        # the targets the attachments are sent to, as opposed to the forwards of the whole email
+        attachment_targets = [delivery_details for delivery_details in compiled.deliveries if delivery_details['target'] != 'email_forward']
+
+        meets_criteria = True
+
+        # check attachment pattern
+        if compiled.filename is not None:
+            any_attachment_matched = False
+            for attachment, found_keywords in zip(attachments, attachment_keywords):
+                if compiled.matches_attachment(found_keywords):
+                    print(f"Attachment {attachment['name'].lower()} meets the condition: {condition_name}")
+                    pending_targets = [delivery_details for delivery_details in attachment_targets if start_delivery(attachment['id'], attachment['name'], condition_name, delivery_details)]
+                    if pending_targets:
+                        deliveries.append((attachment, compiled, pending_targets))
+                    elif attachment_targets:
+                        print(f"Attachment {attachment['name'].lower()} was already delivered or given up on for {condition_name}, skipping")
+                    any_attachment_matched = True
+            if not any_attachment_matched:
+                meets_criteria = False
+                continue
+
+        if meets_criteria:
+            metrics.inc('conditions_matched_total', condition=condition_name)
+            for delivery_details in compiled.deliveries:
+                if delivery_details['target'] == 'email_forward' and start_delivery('', f"email {message['subject']}", condition_name, delivery_details):
+                    forwards.append((condition_name, delivery_details))
+
+        # this prevents the email from being compared against further patterns.  If you wish to have the email evaluated against other conditions, such as to extract other attachments, remove these lines
+        if meets_criteria == True:
+            break
+
+    return deliveries, forwards
+
+def deliver_attachment(email_client, o365_email_user_id, pw, message, attachment, compiled, delivery_targets, settings, ledger):
+    """Deliver stage of the message pipeline.  Downloads a single attachment once and transmits it to all of 'delivery_targets' at the same time.  Every target succeeds or fails on its own, and only the successful ones are recorded in the ledger.  Returns the targets that failed"""
+    # only now is the content of the attachment downloaded
+    with metrics.timer('download_attachment'):
+        attachment_content = download_attachment(email_client, o365_email_user_id, message['id'], attachment['id'], settings)
+    labels = metrics.current_labels()
+
+    def transmit(delivery_details, content):
+        delivery_target = delivery_details['target']
+        delivery_key = get_delivery_key(delivery_details)
+        try:
+            with metrics.labelled(**labels), metrics.timer('transmit_files', condition=compiled.name, target=delivery_target):
+                transmit_files(pw, compiled.name, delivery_target, delivery_details, message['receivedDateTime'], attachment['name'], content, settings)
+        except Exception as e:
+            print(f"Error delivering attachment {attachment['name']} for {compiled.name} to {delivery_key}, it will be retried on the next run: {e}")
+            return False
+        ledger.finish_delivery(o365_email_user_id, message['id'], attachment['id'], compiled.name, delivery_key)
+        with metrics.labelled(**labels):
+            metrics.inc('attachments_delivered_total', condition=compiled.name, target=delivery_target)
+            metrics.inc('attachment_bytes_total', attachment.get('size') or 0, condition=compiled.name, target=delivery_target)
+        return True
+
+    with attachment_content:
+        if len(delivery_targets) == 1:
+            results = [transmit(delivery_targets[0], attachment_content)]
+        else:
+            # every target reads the downloaded copy through a reader of its own, so the targets are written to in parallel
+            shared_content = SharedFile(attachment_content)
+            with ThreadPoolExecutor(max_workers=len(delivery_targets)) as executor:
+                results = list(executor.map(lambda delivery_details: transmit(delivery_details, shared_content.reader()), delivery_targets))
+
+    return [delivery_details for delivery_details, delivered in zip(delivery_targets, results) if not delivered]
+
+def complete_message(write_batch, o365_email_user_id, message, forwards, ledger):
+    """Queue the forwards of an email whose attachments have all been delivered, then mark it as read, and as done in the ledger, once every forward has been sent"""
+    email_id = message['id']
+
+    def mark_read():
+        def on_marked_read(status):
+            if status < 300:
+                ledger.finish_message(o365_email_user_id, email_id)
+                metrics.inc('messages_completed_total')
+        write_batch.patch(f"/users/{o365_email_user_id}/messages/{email_id}", json={'isRead': True}, on_complete=on_marked_read)
+
+    if not forwards:
+        mark_read()
+    unsent = [(condition_name, get_delivery_key(delivery_details)) for condition_name, delivery_details in forwards]
+    for condition_name, delivery_details in forwards:
+        # queueing the forward returns straight away, so it is timed until its batch has been sent and answered
+        def on_forwarded(status, condition_name=condition_name, delivery_key=get_delivery_key(delivery_details), queued=time.perf_counter()):
+            metrics.observe('stage_duration_seconds', time.perf_counter() - queued, stage='forward_email', condition=condition_name)
+            if status >= 300:
+                metrics.inc('stage_errors_total', stage='forward_email', condition=condition_name)
+                metrics.inc('forwards_failed_total', condition=condition_name)
+                return
+            metrics.inc('forwards_sent_total', condition=condition_name)
+            ledger.finish_delivery(o365_email_user_id, email_id, '', condition_name, delivery_key)
+            unsent.remove((condition_name, delivery_key))
+            if not unsent:
+                mark_read()
+        forward_email(write_batch, o365_email_user_id, message, delivery_details, on_forwarded)
+
+def process_messages(email_client, o365_email_user_id, pw, rule_index, messages, settings, write_batch):
+    """Evaluate emails against the rules and deliver their attachments or forward them accordingly, in fetch, match and deliver stages connected by bounded queues, so downloads, matching and uploads of different emails overlap.  'messages' can be a generator, which is only asked for the next email once the previous one is queued and recorded in the ledger.  Marking the emails as read and forwarding them are queued on 'write_batch'"""
+    ledger = get_ledger(settings['ledger_file'], settings['ledger_retention_days'])
+    budget = ByteBudget(float(settings['pipeline_memory_mb']) * MB)
+    spool_size = int(float(settings['attachment_spool_mb']) * MB)
+    queue_size = settings['pipeline_queue_size']
+    # number of deliveries still outstanding per email, whether any failed, and the forwards to send once they are done
+    progress = {}
+    progress_lock = threading.Lock()
+    # the stages run on their own threads, which record their metrics with the labels of the calling thread
+    labels = metrics.current_labels()
+
+    def delivery_done(message, failed):
+        with progress_lock:
+            entry = progress[message['id']]
+            entry['left'] -= 1
+            entry['failed'] = entry['failed'] or failed
+            finished = entry['left'] == 0
+            if finished:
+                del progress[message['id']]
+        # an email with a failed delivery stays unread and pending in the ledger, so the next run retries what is missing
+        if finished and not entry['failed']:
+            # an error is handled here, as it is not an error delivering the attachment that happened to finish last
+            try:
+                with metrics.labelled(**labels):
+                    complete_message(write_batch, o365_email_user_id, message, entry['forwards'], ledger)
+            except Exception as e:
+                print(f"Error completing email {message['subject']}, it will be retried on the next run: {e}")
+
+    def deliver(job):
+        message, attachment, compiled, delivery_targets = job
+        # every delivery is counted as done exactly once, as failed if it raised, in which case delivery_failed reports the error
+        failed = True
+        try:
+            # attachments larger than the spool size are written to disk, so only the part held in memory counts against the budget.  The copy is shared by all targets, so it is counted once
+            with metrics.labelled(**labels):
+                with metrics.timer('wait_for_memory_budget'):
+                    reserved = budget.acquire(min(attachment.get('size') or 0, spool_size))
+                try:
+                    failed_targets = deliver_attachment(email_client, o365_email_user_id, pw, message, attachment, compiled, delivery_targets, settings, ledger)
+                finally:
+                    budget.release(reserved)
+                for delivery_details in failed_targets:
+                    metrics.inc('delivery_errors_total', condition=compiled.name, target=delivery_details['target'])
+            failed = bool(failed_targets)
+        finally:
+            delivery_done(message, failed)
+
+    def delivery_failed(job, e):
+        _, attachment, compiled, _ = job
+        print(f"Error delivering attachment {attachment['name']} for {compiled.name}, it will be retried on the next run: {e}")
+        metrics.inc('delivery_errors_total', condition=compiled.name, **labels)
+
+    def match(item):
+        message, candidates, attachments = item
+        with metrics.labelled(**labels), metrics.timer('match_message'):
+            deliveries, forwards = match_message(o365_email_user_id, rule_index, message, candidates, attachments, ledger, settings['max_delivery_attempts'])
+        if not deliveries:
+            with metrics.labelled(**labels):
+                complete_message(write_batch, o365_email_user_id, message, forwards, ledger)
+            return
+        with progress_lock:
+            progress[message['id']] = {'left': len(deliveries), 'failed': False, 'forwards': forwards}
+        for attachment, compiled, delivery_targets in deliveries:
+            delivery_stage.put((message, attachment, compiled, delivery_targets))
+
+    def fetch(message):
+        with metrics.labelled(**labels), metrics.timer('fetch_message'):
+            item = fetch_message(email_client, o365_email_user_id, rule_index, message)
+        match_stage.put(item)
+
+    def message_failed(item, e):
+        # the fetch stage is handed the email, the match stage the output of the fetch stage
+        message = item[0] if isinstance(item, tuple) else item
+        print(f"Error processing email {message['subject']}, it will be retried on the next run: {e}")
+
+    # created from the last stage backwards, so every stage exists before anything is put on it
+    delivery_stage = Stage('deliver', deliver, settings['pipeline_delivery_workers'], queue_size, delivery_failed)
+    match_stage = Stage('match', match, settings['pipeline_match_workers'], queue_size, message_failed)
+    fetch_stage = Stage('fetch', fetch, settings['pipeline_fetch_workers'], queue_size, message_failed)
+    try:
+        for message in messages:
+            # recorded before anything else happens, so an email interrupted at any stage is resumed by the next run
+            ledger.start_message(o365_email_user_id, message['id'])
+            metrics.inc('messages_total')
+            fetch_stage.put(message)
+    finally:
+        # a stage can still be feeding the next one until it is drained, so they are closed in order
+        fetch_stage.close()
+        match_stage.close()
+        delivery_stage.close()
+
+def get_message(email_client, o365_email_user_id, message_id):
+    """Return a single message with the fields needed for rule matching, or None if it no longer exists"""
+    api_endpoint = f"/users/{o365_email_user_id}/messages/{message_id}?$select={MESSAGE_FIELDS}"
+    response = email_client.get(api_endpoint, headers=dict(MESSAGE_HEADERS))
+    if response.status_code == 404:
+        return None
+    if not response.ok:
+        raise GraphRequestError('GET', api_endpoint, response)
+
+    return response.json()
+
+def list_unread_messages(email_client, o365_email_user_id):
+    """Return the unread messages in the inbox, newest first, including the fields needed for rule matching"""
+    api_endpoint = f"/users/{o365_email_user_id}/mailfolders/inbox/messages?$filter=isRead eq false&$orderby=receivedDateTime desc&$select={MESSAGE_FIELDS}"
+
+    messages = []
+    while api_endpoint:
+        result = email_client.get_json(api_endpoint, headers=dict(MESSAGE_HEADERS))
+        messages.extend(result.get('value', []))
+        api_endpoint = result.get('@odata.nextLink')
+
+    # for message in messages:
+    #     print(message['subject'].lower() + ' | ' + message['receivedDateTime'])
+
+    return messages
+
+def list_delta_messages(email_client, o365_email_user_id, account_state, settings, ledger):
+    """Return the inbox messages added or changed since the last delta round that have not been processed yet, oldest first, along with the deltaLink for the next round"""
+    delta_link = account_state.get('delta_link')
+    # without a deltaLink (or the watermark kept by older versions) this is the very first sync
+    first_sync = delta_link is None and 'watermark' not in account_state
+    # processed messages are cleared from the ledger after 'ledger_retention_days', so older mail it does not know cannot be told apart from mail already processed
+    horizon = ''
+    if settings['ledger_retention_days']:
+        horizon = (datetime.datetime.utcnow() - datetime.timedelta(days=float(settings['ledger_retention_days']))).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    messages = {}
+    url = delta_link
+    while True:
+        if url is None:
+            # initial sync, optionally limited to recent mail to avoid enumerating the whole inbox history
+            url = f"/users/{o365_email_user_id}/mailFolders/inbox/messages/delta?$select={MESSAGE_FIELDS}"
+            if settings['delta_initial_days']:
+                since = datetime.datetime.utcnow() - datetime.timedelta(days=float(settings['delta_initial_days']))
+                url += f"&$filter=receivedDateTime ge {since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+
+        response = email_client.get(url, headers=dict(MESSAGE_HEADERS))
+        if response.status_code == 410 and delta_link is not None:
+            # the delta token has expired, start a new initial sync.  The ledger prevents already processed mail from being picked up again
+            delta_link = None
+            url = None
+            messages = {}
+            continue
+        if not response.ok:
+            raise GraphRequestError('GET', url, response)
+        result = response.json()
+
+        for message in result.get('value', []):
+            # deleted messages and property changes to mail we have already processed are not of interest.  Mail moved or released into the inbox keeps its original receivedDateTime, so it is checked by id
+            if '@removed' in message:
+                continue
+            status = ledger.message_status(o365_email_user_id, message['id'])
+            if status == 'done':
+                continue
+            if status is None:
+                if message['receivedDateTime'] < horizon:
+                    continue
+                if first_sync and message.get('isRead'):
+                    # behave like the unread scan for existing mail, remembering it so later changes to it are not mistaken for new mail
+                    ledger.start_message(o365_email_user_id, message['id'])
+                    ledger.finish_message(o365_email_user_id, message['id'])
+                    continue
+            messages[message['id']] = message
+
+        if '@odata.nextLink' in result:
+            url = result['@odata.nextLink']
+        else:
+            delta_link = result.get('@odata.deltaLink', delta_link)
+            break
+
+    return sorted(messages.values(), key=lambda message: message['receivedDateTime']), delta_link
+
+def connect_email_account(account, settings):
+    """Return the secret provider and Graph client for the email side of an account"""
     # choose appropriate password method
-    password_method = account['password_method'].lower()
-    # pylint: disable=import-error
-    if password_method == 'keyring':
-        from utils.password_keyring import get_password as pw
-    elif password_method == 'secretsmanager':
-        from utils.password_aws import get_password as pw
-    elif password_method == 'ssm':
-        from utils.password_ssm import get_password as pw
-    if password_method == 'custom':
-        from utils.password_custom import get_password as pw
-    # pylint: enable=import-error
+    pw = get_password_method(account['password_method'], settings)
 
     email_account = account['email_account']
     email_account_name = email_account['account_name']
-    o365_email_username = email_account['o365_username']
-    o365_email_user_id = email_account['o365_user_id']
     o365_email_tenant_id = email_account['o365_tenant_id']
     o365_email_client_id = email_account['o365_client_id']
     email_password_key = email_account['o365_password_key']
-    o365_emailpassword = pw(email_account_name, email_password_key)
+    with metrics.timer('get_password'):
+        o365_emailpassword = pw(email_account_name, email_password_key)
     # build initial email client to check for any unread messages
-    email_client = authenticate(o365_email_tenant_id, o365_email_client_id, o365_emailpassword)
+    with metrics.timer('authenticate', purpose='email'):
+        email_client = authenticate(o365_email_tenant_id, o365_email_client_id, o365_emailpassword, settings)
+
+    return pw, email_client
+
+def process_account(account, settings, deadline=None, stop_event=None):
+    """Check a single O365 account for new emails and process them against its rules.  Stops picking up new messages once 'deadline' (a time.monotonic() value) has passed or 'stop_event' is set"""
+    pw, email_client = connect_email_account(account, settings)
+    email_account_name = account['email_account']['account_name']
+    o365_email_user_id = account['email_account']['o365_user_id']
 
     # search_parameters = {
     #     "$search": "isRead eq false",
     #     "$orderby": "receivedDateTime desc"
     # }
 
-    # define the API endpoint for retrieving emails
-    api_endpoint = f"/users/{o365_email_user_id}/mailfolders/inbox/messages?$filter=isRead eq false&$orderby=receivedDateTime desc"
-    result = email_client.get(api_endpoint).json()
+    ledger = get_ledger(settings['ledger_file'], settings['ledger_retention_days'])
+    # the ledger stays open for as long as the daemon runs, so it is pruned on every check rather than only when opened
+    ledger.prune(settings['ledger_retention_days'])
 
-    # for message in result['value']:
-    #     print(message['subject'].lower() + ' | ' + message['receivedDateTime'])
+    scan_mode = account.get('scan_mode', settings['scan_mode']).lower()
+    if scan_mode == 'delta':
+        account_state = load_state(settings['state_file'], email_account_name)
+        with metrics.timer('list_messages', scan_mode=scan_mode):
+            messages, delta_link = list_delta_messages(email_client, o365_email_user_id, account_state, settings, ledger)
+    else:
+        with metrics.timer('list_messages', scan_mode=scan_mode):
+            messages = list_unread_messages(email_client, o365_email_user_id)
+
+    # messages whose processing was interrupted, eg by a crash or a failed delivery, are picked up again even when the scan no longer returns them
+    listed_ids = {message['id'] for message in messages}
+    resumed = []
+    for message_id in ledger.pending_messages(o365_email_user_id):
+        if message_id in listed_ids:
+            continue
+        message = get_message(email_client, o365_email_user_id, message_id)
+        if message is None:
+            # the message has been deleted, so there is nothing left to resume
+            ledger.finish_message(o365_email_user_id, message_id)
+            continue
+        print(f"{email_account_name}: Resuming unfinished message {message['subject']}")
+        resumed.append(message)
+    messages = resumed + messages
 
-    if 'value' in result and len(result['value']) == 0:
-        print('No Unread messages to process')
-        continue
+    if len(messages) == 0:
+        print(f'{email_account_name}: No new messages to process')
+        if scan_mode == 'delta':
+            save_delta_link(settings, email_account_name, account_state, delta_link)
+        return
 
     # read rules
-    email_rules = retrieve_rules(email_account_name)
+    rule_index = get_rule_index(account, pw, settings)
 
-    # rebuild email client after potentially checking Sharepoint - building the Sharepoint client seems to affect the email client
-    email_client = authenticate(o365_email_tenant_id, o365_email_client_id, o365_emailpassword)
+    # load the S3 keys and SFTP passwords of every condition that may need them in one go
+    delivery_secrets = []
+    for compiled in rule_index.conditions:
+        for delivery_details in compiled.deliveries:
+            if delivery_details['target'] == 's3':
+                delivery_secrets.extend((compiled.name, key) for key in ('S3AccessKey', 'S3SecretKey'))
+            elif delivery_details['target'] == 'sftp':
+                delivery_secrets.append((compiled.name, delivery_details['password_key']))
+    pw.prefetch(delivery_secrets)
 
-    # loop through all unread emails
-    for message in result['value']:
-        # Fetch the email content
-        email_id = message['id']
+    stopped_early = False
 
-        # extract relevant fields from the email message
-        email_subject = message['subject'].lower()
-        email_from = message['from']['emailAddress']['address'].lower()
-        email_to = [recipient['emailAddress']['address'].lower() for recipient in message['toRecipients']]
-        email_date = message['receivedDateTime']
+    def queued_messages():
+        """Hand the new emails to the pipeline one at a time, stopping early on timeout or shutdown"""
+        nonlocal stopped_early
+        for message in messages:
+            if deadline is not None and time.monotonic() > deadline:
+                # leave the remaining messages for the next run.  In delta mode the old deltaLink is kept so they are returned again
+                print(f'{email_account_name}: Account timeout reached, remaining messages will be processed on the next run')
+                stopped_early = True
+                return
+            if stop_event is not None and stop_event.is_set():
+                print(f'{email_account_name}: Shutting down, remaining messages will be processed on the next run')
+                stopped_early = True
+                return
 
-        if 'undeliverable' in email_subject:
-            # mark the email as read
-            email_client.patch(f"/users/{o365_email_user_id}/messages/{email_id}", json={'isRead': True})
-            continue
+            # a message pushed by a change notification since the scan may already be done
+            if ledger.message_status(o365_email_user_id, message['id']) != 'done':
+                yield message
 
-        response = email_client.get(f"{api_endpoint}", params={'$select': 'body'})
-        email_body = ''
+    # loop through all new emails.  Mark-as-read and forward requests are sent in batches, and any still queued are sent when leaving the block
+    with GraphBatch(email_client, settings['graph_batch_size']) as write_batch:
+        process_messages(email_client, o365_email_user_id, pw, rule_index, queued_messages(), settings, write_batch)
 
-        # check if the email is multipart
-        if 'multipart' in response.json()['value'][0]['body']['contentType']:
-            for part in response.json()['body']['content']:
-                # Check if the part contains plain text
-                if 'text/plain' in part['contentType']:
-                    email_body = part['content']
-                    break
-        else:
-            email_body = response.json()['value'][0]['body']['content']
-
-        # decode the email body if it is base64 encoded
-        if 'base64' in response.json()['value'][0]['body']:
-            email_body = base64.b64decode(email_body).decode()
-
-        # convert the email body to lowercase
-        email_body = email_body.lower()
-
-        # retrieve any attachment names.  Could potentially be used to check attachment patterns without having to actually fully download them
-        # for message in result['value']:
-        #     # Check if the message has attachments
-        #     if message['hasAttachments']:
-        #         # Retrieve the attachment names
-        #         attachment_endpoint = f"/users/{o365_email_user_id}/messages/{message['id']}/attachments?$select=name"
-        #         attachments = email_client.get(attachment_endpoint).json()
-        #         attachment_names = [attachment['name'] for attachment in attachments['value']]
-
-        # check if the message has attachments
-        if message['hasAttachments']:
-            # Retrieve the attachments
-            attachment_endpoint = f"/users/{o365_email_user_id}/messages/{message['id']}/attachments"
-            attachments = email_client.get(attachment_endpoint).json()
-
-        # mark the email as read
-        email_client.patch(f"/users/{o365_email_user_id}/messages/{email_id}", json={'isRead': True})
-
-        # check if email meets any of the defined patterns
-        for condition in email_rules['conditions']:
-            condition_name = condition['name']
-            if condition_name == 'example_entry_will_be_ignored':
-                continue
+    if scan_mode == 'delta' and not stopped_early:
+        save_delta_link(settings, email_account_name, account_state, delta_link)
 
-            pattern = condition['pattern']
+def save_delta_link(settings, email_account_name, account_state, delta_link):
+    """Save the deltaLink the next delta round of an account starts from"""
+    account_state['delta_link'] = delta_link
+    # the watermark of older versions is no longer used, the ledger records which messages have been processed
+    for key in ('watermark', 'watermark_ids', 'pushed_ids'):
+        account_state.pop(key, None)
+    save_state(settings['state_file'], email_account_name, account_state)
 
-            meets_criteria = True
-                
-            # ensure the proper definitions are present
-            if not ('attachments' in pattern or 'sender' in pattern or 'subject' in pattern or 'body' in pattern):
-                meets_criteria = False
+def process_message_ids(account, settings, message_ids, stop_event=None):
+    """Process specific messages of an account, such as those reported by change notifications.  Messages that are gone or already processed are skipped"""
+    pw, email_client = connect_email_account(account, settings)
+    email_account_name = account['email_account']['account_name']
+    o365_email_user_id = account['email_account']['o365_user_id']
+
+    scan_mode = account.get('scan_mode', settings['scan_mode']).lower()
+    ledger = get_ledger(settings['ledger_file'], settings['ledger_retention_days'])
+
+    def queued_messages():
+        """Fetch the notified emails and hand those still to be processed to the pipeline one at a time"""
+        for message_id in message_ids:
+            if stop_event is not None and stop_event.is_set():
+                print(f'{email_account_name}: Shutting down, remaining messages will be processed on the next run')
+                return
+
+            message = get_message(email_client, o365_email_user_id, message_id)
+            if message is None:
+                # deleted or moved out of the inbox before it could be processed
                 continue
 
-            # check sender pattern
-            if 'sender' in pattern and pattern['sender'].lower() not in email_from:
-                meets_criteria = False
+            # skip anything already processed, the same way the polling scan would.  Messages left unfinished in the ledger are always processed
+            status = ledger.message_status(o365_email_user_id, message['id'])
+            if status == 'done' or (status is None and scan_mode != 'delta' and message.get('isRead')):
                 continue
 
-            # check subject patterns
-            if 'subject' in pattern:
-                subject_patterns = pattern['subject']
-                subject_matches = [pattern for pattern in subject_patterns if pattern.lower() in email_subject.lower()]
-                if not subject_matches:
-                    meets_criteria = False
-                    continue
+            yield message
 
-            # check body patterns
-            if 'body' in pattern:
-                body_patterns = pattern['body']
-                body_matches = [pattern for pattern in body_patterns if pattern.lower() in email_body.lower()]
-                if not body_matches:
-                    meets_criteria = False
-                    continue
+    with GraphBatch(email_client, settings['graph_batch_size']) as write_batch:
+        process_messages(email_client, o365_email_user_id, pw, get_rule_index(account, pw, settings), queued_messages(), settings, write_batch)
 
-            if 'delivery' in condition:
-                delivery_target = condition['delivery']['target']
-            else:
-                delivery_target = None
-            
-            # check attachment pattern
-            if meets_criteria and 'attachments' in pattern:
-                attachment_matches = [pattern.lower() for pattern in pattern['attachments'][0]['filename']]
-                for attachment in attachments['value']:
-                    attachment_name = attachment['name'].lower()
-                    if all(pattern in attachment_name for pattern in attachment_matches):
-                        print(f'Attachment {attachment_name} meets the condition: {condition_name}')
-                        if delivery_target != 'email_forward':
-                            attachment_content = base64.b64decode(attachment['contentBytes'])
-                            transmit_files(condition_name, delivery_target, condition['delivery'], email_date, attachment['name'], attachment_content)
-                        any_attachment_matched = True
-                if not any_attachment_matched:
-                    meets_criteria = False
+def ensure_subscription(account, settings, force_renewal=False):
+    """Make sure the account has a Graph subscription sending new inbox messages to 'webhook_url', creating it or extending its expiry when it is due for renewal.  Returns the subscription id, client state and expiry"""
+    pw, email_client = connect_email_account(account, settings)
+    email_account_name = account['email_account']['account_name']
+
+    account_state = load_state(settings['state_file'], email_account_name)
+    subscription = account_state.get('subscription')
+    now = datetime.datetime.utcnow()
+    expiration = (now + datetime.timedelta(minutes=float(settings['webhook_subscription_minutes']))).strftime(SUBSCRIPTION_TIME_FORMAT)
+
+    if subscription is not None and subscription['notification_url'] == settings['webhook_url']:
+        renew_after = (now + datetime.timedelta(minutes=float(settings['webhook_renewal_minutes']))).strftime(SUBSCRIPTION_TIME_FORMAT)
+        if not force_renewal and subscription['expiration'] > renew_after:
+            return subscription
+        response = email_client.patch(f"/subscriptions/{subscription['id']}", json={'expirationDateTime': expiration})
+        if response.ok:
+            subscription['expiration'] = expiration
+            account_state['subscription'] = subscription
+            save_state(settings['state_file'], email_account_name, account_state)
+            return subscription
+        # the subscription has expired or been removed, so a new one is created
+        print(f"{email_account_name}: Could not renew subscription {subscription['id']}, creating a new one")
+    elif subscription is not None:
+        # the notification url has changed, so the old subscription would keep sending to the wrong place
+        email_client.delete(f"/subscriptions/{subscription['id']}")
+
+    # the client state is sent along with every notification, so notifications not coming from Graph can be told apart
+    client_state = secrets.token_urlsafe(32)
+    response = email_client.post('/subscriptions', json={
+        'changeType': 'created',
+        'notificationUrl': settings['webhook_url'],
+        'lifecycleNotificationUrl': settings['webhook_url'],
+        'resource': SUBSCRIPTION_RESOURCE.format(account['email_account']['o365_user_id']),
+        'expirationDateTime': expiration,
+        'clientState': client_state
+    })
+    if not response.ok:
+        raise GraphRequestError('POST', '/subscriptions', response)
+
+    subscription = {'id': response.json()['id'], 'client_state': client_state, 'expiration': expiration, 'notification_url': settings['webhook_url']}
+    account_state['subscription'] = subscription
+    save_state(settings['state_file'], email_account_name, account_state)
+    print(f"{email_account_name}: Created subscription {subscription['id']}")
+
+    return subscription
+
+def load_accounts():
+    """Return the accounts from o365_accounts_local.json if it exists, otherwise from o365_accounts.json, along with the name of the file read"""
+    accounts_filename = 'o365_accounts_local.json' if os.path.exists('o365_accounts_local.json') else 'o365_accounts.json'
+    with open(accounts_filename, encoding='utf-8') as f:
+        o365_accounts = json.load(f)
+
+    return o365_accounts, accounts_filename
+
+def load_settings(o365_accounts):
+    """Return the processor settings, falling back to DEFAULT_SETTINGS for anything not defined in the accounts file"""
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(o365_accounts.get('settings', {}))
+
+    return settings
+
+def run_account(account, settings, stop_event=None):
+    """Worker wrapper around process_account that applies the account timeout"""
+    # the timeout starts once the account is actually being worked on, not while it waits in the queue
+    deadline = None
+    if settings['account_timeout_seconds']:
+        deadline = time.monotonic() + float(settings['account_timeout_seconds'])
+    with metrics.labelled(account=account['email_account']['account_name']), metrics.timer('process_account'):
+        process_account(account, settings, deadline, stop_event)
+
+def run_accounts(o365_accounts, settings):
+    """Process all configured accounts in parallel using a bounded worker pool, capping the number of concurrent accounts per tenant"""
+    pending = list(o365_accounts['o365_accounts'])
+    if settings['prefetch_secrets']:
+        prefetch_account_secrets(pending, settings)
+    max_per_tenant = max(1, int(settings['max_workers_per_tenant']))
+    running_per_tenant = {}
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=int(settings['max_workers'])) as executor:
+        while pending or futures:
+            # only hand accounts to the pool when their tenant has spare capacity, so a busy tenant does not park idle workers
+            for account in list(pending):
+                if len(futures) >= int(settings['max_workers']):
+                    break
+                tenant_id = account['email_account']['o365_tenant_id']
+                if running_per_tenant.get(tenant_id, 0) >= max_per_tenant:
                     continue
+                pending.remove(account)
+                running_per_tenant[tenant_id] = running_per_tenant.get(tenant_id, 0) + 1
+                futures[executor.submit(run_account, account, settings)] = account
 
-            if meets_criteria and delivery_target == 'email_forward':
-                forward_email(message, condition['delivery'])
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                account = futures.pop(future)
+                running_per_tenant[account['email_account']['o365_tenant_id']] -= 1
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"{account['email_account']['account_name']}: Error processing account: {e}")
 
-            # this prevents the email from being compared against further patterns.  If you wish to have the email evaluated against other conditions, such as to extract other attachments, remove these lines
-            if meets_criteria == True:
-                break
+    # report throttling, which is usually the reason for slow cycles
+    for tenant_id, counters in get_request_counters().items():
+        if counters['throttled'] or counters['retried'] or counters['failed']:
+            print(f"Tenant {tenant_id}: {counters['requests']} Graph requests, {counters['throttled']} throttled, {counters['retried']} retried, {counters['failed']} failed")
+
+    if settings['metrics_file']:
+        metrics.export(settings['metrics_file'], settings['metrics_format'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the configured O365 accounts once for new emails and process them')
+    parser.add_argument('--profile', metavar='FILE', help='profile the run with cProfile, writing the stats of all threads to FILE')
+    args = parser.parse_args()
+    profile_file = os.path.abspath(args.profile) if args.profile else None
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(current_dir)
+
+    profiler = None
+    if profile_file:
+        profiler = ThreadProfiler()
+        profiler.start()
+    try:
+        o365_accounts, _ = load_accounts()
+        run_accounts(o365_accounts, load_settings(o365_accounts))
+    finally:
+        if profiler is not None:
+            profiler.dump(profile_file)
 
 # %%
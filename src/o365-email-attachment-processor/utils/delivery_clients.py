@@ -0,0 +1,90 @@
+"""Reuse delivery clients across all deliveries in a run"""
+import threading
+from contextlib import contextmanager
+
+# accounts are processed in parallel, so the registry is only modified while holding the lock
+_lock = threading.Lock()
+_s3_clients = {}
+# idle (ssh client, sftp client) pairs per server and login
+_sftp_pools = {}
+
+def get_s3_client(pw, condition_name, region, max_pool_connections):
+    """Return a pooled S3 client for a condition.  Conditions sharing a region and credentials share a client"""
+    # the secret provider caches the keys, so rotated keys are picked up once the cached entries expire
+    s3_access_key = pw(condition_name, "S3AccessKey")
+    s3_secret_key = pw(condition_name, "S3SecretKey")
+
+    with _lock:
+        client_key = (region, s3_access_key, s3_secret_key)
+        if client_key not in _s3_clients:
+            # boto3 is only imported once an S3 delivery happens, keeping it out of startup for everything else
+            import boto3
+            from botocore.config import Config
+
+            # Create an S3 client using the access key and secret key
+            _s3_clients[client_key] = boto3.client('s3', aws_access_key_id=s3_access_key, aws_secret_access_key=s3_secret_key, region_name=region, use_ssl=True, config=Config(max_pool_connections=int(max_pool_connections)))
+
+        return _s3_clients[client_key]
+
+def open_sftp(hostname, port, username, password, verify_host_key, timeout):
+    """Log in to an SFTP server, returning the ssh client and the sftp client opened on it"""
+    # paramiko is only needed for SFTP deliveries, so it is an optional dependency imported on first use
+    import paramiko
+
+    ssh_client = paramiko.SSHClient()
+    ssh_client.load_system_host_keys()
+    if not verify_host_key:
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh_client.connect(hostname, port=port, username=username, password=password, timeout=timeout, look_for_keys=False, allow_agent=False)
+    try:
+        return ssh_client, ssh_client.open_sftp()
+    except Exception:
+        ssh_client.close()
+        raise
+
+@contextmanager
+def sftp_connection(pw, condition_name, delivery_details, pool_size, timeout):
+    """Yield an SFTP client for a delivery, reusing an idle connection to the same server and login when there is one.  The connection goes back to the pool afterwards, keeping at most 'pool_size' idle connections per server, unless the delivery failed"""
+    hostname = delivery_details['hostname']
+    port = int(delivery_details.get('port', 22))
+    username = delivery_details['username']
+    password = pw(condition_name, delivery_details['password_key'])
+    # host keys are checked against known_hosts unless the delivery turns it off
+    verify_host_key = str(delivery_details.get('verify_host_key', 'True')).lower() != 'false'
+    pool_key = (hostname, port, username, password, verify_host_key)
+
+    connection = None
+    with _lock:
+        idle = _sftp_pools.setdefault(pool_key, [])
+        while idle and connection is None:
+            connection = idle.pop()
+            # the server may have dropped the connection while it sat idle
+            if not connection[0].get_transport() or not connection[0].get_transport().is_active():
+                connection[0].close()
+                connection = None
+    if connection is None:
+        connection = open_sftp(hostname, port, username, password, verify_host_key, timeout)
+
+    try:
+        yield connection[1]
+    except Exception:
+        # the connection may be left in an unknown state, so it is not reused
+        connection[0].close()
+        raise
+
+    with _lock:
+        idle = _sftp_pools.setdefault(pool_key, [])
+        if len(idle) < int(pool_size):
+            idle.append(connection)
+            return
+    connection[0].close()
+
+def clear_delivery_clients():
+    """Forget all cached clients, so they are rebuilt on next use"""
+    with _lock:
+        _s3_clients.clear()
+        pools = list(_sftp_pools.values())
+        _sftp_pools.clear()
+    for idle in pools:
+        for ssh_client, _ in idle:
+            ssh_client.close()
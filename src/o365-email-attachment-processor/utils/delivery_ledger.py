@@ -0,0 +1,97 @@
+"""Durable record of which messages and deliveries have been completed, so interrupted work can be resumed without delivering anything twice"""
+import time
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    user_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    attachment_id TEXT NOT NULL,
+    condition_name TEXT NOT NULL,
+    target TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, message_id, attachment_id, condition_name, target)
+);
+'''
+
+class DeliveryLedger:
+    """SQLite ledger of messages ('pending' until fully handled, then 'done') and of the deliveries made for them ('pending' while being attempted, 'delivered' once successful, 'failed' once given up on)"""
+
+    def __init__(self, path, retention_days=0):
+        # one connection shared by all worker threads, with writes serialised by the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(SCHEMA)
+        self.prune(retention_days)
+
+    def prune(self, retention_days):
+        """Remove the messages finished more than 'retention_days' ago, along with their deliveries.  0 keeps them forever"""
+        if not retention_days:
+            return
+        # finished messages are only needed while Graph may still report them as new, so old ones are cleared out
+        cutoff = time.time() - float(retention_days) * 86400
+        with self._lock:
+            self.connection.execute("DELETE FROM deliveries WHERE (user_id, message_id) IN (SELECT user_id, message_id FROM messages WHERE status = 'done' AND updated_at < ?)", (cutoff,))
+            self.connection.execute("DELETE FROM messages WHERE status = 'done' AND updated_at < ?", (cutoff,))
+
+    def _execute(self, sql, parameters):
+        with self._lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def start_message(self, user_id, message_id):
+        """Record that a message is being processed, unless it is already known"""
+        self._execute("INSERT OR IGNORE INTO messages VALUES (?, ?, 'pending', ?)", (user_id, message_id, time.time()))
+
+    def finish_message(self, user_id, message_id):
+        """Record that a message has been fully handled"""
+        self._execute("UPDATE messages SET status = 'done', updated_at = ? WHERE user_id = ? AND message_id = ?", (time.time(), user_id, message_id))
+
+    def message_status(self, user_id, message_id):
+        """Return 'pending' or 'done' for a known message, otherwise None"""
+        rows = self._execute('SELECT status FROM messages WHERE user_id = ? AND message_id = ?', (user_id, message_id))
+        return rows[0][0] if rows else None
+
+    def pending_messages(self, user_id):
+        """Return the ids of the messages of a mailbox whose processing has not finished"""
+        return [row[0] for row in self._execute("SELECT message_id FROM messages WHERE user_id = ? AND status = 'pending' ORDER BY updated_at", (user_id,))]
+
+    def start_delivery(self, user_id, message_id, attachment_id, condition_name, target, max_attempts=0):
+        """Record an attempt at a delivery.  Returns 'pending' if it should be attempted, or 'delivered' or 'failed' if it should be skipped.  A delivery still pending after 'max_attempts' attempts is marked as 'failed', 0 meaning there is no limit"""
+        with self._lock:
+            rows = self.connection.execute('SELECT status, attempts FROM deliveries WHERE user_id = ? AND message_id = ? AND attachment_id = ? AND condition_name = ? AND target = ?', (user_id, message_id, attachment_id, condition_name, target)).fetchall()
+            if not rows:
+                self.connection.execute("INSERT INTO deliveries VALUES (?, ?, ?, ?, ?, 'pending', 1, ?)", (user_id, message_id, attachment_id, condition_name, target, time.time()))
+                return 'pending'
+            status, attempts = rows[0]
+            if status == 'pending' and max_attempts and attempts >= max_attempts:
+                status = 'failed'
+                self.connection.execute("UPDATE deliveries SET status = 'failed', updated_at = ? WHERE user_id = ? AND message_id = ? AND attachment_id = ? AND condition_name = ? AND target = ?", (time.time(), user_id, message_id, attachment_id, condition_name, target))
+            elif status == 'pending':
+                self.connection.execute('UPDATE deliveries SET attempts = attempts + 1, updated_at = ? WHERE user_id = ? AND message_id = ? AND attachment_id = ? AND condition_name = ? AND target = ?', (time.time(), user_id, message_id, attachment_id, condition_name, target))
+            return status
+
+    def finish_delivery(self, user_id, message_id, attachment_id, condition_name, target):
+        """Record that a delivery succeeded"""
+        self._execute("UPDATE deliveries SET status = 'delivered', updated_at = ? WHERE user_id = ? AND message_id = ? AND attachment_id = ? AND condition_name = ? AND target = ?", (time.time(), user_id, message_id, attachment_id, condition_name, target))
+
+_lock = threading.Lock()
+_ledgers = {}
+
+def get_ledger(path, retention_days=0):
+    """Return the shared ledger stored at 'path', opening it the first time"""
+    with _lock:
+        if path not in _ledgers:
+            _ledgers[path] = DeliveryLedger(path, retention_days)
+        return _ledgers[path]
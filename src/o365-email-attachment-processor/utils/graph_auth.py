@@ -0,0 +1,56 @@
+"""Share credentials, access tokens and Graph clients between accounts using the same app registration"""
+import time
+import threading
+
+# access tokens are renewed this long before they expire, so a request never goes out with a token about to expire
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
+class CachedTokenCredential:
+    """Wraps an azure.identity credential, handing out one cached access token per set of scopes and renewing it shortly before it expires.  Only one thread renews a token, the others wait for it"""
+
+    def __init__(self, credential):
+        self.credential = credential
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        with self._lock:
+            token = self._tokens.get(scopes)
+            if token is None or token.expires_on - TOKEN_REFRESH_MARGIN_SECONDS <= time.time():
+                token = self.credential.get_token(*scopes, **kwargs)
+                self._tokens[scopes] = token
+            return token
+
+_lock = threading.Lock()
+_credentials = {}
+_clients = {}
+
+def get_credential(tenant_id, client_id, client_secret):
+    """Return the shared credential for an app registration, building a new one if the secret has changed"""
+    with _lock:
+        cached = _credentials.get((tenant_id, client_id))
+        if cached is None or cached[0] != client_secret:
+            from azure.identity import ClientSecretCredential
+            # Create a ClientSecretCredential object
+            credential = ClientSecretCredential(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
+            cached = (client_secret, CachedTokenCredential(credential))
+            _credentials[(tenant_id, client_id)] = cached
+            # clients built with the old secret are rebuilt on next use
+            for client_key in [client_key for client_key in _clients if client_key[:2] == (tenant_id, client_id)]:
+                del _clients[client_key]
+        return cached[1]
+
+def get_graph_client(tenant_id, client_id, client_secret, purpose, build_client):
+    """Return the Graph client for an app registration and purpose (eg 'email' or 'sharepoint'), calling build_client(credential) the first time.  Each purpose gets its own HTTP session and connection pool, while all of them share the credential and its access tokens"""
+    credential = get_credential(tenant_id, client_id, client_secret)
+    client_key = (tenant_id, client_id, purpose)
+    with _lock:
+        if client_key not in _clients:
+            _clients[client_key] = build_client(credential)
+        return _clients[client_key]
+
+def clear_graph_clients():
+    """Forget all cached credentials, tokens and clients"""
+    with _lock:
+        _credentials.clear()
+        _clients.clear()
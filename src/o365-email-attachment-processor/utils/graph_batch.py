@@ -0,0 +1,147 @@
+"""Coalesce Graph write requests into JSON $batch calls"""
+import time
+import threading
+# pylint: disable=import-error
+from utils.graph_request import is_retryable
+from utils import metrics
+# pylint: enable=import-error
+
+MAX_BATCH_SIZE = 20
+
+class GraphBatch:
+    """Buffers PATCH and POST requests and sends them through the Graph $batch endpoint, up to 20 requests at a time.  Whole batches are sent by a thread of its own as they fill up, and what is left when the batch is closed.  Has the same patch/post signature as the Graph client, so it can be passed where only writes are made"""
+
+    def __init__(self, client, batch_size=MAX_BATCH_SIZE, max_retries=3):
+        self.client = client
+        self.batch_size = max(1, min(int(batch_size), MAX_BATCH_SIZE))
+        self.max_retries = int(max_retries)
+        self.results = {}
+        self._pending = []
+        self._callbacks = {}
+        self._next_id = 0
+        self._lock = threading.Condition()
+        self._sender = None
+        self._closing = False
+        # the sender thread records its metrics with the labels of the thread creating the batch
+        self._labels = metrics.current_labels()
+
+    def patch(self, url, json=None, on_complete=None):
+        """Queue a PATCH request and return its request id"""
+        return self.add('PATCH', url, json, on_complete)
+
+    def post(self, url, json=None, on_complete=None):
+        """Queue a POST request and return its request id"""
+        return self.add('POST', url, json, on_complete)
+
+    def add(self, method, url, body=None, on_complete=None):
+        """Queue a request, handing it to the sender thread once a full batch is waiting.  Returns the request id, which can be looked up in 'results' once the batch is closed.  'on_complete' is called with the final status code once the request has been sent, with the metric labels of the thread that queued it"""
+        with self._lock:
+            self._next_id += 1
+            request = {'id': str(self._next_id), 'method': method, 'url': url}
+            if body is not None:
+                request['body'] = body
+                request['headers'] = {'Content-Type': 'application/json'}
+            self._pending.append(request)
+            if on_complete is not None:
+                self._callbacks[request['id']] = (on_complete, metrics.current_labels())
+            if len(self._pending) >= self.batch_size:
+                # the thread queueing the request does not wait for the batch to be sent, or for its retries
+                if self._sender is None and not self._closing:
+                    self._sender = threading.Thread(target=self._send_batches, name='graph-batch', daemon=True)
+                    self._sender.start()
+                self._lock.notify()
+        return request['id']
+
+    def flush(self):
+        """Send every queued request on the calling thread.  Requests in a batch that are throttled, or fail with a server error unless they are POSTs, are retried, honouring Retry-After up to the client's maximum backoff.  Returns a dict of request id to status code for the requests sent"""
+        statuses = {}
+        # completion callbacks can queue follow-up requests, which are sent as part of the same flush
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                break
+
+            for i in range(0, len(pending), self.batch_size):
+                statuses.update(self._complete(self._send(pending[i:i + self.batch_size])))
+
+        return statuses
+
+    def close(self):
+        """Wait for the sender thread to send the whole batches queued, then send whatever is left"""
+        with self._lock:
+            self._closing = True
+            self._lock.notify_all()
+        if self._sender is not None:
+            self._sender.join()
+        self.flush()
+
+    def _send_batches(self):
+        """Sender thread, sending whole batches as they fill up until the batch is closed"""
+        with metrics.labelled(**self._labels):
+            self._send_whole_batches()
+
+    def _send_whole_batches(self):
+        while True:
+            with self._lock:
+                while len(self._pending) < self.batch_size and not self._closing:
+                    self._lock.wait()
+                # a partial batch is left to close()
+                if len(self._pending) < self.batch_size:
+                    return
+                requests, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            try:
+                self._complete(self._send(requests))
+            except Exception as e:
+                print(f"Error sending a batch of {len(requests)} requests, the emails they were for will be retried on the next run: {e}")
+
+    def _complete(self, sent):
+        """Record the statuses of sent requests and call their completion callbacks.  Returns 'sent'"""
+        for request_id, status in sent.items():
+            with self._lock:
+                self.results[request_id] = status
+                on_complete, labels = self._callbacks.pop(request_id, (None, None))
+            if on_complete is not None:
+                with metrics.labelled(**labels):
+                    on_complete(status)
+        return sent
+
+    def _send(self, requests):
+        """Send a single batch, retrying the requests in it that were throttled or failed with a server error"""
+        statuses = {}
+        attempt = 0
+        while requests:
+            # the client has already retried the batch as a whole if it was throttled, so a rejected batch is final
+            with metrics.timer('send_batch'):
+                response = self.client.post('/$batch', json={'requests': requests})
+            if response.status_code != 200:
+                responses = [{'id': request['id'], 'status': response.status_code, 'headers': {}, 'body': {}} for request in requests]
+            else:
+                responses = response.json()['responses']
+
+            retry = []
+            retry_delay = 0
+            requests_by_id = {request['id']: request for request in requests}
+            for item in responses:
+                statuses[item['id']] = item['status']
+                if response.status_code == 200 and is_retryable(requests_by_id[item['id']]['method'], item['status']) and attempt < self.max_retries:
+                    retry.append(requests_by_id[item['id']])
+                    # the same capped Retry-After and jittered backoff as single requests
+                    retry_delay = max(retry_delay, self.client.retry_delay(item.get('headers'), attempt))
+                elif item['status'] >= 300:
+                    request = requests_by_id[item['id']]
+                    error = (item.get('body') or {}).get('error', {}).get('message', '')
+                    print(f"Batched {request['method']} {request['url']} failed with status {item['status']}: {error}")
+
+            requests = retry
+            if requests:
+                attempt += 1
+                time.sleep(retry_delay)
+
+        return statuses
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,172 @@
+"""Shared request layer for Graph calls, adding status checks, retries with backoff and adaptive per-tenant concurrency"""
+import time
+import random
+import threading
+# pylint: disable=import-error
+from utils import metrics
+# pylint: enable=import-error
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+# a POST, such as a forward or a new subscription, may have taken effect even though it failed with a server error or lost connection, so it is only sent again when Graph turned it away
+NON_IDEMPOTENT_METHODS = {'POST'}
+
+def is_retryable(method, status_code):
+    """Return whether a request answered with 'status_code' can be sent again without the risk of it taking effect twice"""
+    if method.upper() in NON_IDEMPOTENT_METHODS:
+        return status_code in THROTTLE_STATUS_CODES
+    return status_code in RETRY_STATUS_CODES
+
+def never_sent(error):
+    """Return whether a connection error happened before the request reached Graph, such as a refused connection or a connect timeout"""
+    # requests and urllib3 are already loaded by the Graph client by the time one of its requests fails
+    from requests.exceptions import ConnectTimeout, ConnectionError as RequestsConnectionError
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    if isinstance(error, (ConnectTimeout, ConnectionRefusedError)):
+        return True
+    if isinstance(error, RequestsConnectionError) and error.args:
+        # requests wraps the urllib3 error in a MaxRetryError, whose reason is the error that ended the request
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+    return False
+
+class GraphRequestError(Exception):
+    """Raised when a Graph request still fails after any retries"""
+
+    def __init__(self, method, url, response):
+        self.status_code = response.status_code
+        try:
+            message = response.json().get('error', {}).get('message', '')
+        except ValueError:
+            message = response.text[:200]
+        super().__init__(f'{method} {url} failed with status {response.status_code}: {message}')
+
+class AdaptiveLimiter:
+    """Concurrency limit adjusted with AIMD: every successful request raises the limit slightly, a throttled request halves it"""
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = float(maximum)
+        self.minimum = float(minimum)
+        self.limit = self.maximum
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request is allowed to start"""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled):
+        """Mark a request as finished and adjust the limit based on whether it was throttled"""
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                # requests already in flight when the throttling started would otherwise each halve the limit again
+                if time.monotonic() - self._last_decrease > 1:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = time.monotonic()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+_lock = threading.Lock()
+_limiters = {}
+_counters = {}
+
+def get_limiter(tenant_id, maximum):
+    """Return the limiter shared by all clients of a tenant"""
+    with _lock:
+        if tenant_id not in _limiters:
+            _limiters[tenant_id] = AdaptiveLimiter(maximum)
+            _counters[tenant_id] = {'requests': 0, 'throttled': 0, 'retried': 0, 'failed': 0}
+        return _limiters[tenant_id]
+
+def count(tenant_id, counter):
+    """Increase one of the request counters of a tenant"""
+    with _lock:
+        _counters[tenant_id][counter] += 1
+    metrics.inc(f'graph_{counter}_total', tenant=tenant_id)
+
+def get_request_counters():
+    """Return a copy of the request counters (requests, throttled, retried, failed) per tenant"""
+    with _lock:
+        return {tenant_id: dict(counters) for tenant_id, counters in _counters.items()}
+
+class GraphRequestClient:
+    """Wraps a Graph client so every request goes through the tenant's adaptive limiter and is retried on throttling and server errors.  Has the same get/post/patch/put/delete methods as the Graph client"""
+
+    def __init__(self, client, tenant_id, settings):
+        self.client = client
+        self.tenant_id = tenant_id
+        self.max_retries = int(settings['graph_max_retries'])
+        self.backoff_base = float(settings['graph_backoff_base_seconds'])
+        self.backoff_max = float(settings['graph_backoff_max_seconds'])
+        self.limiter = get_limiter(tenant_id, settings['graph_max_concurrency_per_tenant'])
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying it when it is throttled or fails with a server or connection error.  POST requests are only retried when throttled or when they could not be sent at all.  Returns the last response"""
+        attempt = 0
+        while True:
+            count(self.tenant_id, 'requests')
+            self.limiter.acquire()
+            response = None
+            start = time.perf_counter()
+            try:
+                response = getattr(self.client, method.lower())(url, **kwargs)
+            except OSError as e:
+                # connection errors and timeouts from requests are OSErrors
+                if attempt >= self.max_retries or (method.upper() in NON_IDEMPOTENT_METHODS and not never_sent(e)):
+                    count(self.tenant_id, 'failed')
+                    raise
+            finally:
+                self.limiter.release(response is not None and response.status_code in THROTTLE_STATUS_CODES)
+                metrics.observe('graph_request_duration_seconds', time.perf_counter() - start, method=method.upper(), tenant=self.tenant_id)
+
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                return response
+            if response is not None and response.status_code in THROTTLE_STATUS_CODES:
+                count(self.tenant_id, 'throttled')
+            if attempt >= self.max_retries or (response is not None and not is_retryable(method, response.status_code)):
+                count(self.tenant_id, 'failed')
+                return response
+
+            time.sleep(self.retry_delay(response.headers if response is not None else None, attempt))
+            if response is not None:
+                response.close()
+            attempt += 1
+            count(self.tenant_id, 'retried')
+
+    def retry_delay(self, headers, attempt):
+        """Return the Retry-After delay if the response headers have one, capped at the maximum backoff, otherwise an exponential backoff with full jitter"""
+        if headers and 'Retry-After' in headers:
+            try:
+                return min(float(headers['Retry-After']), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get_json(self, url, **kwargs):
+        """Send a GET request and return the JSON body, raising GraphRequestError if it did not succeed"""
+        response = self.get(url, **kwargs)
+        if not response.ok:
+            raise GraphRequestError('GET', url, response)
+        return response.json()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
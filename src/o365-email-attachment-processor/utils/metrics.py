@@ -0,0 +1,143 @@
+"""In-process counters and timing histograms, exported as Prometheus text or a JSON summary"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# upper bounds in seconds, from quick Graph calls up to large uploads
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PREFIX = 'o365_'
+
+class Histogram:
+    """Cumulative-bucket histogram, along with the count, sum and largest value observed"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+class MetricsRegistry:
+    """Counters and histograms keyed by metric name and labels"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_json(self):
+        """Return a summary of every metric as a JSON-serialisable dict"""
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': round(histogram.sum, 6), 'mean': round(histogram.sum / histogram.count, 6) if histogram.count else 0, 'max': round(histogram.max, 6)}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        return {'generated_at': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        """Return every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {PREFIX}{name} counter')
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{PREFIX}{name}{format_labels(labels)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", str(bound)),))} {count}')
+                    lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    """Return labels as a Prometheus label set, escaping the values"""
+    if not labels:
+        return ''
+    escaped = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels)
+    return '{' + escaped + '}'
+
+registry = MetricsRegistry()
+
+# labels added to every metric recorded on the current thread, such as the account being processed
+_context = threading.local()
+
+def current_labels():
+    """Return the labels set for the current thread"""
+    return dict(getattr(_context, 'labels', {}))
+
+@contextmanager
+def labelled(**labels):
+    """Add labels to every metric recorded on the current thread inside the block"""
+    previous = current_labels()
+    _context.labels = {**previous, **labels}
+    try:
+        yield
+    finally:
+        _context.labels = previous
+
+def inc(name, value=1, **labels):
+    """Increase a counter, adding the labels set for the current thread"""
+    registry.inc(name, value, **{**current_labels(), **labels})
+
+def observe(name, value, **labels):
+    """Add a value to a histogram, adding the labels set for the current thread"""
+    registry.observe(name, value, **{**current_labels(), **labels})
+
+@contextmanager
+def timer(stage, **labels):
+    """Record how long the block takes in the stage_duration_seconds histogram, and count it in stage_errors_total if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc('stage_errors_total', stage=stage, **labels)
+        raise
+    finally:
+        observe('stage_duration_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+def export(path, format='prometheus'):
+    """Write every metric to a file, as Prometheus text (eg for the node_exporter textfile collector) or a JSON summary"""
+    if format == 'json':
+        content = json.dumps(registry.to_json(), indent=4)
+    else:
+        content = registry.to_prometheus()
+
+    # written to a temporary file first, so a scraper never reads a half written file
+    temp_file = f'{path}.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp_file, path)
@@ -0,0 +1,67 @@
+"""Small HTTP listener receiving Graph change notifications"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class NotificationListener:
+    """Listens for Graph change notifications, calling on_notification(notification) for each one received.  Answers the validation request Graph sends when a subscription is created or renewed"""
+
+    def __init__(self, host, port, on_notification):
+        self.on_notification = on_notification
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                listener.handle(self)
+
+            def log_message(self, format, *args):
+                # every notification would otherwise be logged to stderr
+                pass
+
+        self.server = ThreadingHTTPServer((host, int(port)), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        """Port the listener is bound to, useful when started on port 0"""
+        return self.server.server_address[1]
+
+    def start(self):
+        """Start listening on a background thread"""
+        self._thread = threading.Thread(target=self.server.serve_forever, name='notification-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening and close the socket"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        """Answer a single POST from Graph"""
+        query = parse_qs(urlparse(request.path).query)
+        if 'validationToken' in query:
+            # the token has to be echoed back as plain text within 10 seconds for the subscription to be created
+            token = query['validationToken'][0].encode('utf-8')
+            request.send_response(200)
+            request.send_header('Content-Type', 'text/plain')
+            request.send_header('Content-Length', str(len(token)))
+            request.end_headers()
+            request.wfile.write(token)
+            return
+
+        try:
+            notifications = json.loads(request.rfile.read(int(request.headers.get('Content-Length', 0)))).get('value', [])
+        except (ValueError, AttributeError):
+            request.send_response(400)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        # Graph retries notifications that are not acknowledged within a few seconds, so they are only handed over here and processed elsewhere
+        request.send_response(202)
+        request.send_header('Content-Length', '0')
+        request.end_headers()
+        for notification in notifications:
+            self.on_notification(notification)
@@ -1,16 +1,27 @@
 """Retrieve password using AWS Secret Manager"""
-import boto3
+import threading
 from botocore.exceptions import ClientError
 import base64
 
-client = boto3.client(
-    'secretsmanager',
-    endpoint_url='https://my-secret-manager-instance.example.com',
-    region_name='your_region_name',
-    aws_access_key_id='your_access_key',
-    aws_secret_access_key='your_secret_key',
-    aws_session_token='your_session_token'
-)
+# built lazily by get_client(), so the module can be imported without boto3 being loaded
+client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the Secrets Manager client, building it on first use"""
+    global client
+    with _client_lock:
+        if client is None:
+            import boto3
+            client = boto3.client(
+                'secretsmanager',
+                endpoint_url='https://my-secret-manager-instance.example.com',
+                region_name='your_region_name',
+                aws_access_key_id='your_access_key',
+                aws_secret_access_key='your_secret_key',
+                aws_session_token='your_session_token'
+            )
+        return client
 
 def get_password(account_name, password_key, encoding='utf-8'):
     """Return password based on account name and secret key"""
@@ -18,7 +29,7 @@ def get_password(account_name, password_key, encoding='utf-8'):
     secret_name = f"{account_name}_{password_key}"
     
     try:
-        response = client.get_secret_value(SecretId=secret_name)
+        response = get_client().get_secret_value(SecretId=secret_name)
     except ClientError as e:
         print(f"Error retrieving secret: {e}")
         return None
@@ -34,3 +45,28 @@ def get_password(account_name, password_key, encoding='utf-8'):
             
             secret_value = base64.b64decode(response['SecretBinary']).decode(encoding)
         return secret_value
+
+def get_passwords(keys, encoding='utf-8'):
+    """Return a dict of passwords for a list of (account_name, password_key) pairs, retrieving up to 20 secrets per request"""
+    # batch_get_secret_value is only available in newer versions of boto3
+    if not hasattr(get_client(), 'batch_get_secret_value'):
+        return {(account_name, password_key): get_password(account_name, password_key, encoding) for account_name, password_key in keys}
+
+    secret_names = {f"{account_name}_{password_key}": (account_name, password_key) for account_name, password_key in keys}
+    secret_values = {}
+    names = list(secret_names)
+    for i in range(0, len(names), 20):
+        try:
+            response = get_client().batch_get_secret_value(SecretIdList=names[i:i + 20])
+        except ClientError as e:
+            print(f"Error retrieving secrets: {e}")
+            continue
+        for secret in response['SecretValues']:
+            if 'SecretString' in secret:
+                secret_values[secret_names[secret['Name']]] = secret['SecretString']
+            else:
+                secret_values[secret_names[secret['Name']]] = base64.b64decode(secret['SecretBinary']).decode(encoding)
+        for error in response.get('Errors', []):
+            print(f"Error retrieving secret {error['SecretId']}: {error.get('Message', error['ErrorCode'])}")
+
+    return secret_values
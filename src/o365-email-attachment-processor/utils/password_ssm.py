@@ -1,35 +1,79 @@
 """Retrieve password using Systems Manager Parameter Store"""
-import boto3
+import threading
 from botocore.exceptions import ClientError
 
-client = boto3.client(
-    'ssm',
-    endpoint_url='https://my-ssm-instance.example.com',
-    region_name='your_region_name',
-    aws_access_key_id='your_access_key',
-    aws_secret_access_key='your_secret_key',
-    aws_session_token='your_session_token'
-)
+# the client is built on first use, so importing this module does not require valid AWS settings or pay for a boto3 client
+client = None
+_client_lock = threading.Lock()
 
-def get_password(account_name, password_key, encoding='utf-8'):
-    """Return password based on account name and secret key"""
+def get_client():
+    """Return the Parameter Store client, building it on first use"""
+    global client
+    with _client_lock:
+        if client is None:
+            import boto3
+            client = boto3.client(
+                'ssm',
+                endpoint_url='https://my-ssm-instance.example.com',
+                region_name='your_region_name',
+                aws_access_key_id='your_access_key',
+                aws_secret_access_key='your_secret_key',
+                aws_session_token='your_session_token'
+            )
+        return client
 
-    password_path = '/aws/prod/email_processor/passwords'
+password_path = '/aws/prod/email_processor/passwords'
+
+def get_parameter_name(account_name, password_key):
+    """Return the full parameter name for an account name and secret key"""
     parameter_name = f"{account_name}_{password_key}"
     if password_path is not None and password_path != '':
         parameter_name = f"{password_path}/{account_name}_{password_key}"
+    return parameter_name
+
+def decode_value(secret_value, encoding='utf-8'):
+    """Return a parameter value as a string"""
+    supported_encodings = ['utf-8', 'ascii', 'latin-1', 'utf-16']
+    if encoding not in supported_encodings:
+        print(f"Unsupported encoding: {encoding}")
+        return None
+    if isinstance(secret_value, bytes):
+        secret_value = secret_value.decode(encoding)
+    return secret_value
+
+def get_password(account_name, password_key, encoding='utf-8'):
+    """Return password based on account name and secret key"""
+
+    parameter_name = get_parameter_name(account_name, password_key)
     try:
-        response = client.get_parameter(Name=parameter_name, WithDecryption=True)
+        response = get_client().get_parameter(Name=parameter_name, WithDecryption=True)
     except ClientError as e:
         print(f"Error retrieving secret: {e}")
         return None
     else:
-        secret_value = response['Parameter']['Value']
-        supported_encodings = ['utf-8', 'ascii', 'latin-1', 'utf-16']
-        if encoding not in supported_encodings:
-            print(f"Unsupported encoding: {encoding}")
-            return None
-        if isinstance(secret_value, bytes):
-            secret_value = secret_value.decode(encoding)
+        secret_value = decode_value(response['Parameter']['Value'], encoding)
     
     return secret_value
+
+def get_passwords(keys, encoding='utf-8'):
+    """Return a dict of passwords for a list of (account_name, password_key) pairs, using as few requests as possible"""
+    parameter_names = {get_parameter_name(account_name, password_key): (account_name, password_key) for account_name, password_key in keys}
+    parameters = {}
+    try:
+        if password_path is not None and password_path != '':
+            # everything lives under one path, so it can be read a page at a time
+            paginator = get_client().get_paginator('get_parameters_by_path')
+            for page in paginator.paginate(Path=password_path, Recursive=False, WithDecryption=True):
+                for parameter in page['Parameters']:
+                    parameters[parameter['Name']] = parameter['Value']
+        else:
+            names = list(parameter_names)
+            for i in range(0, len(names), 10):
+                response = get_client().get_parameters(Names=names[i:i + 10], WithDecryption=True)
+                for parameter in response['Parameters']:
+                    parameters[parameter['Name']] = parameter['Value']
+    except ClientError as e:
+        print(f"Error retrieving secrets: {e}")
+        return {}
+
+    return {key: decode_value(parameters[name], encoding) for name, key in parameter_names.items() if name in parameters}
@@ -0,0 +1,117 @@
+"""Building blocks for running message processing as stages connected by bounded queues"""
+import io
+import queue
+import threading
+
+class ByteBudget:
+    """Caps the number of bytes held at the same time across threads.  A request larger than the whole budget is reduced to the budget, so it waits until nothing else is held instead of waiting forever"""
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        """Wait until 'size' bytes are available and reserve them.  Returns the number of bytes reserved, to be passed to release()"""
+        size = min(max(0, int(size)), self.limit)
+        with self._condition:
+            while self.in_use + size > self.limit:
+                self._condition.wait()
+            self.in_use += size
+        return size
+
+    def release(self, size):
+        """Give back bytes reserved by acquire()"""
+        with self._condition:
+            self.in_use -= size
+            self._condition.notify_all()
+
+class SharedFile:
+    """Lets several threads read one file at the same time, each through a reader of its own with its own position"""
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = threading.Lock()
+        file.seek(0, io.SEEK_END)
+        self.size = file.tell()
+
+    def reader(self):
+        """Return a new file-like reader positioned at the start of the file"""
+        return SharedFileReader(self)
+
+    def read_at(self, position, size):
+        """Return up to 'size' bytes from 'position'"""
+        with self._lock:
+            self.file.seek(position)
+            return self.file.read(size)
+
+class SharedFileReader(io.RawIOBase):
+    """Read-only, seekable view of a SharedFile.  Closing it leaves the shared file open"""
+
+    def __init__(self, shared_file):
+        super().__init__()
+        self.shared_file = shared_file
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.shared_file.read_at(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.shared_file.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+# put on the queue once per worker to tell it to stop
+_STOP = object()
+
+class Stage:
+    """Pool of worker threads calling handler(item) for every item put on a bounded queue.  put() blocks while the queue is full, which holds back whatever is feeding the stage.  on_error(item, exception) is called for items whose handler raised"""
+
+    def __init__(self, name, handler, workers, queue_size, on_error):
+        self.name = name
+        self.handler = handler
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.threads = [threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True) for i in range(max(1, int(workers)))]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        """Queue an item, waiting while the queue is full"""
+        self.queue.put(item)
+
+    def close(self):
+        """Wait for every queued item to be handled, then stop the workers"""
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            try:
+                self.handler(item)
+            except Exception as e:
+                # a worker ending here would leave its items unhandled, and close() waiting for it forever
+                try:
+                    self.on_error(item, e)
+                except Exception as error_e:
+                    print(f"Error handling a failed item in the {self.name} stage: {error_e}")
@@ -0,0 +1,47 @@
+"""Profile every thread of the processor with cProfile"""
+import sys
+import cProfile
+import pstats
+import threading
+
+class ThreadProfiler:
+    """Before Python 3.12, cProfile only sees the thread that enabled it, so a profiler is started in every new thread and their stats are merged when dumped"""
+
+    def __init__(self):
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def _start_profiler(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # from Python 3.12 a single profiler already covers every thread, and only one can be active
+            return
+        with self._lock:
+            self.profilers.append(profiler)
+
+    def _on_thread_start(self, frame, event, arg):
+        # called on the first event of every new thread, swapping this hook for a profiler of its own
+        sys.setprofile(None)
+        self._start_profiler()
+
+    def start(self):
+        """Start profiling the current thread and every thread started from now on"""
+        self._start_profiler()
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._on_thread_start)
+
+    def dump(self, path):
+        """Stop profiling and write the merged stats to 'path', which can be read with pstats or snakeviz"""
+        threading.setprofile(None)
+        with self._lock:
+            profilers, self.profilers = self.profilers, []
+        if not profilers:
+            return
+
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        print(f'Profile written to {path}')
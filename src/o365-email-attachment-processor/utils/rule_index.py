@@ -0,0 +1,147 @@
+"""Compile email rules once so each message is only checked against the conditions its sender can meet, checking every keyword at most once"""
+from collections import deque
+
+IGNORED_CONDITION = 'example_entry_will_be_ignored'
+
+class KeywordMatcher:
+    """Aho-Corasick automaton returning which of a set of keywords occur anywhere in a text, scanning the text once"""
+
+    def __init__(self, keywords):
+        keywords = set(keywords)
+        # an empty pattern is found in every text, the same as "'' in text"
+        self.always_found = {''} if '' in keywords else set()
+        self.transitions = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for keyword in keywords - {''}:
+            state = 0
+            for char in keyword:
+                if char not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.transitions[state][char] = len(self.transitions) - 1
+                state = self.transitions[state][char]
+            self.output[state] = (keyword,)
+
+        # breadth first, so the fail state of every shallower node is known before it is used
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.transitions[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.transitions[fail_state].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """Return the set of keywords found in the text"""
+        transitions = self.transitions
+        fail = self.fail
+        output = self.output
+        found = set(self.always_found)
+        state = 0
+        for char in text:
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+class TextSearch:
+    """Answers whether keywords occur in a text, searching for each keyword at most once however many conditions use it"""
+
+    def __init__(self, text):
+        self.text = text
+        self.found = {}
+
+    def any_of(self, keywords):
+        """Return whether any of 'keywords' occurs in the text"""
+        for keyword in keywords:
+            if not keyword:
+                return True
+            found = self.found.get(keyword)
+            if found is None:
+                found = self.found[keyword] = keyword in self.text
+            if found:
+                return True
+        return False
+
+def keyword_set(keywords):
+    """Return lowercase keywords as a set, reduced to just '' if they include it, as it is found in every text without searching"""
+    keywords = frozenset(keyword.lower() for keyword in keywords)
+    return frozenset(('',)) if '' in keywords else keywords
+
+class CompiledCondition:
+    """A condition with its patterns normalised to lowercase sets and its delivery targets as a list"""
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.name = condition['name']
+        pattern = condition['pattern']
+        self.sender = pattern['sender'].lower() if pattern.get('sender') is not None else None
+        self.subject = keyword_set(pattern['subject']) if 'subject' in pattern else None
+        self.body = keyword_set(pattern['body']) if 'body' in pattern else None
+        self.filename = frozenset(keyword.lower() for keyword in pattern['attachments'][0]['filename']) if 'attachments' in pattern else None
+        # "delivery" can be a single target or a list of targets
+        delivery = condition.get('delivery', [])
+        self.deliveries = delivery if isinstance(delivery, list) else [delivery]
+
+    def matches_attachment(self, found_keywords):
+        """Return whether every filename pattern was found in an attachment name"""
+        return self.filename <= found_keywords
+
+class RuleIndex:
+    """Conditions indexed by sender pattern, with keyword matchers for the short sender and attachment name fields"""
+
+    def __init__(self, email_rules):
+        self.conditions = []
+        for condition in email_rules['conditions']:
+            if condition['name'] == IGNORED_CONDITION:
+                continue
+            pattern = condition['pattern']
+            # ensure the proper definitions are present
+            if not ('attachments' in pattern or 'sender' in pattern or 'subject' in pattern or 'body' in pattern):
+                continue
+            self.conditions.append(CompiledCondition(condition))
+
+        # position of every condition per sender pattern, so only the conditions whose sender matches are evaluated further
+        self.sender_index = {}
+        self.no_sender = []
+        for position, compiled in enumerate(self.conditions):
+            if compiled.sender is None:
+                self.no_sender.append(position)
+            else:
+                self.sender_index.setdefault(compiled.sender, []).append(position)
+
+        self.sender_matcher = KeywordMatcher(self.sender_index)
+        self.filename_matcher = KeywordMatcher(keyword for compiled in self.conditions if compiled.filename for keyword in compiled.filename)
+
+    def candidates(self, email_from, email_subject, email_body):
+        """Yield, in rule order, the compiled conditions whose sender, subject and body patterns match a lowercase email.  Attachment patterns are left to the caller"""
+        positions = list(self.no_sender)
+        for sender in self.sender_matcher.find(email_from):
+            positions.extend(self.sender_index[sender])
+
+        # the subject and body are only searched for the keywords of the conditions whose sender matched, as a long body takes longer to walk through in Python than to search once per keyword
+        subject = TextSearch(email_subject)
+        body = TextSearch(email_body)
+        for position in sorted(positions):
+            compiled = self.conditions[position]
+            if compiled.subject is not None and not subject.any_of(compiled.subject):
+                continue
+            if compiled.body is not None and not body.any_of(compiled.body):
+                continue
+            yield compiled
+
+    def attachment_keywords(self, attachment_name):
+        """Return the filename patterns found in a lowercase attachment name"""
+        return self.filename_matcher.find(attachment_name)
+
+def compile_rules(email_rules):
+    """Return a RuleIndex for the conditions of a rules dict"""
+    return RuleIndex(email_rules)
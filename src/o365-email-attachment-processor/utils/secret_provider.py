@@ -0,0 +1,62 @@
+"""Shared interface in front of the password backends, adding an in-process TTL/LRU cache and bulk prefetching"""
+import time
+import threading
+from collections import OrderedDict
+
+class SecretProvider:
+    """Callable with the same signature as the backend get_password functions.  Results are cached for 'ttl_seconds', keeping at most 'max_entries' of the most recently used secrets"""
+
+    def __init__(self, backend, ttl_seconds=300, max_entries=1024):
+        self.backend = backend
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_entries = int(max_entries)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, account_name, password_key):
+        """Return the password for an account name and password key, only calling the backend when it is not cached"""
+        cache_key = (account_name, password_key)
+        with self._lock:
+            if cache_key in self._cache:
+                secret_value, expires = self._cache[cache_key]
+                if time.monotonic() < expires:
+                    self._cache.move_to_end(cache_key)
+                    return secret_value
+                del self._cache[cache_key]
+
+        # the backend is called outside the lock so a slow lookup does not block cached lookups from other threads
+        secret_value = self.backend.get_password(account_name, password_key)
+        self._store(cache_key, secret_value)
+
+        return secret_value
+
+    def prefetch(self, keys):
+        """Load a list of (account_name, password_key) pairs into the cache, using the backend's bulk lookup when it has one"""
+        with self._lock:
+            keys = [cache_key for cache_key in dict.fromkeys(keys) if cache_key not in self._cache]
+        if not keys:
+            return
+
+        if hasattr(self.backend, 'get_passwords'):
+            secret_values = self.backend.get_passwords(keys)
+        else:
+            secret_values = {cache_key: self.backend.get_password(*cache_key) for cache_key in keys}
+
+        for cache_key, secret_value in secret_values.items():
+            self._store(cache_key, secret_value)
+
+    def clear(self):
+        """Remove every cached secret, eg after credentials have been rotated"""
+        with self._lock:
+            self._cache.clear()
+
+    def _store(self, cache_key, secret_value):
+        """Cache a secret, evicting the least recently used entries once the cache is full"""
+        # failed lookups are not cached so they are retried on the next call
+        if secret_value is None:
+            return
+        with self._lock:
+            self._cache[cache_key] = (secret_value, time.monotonic() + self.ttl_seconds)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
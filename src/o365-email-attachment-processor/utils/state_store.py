@@ -0,0 +1,31 @@
+"""Persist per-account processing state, such as delta links and watermarks, between runs"""
+import os
+import json
+import threading
+
+# accounts are processed in parallel, so reads and writes of the shared state file are serialised
+_lock = threading.Lock()
+
+def _read_file(state_file):
+    """Return the full contents of the state file, or an empty dict if it does not exist yet"""
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, encoding='utf-8') as f:
+        return json.load(f)
+
+def load_state(state_file, account_name):
+    """Return the stored state for an account, or an empty dict if nothing has been stored yet"""
+    with _lock:
+        return _read_file(state_file).get(account_name, {})
+
+def save_state(state_file, account_name, account_state):
+    """Store the state for an account, leaving the state of other accounts untouched"""
+    with _lock:
+        state = _read_file(state_file)
+        state[account_name] = account_state
+
+        # write to a temporary file first so an interrupted run cannot leave a truncated state file behind
+        temp_file = f'{state_file}.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=4)
+        os.replace(temp_file, state_file)
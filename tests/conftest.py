@@ -0,0 +1,121 @@
+"""Shared fixtures: the processor running against the fake Graph server from the benchmarks, with its files in a temporary directory"""
+import os
+import sys
+import json
+import time
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT_DIR, 'src', 'o365-email-attachment-processor')
+BENCHMARKS_DIR = os.path.join(ROOT_DIR, 'benchmarks')
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+# pylint: disable=import-error
+from fake_graph import FakeGraphState, FakeGraphServer, LocalGraphSession
+# pylint: enable=import-error
+
+USER_ID = 'test-user'
+CONDITION_NAME = 'test_reports'
+
+def make_message(message_id, received=None, subject='daily report', sender='reports@vendor.example', is_read=False):
+    """Return a message in the shape the processor lists them in"""
+    if received is None:
+        received = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return {
+        'id': message_id,
+        'subject': subject,
+        'from': {'emailAddress': {'address': sender}},
+        'toRecipients': [{'emailAddress': {'address': f'{USER_ID}@test.example'}}],
+        'receivedDateTime': received,
+        'hasAttachments': True,
+        'isRead': is_read,
+        'body': {'contentType': 'text', 'content': 'please find the report attached'}
+    }
+
+def delivered_files(tmp_path):
+    """Return the names of the attachments delivered to the local target of the test rules"""
+    delivery_dir = tmp_path / 'delivered'
+    return sorted(os.listdir(delivery_dir)) if delivery_dir.exists() else []
+
+def wait_for(predicate, timeout=10):
+    """Wait until 'predicate' returns something true, returning it"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.02)
+    raise AssertionError('timed out waiting for the daemon')
+
+@pytest.fixture
+def graph_state():
+    return FakeGraphState()
+
+@pytest.fixture
+def graph_server(graph_state):
+    server = FakeGraphServer(graph_state)
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def processor(graph_server, tmp_path, monkeypatch):
+    """The main module, signing in to the fake server instead of Microsoft Graph and reading its rules from a temporary directory"""
+    import main
+    from utils.graph_request import GraphRequestClient
+
+    def authenticate(tenant_id, client_id, client_secret, settings, purpose='email'):
+        return GraphRequestClient(LocalGraphSession(graph_server.url), tenant_id, settings)
+
+    monkeypatch.setattr(main, 'authenticate', authenticate)
+    monkeypatch.chdir(tmp_path)
+    main.rule_indexes.clear()
+    rules = {'conditions': [{
+        'name': CONDITION_NAME,
+        'pattern': {'sender': '@vendor.example', 'subject': ['report'], 'body': [''], 'attachments': [{'filename': ['.csv']}]},
+        'delivery': {'target': 'local', 'path': str(tmp_path / 'delivered')}
+    }]}
+    (tmp_path / 'default_email_rules.json').write_text(json.dumps(rules), encoding='utf-8')
+    return main
+
+@pytest.fixture
+def s3(monkeypatch):
+    """A moto S3 with an empty 'delivery-bucket', and no S3 clients cached from other tests"""
+    moto = pytest.importorskip('moto')
+    from utils.delivery_clients import clear_delivery_clients
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    with moto.mock_aws():
+        import boto3
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='delivery-bucket')
+        clear_delivery_clients()
+        yield client
+    clear_delivery_clients()
+
+@pytest.fixture
+def settings(processor, tmp_path):
+    """Default settings with the state, rules cache and ledger files in the temporary directory.  Ledgers are cached by path, so every test gets its own"""
+    return processor.load_settings({'settings': {
+        'state_file': str(tmp_path / 'processor_state.json'),
+        'rules_cache_file': str(tmp_path / 'rules_cache.json'),
+        'ledger_file': str(tmp_path / 'delivery_ledger.db'),
+        'graph_backoff_base_seconds': 0.01,
+        'graph_backoff_max_seconds': 0.05
+    }})
+
+@pytest.fixture
+def account():
+    return {
+        'password_method': 'custom',
+        'email_account': {
+            'account_name': 'test_account',
+            'o365_username': f'{USER_ID}@test.example',
+            'o365_user_id': USER_ID,
+            'o365_tenant_id': 'test-tenant',
+            'o365_client_id': 'test-client',
+            'o365_password_key': 'test-password'
+        }
+    }
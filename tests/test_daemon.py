@@ -0,0 +1,82 @@
+"""The daemon picking up changes to the accounts file, and keeping the accounts it has when the file is broken"""
+import os
+import copy
+import json
+import threading
+
+import pytest
+
+# pylint: disable=import-error
+from .conftest import wait_for
+# pylint: enable=import-error
+
+@pytest.fixture
+def accounts_file(processor, account, tmp_path):
+    """Returns a function writing the accounts file the daemon reads, with a modification time of its own every time"""
+    path = tmp_path / 'o365_accounts.json'
+    writes = []
+
+    def write(*accounts):
+        path.write_text(json.dumps({
+            'settings': {
+                'state_file': str(tmp_path / 'processor_state.json'),
+                'rules_cache_file': str(tmp_path / 'rules_cache.json'),
+                'ledger_file': str(tmp_path / 'delivery_ledger.db'),
+                'poll_interval_seconds': 3600,
+                'poll_jitter_seconds': 0
+            },
+            'o365_accounts': list(accounts)
+        }), encoding='utf-8')
+        writes.append(path)
+        os.utime(path, (1000000 + len(writes), 1000000 + len(writes)))
+
+    return write
+
+@pytest.fixture
+def run_daemon(processor):
+    """Returns a function starting the daemon on a thread of its own, which is stopped at the end of the test"""
+    import daemon
+    stop_event = threading.Event()
+    threads = []
+
+    def start():
+        thread = threading.Thread(target=daemon.run_daemon, args=(stop_event,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        return thread
+
+    yield start
+    stop_event.set()
+    for thread in threads:
+        thread.join(10)
+
+def renamed(account, account_name, password_method=None):
+    account = copy.deepcopy(account)
+    account['email_account']['account_name'] = account_name
+    if password_method:
+        account['password_method'] = password_method
+    return account
+
+def test_broken_reload_keeps_the_current_accounts(accounts_file, run_daemon, account, graph_state, capsys):
+    accounts_file(account)
+    thread = run_daemon()
+    wait_for(lambda: graph_state.counts['list_messages'] == 1)
+
+    accounts_file(account, renamed(account, 'typo_account', 'keyrnig'))
+    wait_for(lambda: 'keeping the current accounts' in capsys.readouterr().out)
+    assert thread.is_alive()
+
+    # a later fix is still picked up, and the new account is polled straight away
+    accounts_file(account, renamed(account, 'second_account'))
+    wait_for(lambda: graph_state.counts['list_messages'] == 2)
+    assert thread.is_alive()
+
+def test_broken_accounts_file_at_startup_waits_for_a_fix(accounts_file, run_daemon, account, graph_state, capsys):
+    accounts_file(renamed(account, 'typo_account', 'keyrnig'))
+    thread = run_daemon()
+    wait_for(lambda: 'no accounts are polled until it is fixed' in capsys.readouterr().out)
+    assert thread.is_alive()
+    assert graph_state.counts['list_messages'] == 0
+
+    accounts_file(account)
+    wait_for(lambda: graph_state.counts['list_messages'] == 1)
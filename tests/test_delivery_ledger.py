@@ -0,0 +1,75 @@
+"""The delivery ledger: deliveries failing run after run are given up on after 'max_delivery_attempts', so their email does not stay pending forever, and finished emails are pruned after 'ledger_retention_days'"""
+import time
+
+import pytest
+
+# pylint: disable=import-error
+from .conftest import USER_ID, make_message, delivered_files
+# pylint: enable=import-error
+
+@pytest.fixture
+def blocked_target(tmp_path):
+    """Block the local target of the test rules with a file where its folder should be, so every delivery to it fails.  Returns a function unblocking it"""
+    blocker = tmp_path / 'delivered'
+    blocker.write_text('', encoding='utf-8')
+    return blocker.unlink
+
+def delivery_rows(processor, settings):
+    return processor.get_ledger(settings['ledger_file']).connection.execute('SELECT status, attempts FROM deliveries').fetchall()
+
+def test_failing_delivery_is_given_up_after_max_attempts(processor, settings, account, graph_state, blocked_target, capsys):
+    settings['max_delivery_attempts'] = 3
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 10)])
+    ledger = processor.get_ledger(settings['ledger_file'])
+
+    for _ in range(3):
+        processor.process_account(account, settings)
+        assert graph_state.read_count() == 0
+        assert ledger.message_status(USER_ID, 'msg0') == 'pending'
+    assert delivery_rows(processor, settings) == [('pending', 3)]
+
+    processor.process_account(account, settings)
+
+    # reported, not attempted a fourth time, and the email is completed
+    assert 'Giving up on delivering report.csv' in capsys.readouterr().out
+    assert delivery_rows(processor, settings) == [('failed', 3)]
+    assert graph_state.read_count() == 1
+    assert ledger.message_status(USER_ID, 'msg0') == 'done'
+
+def test_delivery_succeeding_within_max_attempts_is_made(processor, settings, account, graph_state, blocked_target, tmp_path):
+    settings['max_delivery_attempts'] = 3
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 10)])
+
+    for _ in range(2):
+        processor.process_account(account, settings)
+    blocked_target()
+    processor.process_account(account, settings)
+
+    assert delivered_files(tmp_path) == ['report.csv']
+    assert delivery_rows(processor, settings) == [('delivered', 3)]
+    assert graph_state.read_count() == 1
+
+def test_no_limit_keeps_retrying(processor, settings, account, graph_state, blocked_target):
+    settings['max_delivery_attempts'] = 0
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 10)])
+
+    for _ in range(6):
+        processor.process_account(account, settings)
+
+    assert delivery_rows(processor, settings) == [('pending', 6)]
+    assert graph_state.read_count() == 0
+
+def test_finished_messages_are_pruned_while_the_ledger_stays_open(processor, settings, account, graph_state):
+    settings['ledger_retention_days'] = 1
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 10)])
+    processor.process_account(account, settings)
+    ledger = processor.get_ledger(settings['ledger_file'])
+    assert ledger.message_status(USER_ID, 'msg0') == 'done'
+
+    # finished two days ago, as seen by the ledger the daemon keeps open
+    ledger.connection.execute('UPDATE messages SET updated_at = ?', (time.time() - 2 * 86400,))
+    processor.process_account(account, settings)
+
+    assert processor.get_ledger(settings['ledger_file']) is ledger
+    assert ledger.message_status(USER_ID, 'msg0') is None
+    assert delivery_rows(processor, settings) == []
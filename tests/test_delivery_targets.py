@@ -0,0 +1,166 @@
+"""Attachments delivered to several targets are downloaded once, every target succeeds or fails on its own, and SFTP connections are pooled"""
+import sys
+import json
+import types
+
+import pytest
+
+# pylint: disable=import-error
+from fake_graph import CONTENT_BLOCK
+from utils.delivery_clients import sftp_connection, clear_delivery_clients
+from .conftest import USER_ID, CONDITION_NAME, make_message
+# pylint: enable=import-error
+
+@pytest.fixture
+def targets(processor, tmp_path, s3):
+    """Deliver the test rules to two local folders and the moto bucket"""
+    deliveries = [
+        {'target': 'local', 'path': str(tmp_path / 'first')},
+        {'target': 's3', 'region': 'us-east-1', 'bucket': 'delivery-bucket'},
+        {'target': 'local', 'path': str(tmp_path / 'second')}
+    ]
+    rules = {'conditions': [{
+        'name': CONDITION_NAME,
+        'pattern': {'sender': '@vendor.example', 'attachments': [{'filename': ['.csv']}]},
+        'delivery': deliveries
+    }]}
+    (tmp_path / 'default_email_rules.json').write_text(json.dumps(rules), encoding='utf-8')
+    return deliveries
+
+def delivery_statuses(processor, settings):
+    rows = processor.get_ledger(settings['ledger_file']).connection.execute('SELECT target, status FROM deliveries').fetchall()
+    return dict(rows)
+
+def test_one_download_is_delivered_to_every_target(processor, settings, account, graph_state, targets, tmp_path, s3):
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 100000)])
+
+    processor.process_account(account, settings)
+
+    content = (CONTENT_BLOCK * 2)[:100000]
+    assert graph_state.counts['download_attachment'] == 1
+    assert (tmp_path / 'first' / 'report.csv').read_bytes() == content
+    assert (tmp_path / 'second' / 'report.csv').read_bytes() == content
+    assert s3.get_object(Bucket='delivery-bucket', Key='report.csv')['Body'].read() == content
+    assert set(delivery_statuses(processor, settings).values()) == {'delivered'}
+    assert graph_state.read_count() == 1
+
+def test_failed_target_is_retried_on_its_own(processor, settings, account, graph_state, targets, tmp_path, s3):
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 100)])
+    # a file where the first folder should be makes every delivery to it fail
+    (tmp_path / 'first').write_text('', encoding='utf-8')
+
+    processor.process_account(account, settings)
+
+    assert delivery_statuses(processor, settings) == {
+        f"local:{tmp_path / 'first'}": 'pending',
+        's3:delivery-bucket/': 'delivered',
+        f"local:{tmp_path / 'second'}": 'delivered'
+    }
+    assert graph_state.read_count() == 0
+
+    # only the failed target is delivered to on the next run
+    (tmp_path / 'first').unlink()
+    s3.delete_object(Bucket='delivery-bucket', Key='report.csv')
+    (tmp_path / 'second' / 'report.csv').unlink()
+    processor.process_account(account, settings)
+
+    assert (tmp_path / 'first' / 'report.csv').exists()
+    assert 'Contents' not in s3.list_objects_v2(Bucket='delivery-bucket')
+    assert not (tmp_path / 'second' / 'report.csv').exists()
+    assert set(delivery_statuses(processor, settings).values()) == {'delivered'}
+    assert graph_state.read_count() == 1
+
+class FakeSFTPServer:
+    """Stand-in for paramiko, recording the ssh clients opened and the files written through them"""
+
+    def __init__(self):
+        self.clients = []
+        self.files = {}
+        server = self
+
+        class SSHClient:
+            def __init__(self):
+                self.active = True
+                self.closed = False
+                server.clients.append(self)
+
+            def load_system_host_keys(self):
+                pass
+
+            def set_missing_host_key_policy(self, policy):
+                pass
+
+            def connect(self, hostname, **kwargs):
+                self.hostname = hostname
+
+            def get_transport(self):
+                return None if self.closed else types.SimpleNamespace(is_active=lambda: self.active)
+
+            def open_sftp(self):
+                return types.SimpleNamespace(putfo=lambda fileobj, path: server.files.__setitem__(path, fileobj.read()))
+
+            def close(self):
+                self.closed = True
+
+        self.module = types.ModuleType('paramiko')
+        self.module.SSHClient = SSHClient
+        self.module.AutoAddPolicy = object
+
+@pytest.fixture
+def sftp_server(monkeypatch):
+    server = FakeSFTPServer()
+    monkeypatch.setitem(sys.modules, 'paramiko', server.module)
+    clear_delivery_clients()
+    yield server
+    clear_delivery_clients()
+
+SFTP_DELIVERY = {'target': 'sftp', 'hostname': 'sftp.test.example', 'username': 'uploader', 'password_key': 'sftp-password', 'subfolder': 'incoming/'}
+
+def connection(pw, pool_size=4):
+    return sftp_connection(pw, CONDITION_NAME, SFTP_DELIVERY, pool_size, 5)
+
+def test_sftp_connections_are_reused(processor, settings, sftp_server):
+    pw = processor.get_password_method('custom', settings)
+
+    for name in ('first.csv', 'second.csv'):
+        processor.transmit_files(pw, CONDITION_NAME, 'sftp', SFTP_DELIVERY, '2023-01-01T00:00:00Z', name, b'id,value\n', settings)
+
+    assert sftp_server.files == {'incoming/first.csv': b'id,value\n', 'incoming/second.csv': b'id,value\n'}
+    assert len(sftp_server.clients) == 1
+    assert not sftp_server.clients[0].closed
+
+def test_idle_sftp_connections_are_capped_at_the_pool_size(processor, settings, sftp_server):
+    pw = processor.get_password_method('custom', settings)
+
+    with connection(pw, pool_size=1), connection(pw, pool_size=1):
+        pass
+
+    # both connections were in use at the same time, only the one returned first is kept for later deliveries
+    assert [client.closed for client in sftp_server.clients] == [True, False]
+    with connection(pw, pool_size=1):
+        pass
+    assert len(sftp_server.clients) == 2
+
+def test_dropped_sftp_connection_is_replaced(processor, settings, sftp_server):
+    pw = processor.get_password_method('custom', settings)
+    with connection(pw):
+        pass
+    sftp_server.clients[0].active = False
+
+    with connection(pw):
+        pass
+
+    assert len(sftp_server.clients) == 2
+    assert sftp_server.clients[0].closed
+    assert not sftp_server.clients[1].closed
+
+def test_connection_of_a_failed_sftp_delivery_is_not_reused(processor, settings, sftp_server):
+    pw = processor.get_password_method('custom', settings)
+    with pytest.raises(OSError):
+        with connection(pw):
+            raise OSError('write failed')
+
+    assert sftp_server.clients[0].closed
+    with connection(pw):
+        pass
+    assert len(sftp_server.clients) == 2
@@ -0,0 +1,50 @@
+"""Delta scan mode against the fake Graph server"""
+import time
+
+# pylint: disable=import-error
+from .conftest import USER_ID, make_message, delivered_files
+# pylint: enable=import-error
+
+def hours_ago(hours):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - hours * 3600))
+
+def test_first_sync_skips_read_mail(processor, settings, account, graph_state, tmp_path):
+    settings['scan_mode'] = 'delta'
+    graph_state.add_message(USER_ID, make_message('read', hours_ago(2), is_read=True), [('read.csv', 10)])
+    graph_state.add_message(USER_ID, make_message('unread', hours_ago(1)), [('unread.csv', 10)])
+
+    processor.process_account(account, settings)
+
+    assert delivered_files(tmp_path) == ['unread.csv']
+    # a later change to the skipped mail is not mistaken for new mail
+    with graph_state._lock:
+        graph_state.changed(USER_ID, 'read')
+    processor.process_account(account, settings)
+    assert delivered_files(tmp_path) == ['unread.csv']
+
+def test_mail_released_with_old_received_time_is_processed(processor, settings, account, graph_state, tmp_path):
+    settings['scan_mode'] = 'delta'
+    graph_state.add_message(USER_ID, make_message('newer', hours_ago(1)), [('newer.csv', 10)])
+    processor.process_account(account, settings)
+    assert delivered_files(tmp_path) == ['newer.csv']
+
+    # released from quarantine after newer mail has been processed, keeping its original receivedDateTime
+    graph_state.add_message(USER_ID, make_message('released', hours_ago(5)), [('released.csv', 10)])
+    processor.process_account(account, settings)
+    assert delivered_files(tmp_path) == ['newer.csv', 'released.csv']
+    assert graph_state.read_count() == 2
+
+def test_processed_mail_marked_unread_is_not_processed_again(processor, settings, account, graph_state, tmp_path):
+    settings['scan_mode'] = 'delta'
+    graph_state.add_message(USER_ID, make_message('first', hours_ago(1)), [('first.csv', 10)])
+    processor.process_account(account, settings)
+    assert graph_state.counts['batch_patch'] == 1
+
+    graph_state.mark_all_unread()
+    with graph_state._lock:
+        graph_state.changed(USER_ID, 'first')
+    processor.process_account(account, settings)
+
+    assert graph_state.counts['batch_patch'] == 1
+    assert graph_state.counts['list_attachments'] == 1
+    assert delivered_files(tmp_path) == ['first.csv']
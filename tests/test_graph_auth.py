@@ -0,0 +1,87 @@
+"""Access tokens are shared and renewed shortly before they expire, and clients are shared per app registration and purpose"""
+import time
+import types
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# pylint: disable=import-error
+from utils.graph_auth import CachedTokenCredential, TOKEN_REFRESH_MARGIN_SECONDS, get_graph_client, clear_graph_clients
+# pylint: enable=import-error
+
+class FakeCredential:
+    """Credential handing out numbered tokens valid for 'lifetime' seconds, taking 'delay' seconds per token"""
+
+    def __init__(self, lifetime=3600, delay=0):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            self.requests.append(scopes)
+            return types.SimpleNamespace(token=f'token-{len(self.requests)}', expires_on=int(time.time() + self.lifetime))
+
+def test_token_is_reused_until_shortly_before_it_expires():
+    credential = FakeCredential()
+    cached = CachedTokenCredential(credential)
+
+    tokens = {cached.get_token('https://graph.microsoft.com/.default').token for _ in range(5)}
+
+    assert tokens == {'token-1'}
+    assert len(credential.requests) == 1
+
+def test_token_is_renewed_within_the_refresh_margin():
+    # a token with less time left than the margin is renewed before a request goes out with it
+    credential = FakeCredential(lifetime=TOKEN_REFRESH_MARGIN_SECONDS - 10)
+    cached = CachedTokenCredential(credential)
+
+    assert cached.get_token('https://graph.microsoft.com/.default').token == 'token-1'
+    assert cached.get_token('https://graph.microsoft.com/.default').token == 'token-2'
+
+def test_tokens_are_cached_per_scope():
+    credential = FakeCredential()
+    cached = CachedTokenCredential(credential)
+
+    cached.get_token('https://graph.microsoft.com/.default')
+    cached.get_token('https://example.sharepoint.com/.default')
+    cached.get_token('https://graph.microsoft.com/.default')
+
+    assert credential.requests == [('https://graph.microsoft.com/.default',), ('https://example.sharepoint.com/.default',)]
+
+def test_only_one_thread_renews_a_token():
+    credential = FakeCredential(delay=0.05)
+    cached = CachedTokenCredential(credential)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tokens = set(executor.map(lambda _: cached.get_token('https://graph.microsoft.com/.default').token, range(8)))
+
+    assert tokens == {'token-1'}
+    assert len(credential.requests) == 1
+
+@pytest.fixture
+def graph_clients():
+    clear_graph_clients()
+    yield
+    clear_graph_clients()
+
+def test_clients_share_the_credential_and_are_rebuilt_when_the_secret_changes(graph_clients):
+    built = []
+
+    def build_client(credential):
+        built.append(credential)
+        return object()
+
+    email_client = get_graph_client('tenant', 'client', 'secret', 'email', build_client)
+    assert get_graph_client('tenant', 'client', 'secret', 'email', build_client) is email_client
+    get_graph_client('tenant', 'client', 'secret', 'sharepoint', build_client)
+    # every purpose has a client of its own, all of them sharing one credential and its tokens
+    assert len(built) == 2
+    assert built[0] is built[1]
+
+    rotated_client = get_graph_client('tenant', 'client', 'rotated', 'email', build_client)
+    assert rotated_client is not email_client
+    assert built[2] is not built[0]
@@ -0,0 +1,143 @@
+"""Write requests are coalesced into $batch calls of up to 20, with per-request statuses, retries and completion callbacks"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# pylint: disable=import-error
+from utils.graph_batch import GraphBatch
+from utils import metrics
+from .conftest import USER_ID, make_message
+# pylint: enable=import-error
+
+@pytest.fixture
+def email_client(processor, settings, graph_state):
+    for number in range(45):
+        graph_state.add_message(USER_ID, make_message(f'msg{number}'))
+    return processor.authenticate('test-tenant', 'test-client', '', settings)
+
+def mark_read(batch, message_id, on_complete=None):
+    return batch.patch(f'/users/{USER_ID}/messages/{message_id}', json={'isRead': True}, on_complete=on_complete)
+
+def test_requests_are_sent_in_batches_of_20(email_client, graph_state):
+    with GraphBatch(email_client) as batch:
+        request_ids = [mark_read(batch, f'msg{number}') for number in range(45)]
+
+    assert graph_state.batch_sizes == [20, 20, 5]
+    assert graph_state.read_count() == 45
+    assert [batch.results[request_id] for request_id in request_ids] == [200] * 45
+
+def test_requests_queued_during_a_send_wait_for_a_full_batch(email_client, graph_state):
+    graph_state.latency = 0.02
+
+    def work(number):
+        time.sleep(0.001)
+        mark_read(batch, f'msg{number % 45}')
+
+    # threads keep queueing while a batch is being sent, which is only sent once it is full too
+    with GraphBatch(email_client) as batch:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(work, range(200)))
+
+    assert graph_state.batch_sizes == [20] * 10
+
+def test_filling_a_batch_does_not_wait_for_it_to_be_sent(email_client, graph_state):
+    graph_state.latency = 0.3
+    labels = []
+
+    with metrics.labelled(account='test_account'):
+        with GraphBatch(email_client) as batch:
+            for number in range(19):
+                mark_read(batch, f'msg{number}')
+            start = time.monotonic()
+            mark_read(batch, 'msg19', lambda status: labels.append(metrics.current_labels()))
+            # the batch is sent by the sender thread, so the worker that filled it carries on
+            assert time.monotonic() - start < 0.1
+
+    assert graph_state.read_count() == 20
+    # the callback ran on the sender thread with the labels of the thread that queued the request
+    assert labels == [{'account': 'test_account'}]
+
+def test_batch_size_is_capped_at_20(email_client, graph_state):
+    with GraphBatch(email_client, batch_size=50) as batch:
+        for number in range(45):
+            mark_read(batch, f'msg{number}')
+
+    assert max(graph_state.batch_sizes) == 20
+
+def test_every_request_gets_its_own_status(email_client, graph_state):
+    statuses = {}
+    with GraphBatch(email_client) as batch:
+        for message_id in ('msg0', 'missing', 'msg1'):
+            mark_read(batch, message_id, lambda status, message_id=message_id: statuses.__setitem__(message_id, status))
+        forwarded = batch.post(f'/users/{USER_ID}/messages/msg2/forward', json={'toRecipients': [], 'comment': '', 'send': True})
+
+    assert statuses == {'msg0': 200, 'missing': 404, 'msg1': 200}
+    assert batch.results[forwarded] == 202
+    assert graph_state.forwards == 1
+    # a request that failed for good is not retried
+    assert graph_state.batch_sizes == [4]
+
+def test_throttled_requests_are_retried_after_retry_after(email_client, graph_state):
+    graph_state.throttle_retry_after = 0.03
+    graph_state.batch_failures[f'/users/{USER_ID}/messages/msg1'] = [429, 429]
+    statuses = []
+
+    start = time.monotonic()
+    with GraphBatch(email_client) as batch:
+        mark_read(batch, 'msg0')
+        mark_read(batch, 'msg1', statuses.append)
+    elapsed = time.monotonic() - start
+
+    # only the throttled request is sent again, each time after waiting as long as Retry-After asked
+    assert graph_state.batch_sizes == [2, 1, 1]
+    assert statuses == [200]
+    assert 0.06 <= elapsed < 1
+    assert graph_state.read_count() == 2
+
+def test_retry_after_is_capped_at_the_maximum_backoff(email_client, graph_state):
+    graph_state.throttle_retry_after = 3600
+    graph_state.batch_failures[f'/users/{USER_ID}/messages/msg0'] = [429]
+
+    start = time.monotonic()
+    with GraphBatch(email_client) as batch:
+        mark_read(batch, 'msg0')
+
+    assert time.monotonic() - start < 1
+    assert graph_state.read_count() == 1
+
+def test_requests_still_failing_after_max_retries_are_reported(email_client, graph_state):
+    graph_state.batch_failures[f'/users/{USER_ID}/messages/msg0'] = [503] * 10
+    statuses = []
+
+    with GraphBatch(email_client, max_retries=2) as batch:
+        mark_read(batch, 'msg0', statuses.append)
+
+    assert graph_state.batch_sizes == [1, 1, 1]
+    assert statuses == [503]
+
+def test_rejected_batch_is_only_retried_by_the_client(email_client, graph_state, settings):
+    graph_state.failing_routes['batch'] = 429
+    statuses = []
+
+    with GraphBatch(email_client) as batch:
+        for number in range(3):
+            mark_read(batch, f'msg{number}', statuses.append)
+
+    # the client retries the throttled batch graph_max_retries times, the batch does not add retries of its own on top
+    assert graph_state.counts['batch'] == settings['graph_max_retries'] + 1
+    assert statuses == [429, 429, 429]
+
+def test_callbacks_can_queue_follow_up_requests(email_client, graph_state):
+    order = []
+
+    def on_forwarded(status):
+        order.append(('forwarded', status))
+        mark_read(batch, 'msg0', lambda status: order.append(('read', status)))
+
+    with GraphBatch(email_client) as batch:
+        batch.post(f'/users/{USER_ID}/messages/msg0/forward', json={'toRecipients': [], 'comment': '', 'send': True}, on_complete=on_forwarded)
+
+    # the follow-up request is sent as part of the same flush
+    assert order == [('forwarded', 202), ('read', 200)]
+    assert graph_state.batch_sizes == [1, 1]
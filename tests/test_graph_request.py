@@ -0,0 +1,133 @@
+"""The request layer against the throttling simulator of the fake Graph server: Retry-After, retries that cannot duplicate writes, and adaptive concurrency"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# pylint: disable=import-error
+from fake_graph import LocalGraphSession
+from utils.graph_request import GraphRequestClient, get_limiter, get_request_counters
+from .conftest import USER_ID, make_message
+# pylint: enable=import-error
+
+MESSAGE_URL = f'/users/{USER_ID}/messages/msg0'
+FORWARD_URL = f'/users/{USER_ID}/messages/msg0/forward'
+
+@pytest.fixture
+def client(graph_server, graph_state, settings, request):
+    """A client for a tenant of its own, as limiters and counters are shared per tenant"""
+    graph_state.add_message(USER_ID, make_message('msg0'))
+    settings['graph_max_retries'] = 3
+    return GraphRequestClient(LocalGraphSession(graph_server.url), request.node.name, settings)
+
+def counters(client):
+    return get_request_counters()[client.tenant_id]
+
+def test_retry_after_is_honoured(client, graph_state):
+    graph_state.throttle_retry_after = 0.03
+    graph_state.failing_routes['get_message'] = [429, 429]
+
+    start = time.monotonic()
+    assert client.get(MESSAGE_URL).status_code == 200
+    assert time.monotonic() - start >= 0.06
+    assert counters(client) == {'requests': 3, 'throttled': 2, 'retried': 2, 'failed': 0}
+
+def test_throttled_requests_are_counted(client, graph_state):
+    graph_state.throttle_every = 2
+
+    for _ in range(3):
+        assert client.get(MESSAGE_URL).status_code == 200
+
+    # every second request the server sees is throttled and retried
+    assert counters(client)['throttled'] == 2
+    assert counters(client)['retried'] == 2
+    assert graph_state.throttled == 2
+
+def test_backoff_is_jittered_and_capped(client):
+    delays = [client.retry_delay(None, 10) for _ in range(50)]
+
+    assert all(0 <= delay <= client.backoff_max for delay in delays)
+    assert len(set(delays)) > 1
+    assert client.retry_delay({'Retry-After': '3600'}, 0) == client.backoff_max
+
+def test_reads_are_retried_after_server_errors(client, graph_state):
+    graph_state.failing_routes['get_message'] = [500, 502, 504]
+
+    assert client.get(MESSAGE_URL).status_code == 200
+    assert graph_state.counts['get_message'] == 4
+
+def test_reads_give_up_after_max_retries(client, graph_state):
+    graph_state.failing_routes['get_message'] = 503
+
+    assert client.get(MESSAGE_URL).status_code == 503
+    assert graph_state.counts['get_message'] == 4
+    assert counters(client)['failed'] == 1
+
+@pytest.mark.parametrize('status', [500, 502, 504])
+def test_posts_are_not_retried_after_server_errors(client, graph_state, status):
+    graph_state.failing_routes['batch'] = [status]
+
+    # the forward may already have been sent, so sending it again could deliver it twice
+    assert client.post('/$batch', json={'requests': [{'id': '1', 'method': 'POST', 'url': FORWARD_URL, 'body': {}}]}).status_code == status
+    assert graph_state.counts['batch'] == 1
+    assert graph_state.forwards == 0
+    assert counters(client)['failed'] == 1
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_posts_are_retried_when_throttled(client, graph_state, status):
+    graph_state.failing_routes['batch'] = [status]
+
+    assert client.post('/$batch', json={'requests': [{'id': '1', 'method': 'POST', 'url': FORWARD_URL, 'body': {}}]}).status_code == 200
+    assert graph_state.counts['batch'] == 2
+    assert graph_state.forwards == 1
+
+def test_lost_connection_is_only_retried_for_reads(client, graph_state):
+    graph_state.failing_routes['get_message'] = [0]
+    assert client.get(MESSAGE_URL).status_code == 200
+    assert graph_state.counts['get_message'] == 2
+
+    graph_state.failing_routes['batch'] = [0]
+    with pytest.raises(OSError):
+        client.post('/$batch', json={'requests': [{'id': '1', 'method': 'POST', 'url': FORWARD_URL, 'body': {}}]})
+    assert graph_state.counts['batch'] == 1
+
+def test_refused_connection_is_retried_for_posts(settings):
+    settings['graph_max_retries'] = 2
+    # nothing listens on port 1, so the request never reaches a server
+    client = GraphRequestClient(LocalGraphSession('http://127.0.0.1:1'), 'refused-tenant', settings)
+
+    with pytest.raises(OSError):
+        client.post('/$batch', json={'requests': []})
+    assert counters(client) == {'requests': 3, 'throttled': 0, 'retried': 2, 'failed': 1}
+
+def test_batched_forwards_are_not_retried_after_server_errors(client, graph_state):
+    # pylint: disable=import-error
+    from utils.graph_batch import GraphBatch
+    # pylint: enable=import-error
+    graph_state.batch_failures[FORWARD_URL] = [500]
+    graph_state.batch_failures[MESSAGE_URL] = [500]
+
+    with GraphBatch(client) as batch:
+        forward = batch.post(FORWARD_URL, json={})
+        mark_read = batch.patch(MESSAGE_URL, json={'isRead': True})
+
+    assert batch.results == {forward: 500, mark_read: 200}
+    assert graph_state.forwards == 0
+
+def test_concurrency_adapts_to_throttling(graph_server, graph_state, settings):
+    # the server handles at most 2 requests at a time, each taking 20 ms, and asks for a 50 ms wait when throttling
+    graph_state.add_message(USER_ID, make_message('msg0'))
+    graph_state.throttle_concurrency = 2
+    graph_state.throttle_retry_after = 0.05
+    graph_state.latency = 0.02
+    settings['graph_max_concurrency_per_tenant'] = 16
+    settings['graph_max_retries'] = 50
+    client = GraphRequestClient(LocalGraphSession(graph_server.url, 16), 'aimd-tenant', settings)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        statuses = list(executor.map(lambda _: client.get(MESSAGE_URL).status_code, range(60)))
+
+    assert statuses == [200] * 60
+    assert counters(client)['throttled'] > 0
+    # throttling halved the limit, which then only grows back slowly
+    assert get_limiter('aimd-tenant', 16).limit < 16
@@ -0,0 +1,27 @@
+"""Message listing: one paged listing per cycle carries everything the rules need"""
+# pylint: disable=import-error
+from request_count import MockGraphClient
+from utils.graph_request import GraphRequestClient
+# pylint: enable=import-error
+
+def test_cycle_lists_each_message_once(processor, settings, account):
+    client = MockGraphClient('test-user', 120, 30)
+    processor.authenticate = lambda tenant_id, client_id, client_secret, settings, purpose='email': GraphRequestClient(client, tenant_id, settings)
+
+    processor.process_account(account, settings)
+
+    # 120 messages at 50 per page, with no per-message refetch of the listing or the message
+    assert client.requests['list_messages'] == 3
+    assert client.messages_listed == 120
+    assert client.requests['other'] == 0
+    assert client.requests['list_attachments'] == 30
+    assert client.requests['batch_patch'] == 120
+
+def test_message_headers_are_not_modified(processor, settings):
+    client = MockGraphClient('test-user', 60, 0)
+    email_client = GraphRequestClient(client, 'test-tenant', settings)
+    headers = dict(processor.MESSAGE_HEADERS)
+
+    processor.list_unread_messages(email_client, 'test-user')
+
+    assert processor.MESSAGE_HEADERS == headers
@@ -0,0 +1,35 @@
+"""Timings recorded for batched writes cover the round trip to Graph, not just queueing the request"""
+import pytest
+
+# pylint: disable=import-error
+from utils import metrics
+from utils.graph_batch import GraphBatch
+from .conftest import USER_ID, make_message
+# pylint: enable=import-error
+
+@pytest.fixture
+def registry():
+    metrics.registry.reset()
+    yield metrics.registry
+    metrics.registry.reset()
+
+def test_forward_is_timed_until_it_has_been_sent(processor, settings, graph_state, registry):
+    graph_state.latency = 0.2
+    message = make_message('msg0')
+    graph_state.add_message(USER_ID, message)
+    email_client = processor.authenticate('test-tenant', 'test-client', '', settings)
+    ledger = processor.get_ledger(settings['ledger_file'])
+    forwards = [('forward_reports', {'target': 'email_forward', 'recipients': ['team@test.example']})]
+
+    with metrics.labelled(account='test_account'):
+        with GraphBatch(email_client) as write_batch:
+            processor.complete_message(write_batch, USER_ID, message, forwards, ledger)
+
+    assert graph_state.forwards == 1
+    forward = registry.histograms[('stage_duration_seconds', (('account', 'test_account'), ('condition', 'forward_reports'), ('stage', 'forward_email')))]
+    assert forward.count == 1
+    assert forward.max >= 0.2
+    batches = registry.histograms[('stage_duration_seconds', (('account', 'test_account'), ('stage', 'send_batch')))]
+    # one batch with the forward, then one marking the email as read once it has been sent
+    assert batches.count == 2
+    assert batches.max >= 0.2
@@ -0,0 +1,76 @@
+"""Pipeline building blocks: errors raised while handling an email, or while handling an error, do not stop the stages, so a run always finishes, and one downloaded copy can be read by several targets at once"""
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# pylint: disable=import-error
+from utils.pipeline import Stage, SharedFile
+from .conftest import USER_ID, make_message, delivered_files
+# pylint: enable=import-error
+
+def finishes(target, timeout=10):
+    """Run 'target' on a thread of its own, returning whether it finished in time instead of hanging the tests"""
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+def test_failing_error_handler_does_not_stop_the_stage():
+    handled = []
+
+    def handler(item):
+        if item == 'bad':
+            raise ValueError(item)
+        handled.append(item)
+
+    def on_error(item, e):
+        raise RuntimeError('error handler failed')
+
+    stage = Stage('test', handler, 1, 10, on_error)
+    for item in ('bad', 'good', 'bad', 'also good'):
+        stage.put(item)
+
+    assert finishes(stage.close)
+    assert handled == ['good', 'also good']
+
+def test_failure_to_complete_a_delivered_email_does_not_hang_the_run(processor, settings, account, graph_state, tmp_path, monkeypatch, capsys):
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 10)])
+    complete_message = processor.complete_message
+
+    def failing_complete_message(*args):
+        raise RuntimeError('completion failed')
+
+    monkeypatch.setattr(processor, 'complete_message', failing_complete_message)
+    assert finishes(lambda: processor.process_account(account, settings))
+
+    # the attachment was delivered, only completing the email failed, so it is left unread and pending
+    output = capsys.readouterr().out
+    assert 'Error completing email daily report' in output
+    assert 'Error delivering attachment' not in output
+    assert delivered_files(tmp_path) == ['report.csv']
+    assert graph_state.read_count() == 0
+
+    # the next run completes it without delivering the attachment again
+    monkeypatch.setattr(processor, 'complete_message', complete_message)
+    (tmp_path / 'delivered' / 'report.csv').unlink()
+    assert finishes(lambda: processor.process_account(account, settings))
+    assert graph_state.read_count() == 1
+    assert delivered_files(tmp_path) == []
+
+def test_shared_file_readers_read_independently():
+    content = bytes(range(256)) * 1000
+    shared_file = SharedFile(io.BytesIO(content))
+
+    def read_all(chunk_size):
+        reader = shared_file.reader()
+        chunks = iter(lambda: reader.read(chunk_size), b'')
+        return b''.join(chunks)
+
+    # readers interleave their reads of the same file, each from its own position
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(read_all, [1000, 4096, 7, 65536])) == [content] * 4
+
+    reader = shared_file.reader()
+    reader.seek(-10, io.SEEK_END)
+    assert reader.read() == content[-10:]
+    assert reader.tell() == len(content)
@@ -0,0 +1,78 @@
+"""The compiled rule index picks the same condition and attachments as the linear scan of every condition it replaced"""
+import random
+
+import pytest
+
+# pylint: disable=import-error
+from rule_matching import linear_match, compiled_match
+from utils.rule_index import compile_rules, KeywordMatcher
+# pylint: enable=import-error
+
+# a small vocabulary, so keywords often overlap, contain one another and occur in several fields
+FRAGMENTS = ['re', 'rep', 'report', 'port', 'inv', 'invoice', 'voice', 'Daily', 'ly', 'y r', '#1', '.csv', '.CSV', 'v', '', 'a.co']
+SENDERS = ['@a.com', 'b@a.com', 'a.co', '@b.org', 'B@A.COM', '']
+
+def random_pattern(rng):
+    pattern = {}
+    if rng.random() < 0.7:
+        pattern['sender'] = rng.choice(SENDERS)
+    if rng.random() < 0.6:
+        pattern['subject'] = rng.sample(FRAGMENTS, rng.randint(0, 3))
+    if rng.random() < 0.4:
+        pattern['body'] = rng.sample(FRAGMENTS, rng.randint(1, 3))
+    if rng.random() < 0.6:
+        pattern['attachments'] = [{'filename': rng.sample(FRAGMENTS, rng.randint(0, 2))}]
+    return pattern
+
+def random_text(rng, words):
+    return ' '.join(rng.choice(FRAGMENTS + ['lorem', 'ipsum']) for _ in range(rng.randint(0, words)))
+
+@pytest.mark.parametrize('seed', range(20))
+def test_compiled_index_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    for _ in range(25):
+        conditions = [{'name': f'condition_{number}', 'pattern': random_pattern(rng), 'delivery': {'target': 'local', 'path': '/tmp'}} for number in range(rng.randint(1, 30))]
+        conditions.insert(rng.randint(0, len(conditions)), {'name': 'example_entry_will_be_ignored', 'pattern': {'sender': ''}})
+        email_rules = {'conditions': conditions}
+        rule_index = compile_rules(email_rules)
+
+        for _ in range(20):
+            email_from = rng.choice(['x@a.com', 'b@a.com', 'c@b.org', 'someone@a.co.uk', 'B@A.COM'])
+            email_subject = random_text(rng, 4)
+            email_body = random_text(rng, 12)
+            attachment_names = [random_text(rng, 2).replace(' ', '_') + rng.choice(['.csv', '.pdf', '.CSV']) for _ in range(rng.randint(0, 3))]
+
+            expected = linear_match(email_rules, email_from.lower(), email_subject, email_body, attachment_names)
+            assert compiled_match(rule_index, email_from, email_subject, email_body, attachment_names) == expected
+
+def test_keyword_matcher_finds_overlapping_keywords():
+    matcher = KeywordMatcher(['he', 'she', 'his', 'hers', ''])
+
+    assert matcher.find('ushers') == {'he', 'she', 'hers', ''}
+    assert matcher.find('') == {''}
+
+class SearchedText(str):
+    """Text remembering the keywords searched for in it"""
+
+    def __init__(self, text):
+        super().__init__()
+        self.searches = []
+
+    def __contains__(self, keyword):
+        self.searches.append(keyword)
+        return super().__contains__(keyword)
+
+def test_keywords_are_searched_once_and_match_all_is_not_searched():
+    conditions = [
+        {'name': 'first', 'pattern': {'sender': '@a.com', 'body': ['invoice', 'statement']}, 'delivery': {'target': 'local', 'path': '/tmp'}},
+        {'name': 'second', 'pattern': {'sender': '@a.com', 'body': ['statement']}, 'delivery': {'target': 'local', 'path': '/tmp'}},
+        {'name': 'third', 'pattern': {'sender': '@a.com', 'body': ['', 'ignored']}, 'delivery': {'target': 'local', 'path': '/tmp'}},
+        {'name': 'other_sender', 'pattern': {'sender': '@b.org', 'body': ['remittance']}, 'delivery': {'target': 'local', 'path': '/tmp'}}
+    ]
+    body = SearchedText('lorem ipsum ' * 1000)
+
+    matched = [compiled.name for compiled in compile_rules({'conditions': conditions}).candidates('x@a.com', 'subject', body)]
+
+    assert matched == ['third']
+    # only the keywords of conditions whose sender matched are searched for, each once, and '' needs no search
+    assert sorted(body.searches) == ['invoice', 'statement']
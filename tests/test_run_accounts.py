@@ -0,0 +1,52 @@
+"""A run of all accounts, in parallel but capped per tenant, where an error in one account only stops that account"""
+import copy
+import time
+import threading
+
+# pylint: disable=import-error
+from .conftest import USER_ID, make_message, delivered_files
+# pylint: enable=import-error
+
+def test_bad_password_method_only_stops_its_account(processor, settings, account, graph_state, tmp_path, capsys):
+    graph_state.add_message(USER_ID, make_message('msg0'), [('report.csv', 10)])
+    misconfigured = copy.deepcopy(account)
+    misconfigured['password_method'] = 'keyrnig'
+    misconfigured['email_account']['account_name'] = 'misconfigured_account'
+
+    processor.run_accounts({'o365_accounts': [misconfigured, account]}, settings)
+
+    output = capsys.readouterr().out
+    assert 'Error prefetching passwords for password_method keyrnig' in output
+    assert 'misconfigured_account: Error processing account: Unsupported password_method: keyrnig' in output
+    assert delivered_files(tmp_path) == ['report.csv']
+    assert graph_state.read_count() == 1
+
+def test_accounts_per_tenant_are_capped(processor, settings, account, monkeypatch):
+    settings['max_workers'] = 4
+    settings['max_workers_per_tenant'] = 1
+    accounts = []
+    for number in range(9):
+        tenant_account = copy.deepcopy(account)
+        tenant_account['email_account']['account_name'] = f'account_{number}'
+        tenant_account['email_account']['o365_tenant_id'] = f'tenant_{number % 3}'
+        accounts.append(tenant_account)
+    running = {}
+    peaks = {}
+    lock = threading.Lock()
+
+    def run_account(account, settings, stop_event=None):
+        tenant_id = account['email_account']['o365_tenant_id']
+        with lock:
+            running[tenant_id] = running.get(tenant_id, 0) + 1
+            peaks[tenant_id] = max(peaks.get(tenant_id, 0), running[tenant_id])
+            peaks['all'] = max(peaks.get('all', 0), sum(running.values()))
+        time.sleep(0.05)
+        with lock:
+            running[tenant_id] -= 1
+
+    monkeypatch.setattr(processor, 'run_account', run_account)
+    processor.run_accounts({'o365_accounts': accounts}, settings)
+
+    # accounts 0 and 3 would otherwise run side by side, both being of the first tenant.  The workers a busy tenant cannot use go to the other tenants instead
+    assert peaks.pop('all') == 3
+    assert peaks == {'tenant_0': 1, 'tenant_1': 1, 'tenant_2': 1}
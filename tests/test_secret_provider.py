@@ -0,0 +1,89 @@
+"""Secrets are cached for a limited time, least recently used first out, failed lookups are retried, and prefetching uses the bulk lookup of a backend"""
+import time
+import types
+
+# pylint: disable=import-error
+from utils.secret_provider import SecretProvider
+# pylint: enable=import-error
+
+class FakeBackend:
+    """Password backend counting its lookups.  Keys listed in 'failing' are not found, as backends report it by returning None"""
+
+    def __init__(self, failing=()):
+        self.lookups = []
+        self.failing = set(failing)
+
+    def get_password(self, account_name, password_key):
+        self.lookups.append((account_name, password_key))
+        if password_key in self.failing:
+            return None
+        return f'{account_name}:{password_key}'
+
+def test_secrets_are_cached_until_they_expire():
+    backend = FakeBackend()
+    pw = SecretProvider(backend, ttl_seconds=0.1)
+
+    assert pw('account', 'key') == 'account:key'
+    assert pw('account', 'key') == 'account:key'
+    assert len(backend.lookups) == 1
+
+    time.sleep(0.15)
+    assert pw('account', 'key') == 'account:key'
+    assert len(backend.lookups) == 2
+
+def test_least_recently_used_secret_is_evicted():
+    backend = FakeBackend()
+    pw = SecretProvider(backend, max_entries=2)
+    pw('account', 'first')
+    pw('account', 'second')
+    # using the first secret makes the second one the least recently used
+    pw('account', 'first')
+
+    pw('account', 'third')
+    backend.lookups.clear()
+    pw('account', 'first')
+    pw('account', 'third')
+    assert backend.lookups == []
+    pw('account', 'second')
+    assert backend.lookups == [('account', 'second')]
+
+def test_failed_lookups_are_not_cached():
+    backend = FakeBackend(failing={'key'})
+    pw = SecretProvider(backend)
+
+    assert pw('account', 'key') is None
+    backend.failing.clear()
+    assert pw('account', 'key') == 'account:key'
+    assert len(backend.lookups) == 2
+
+def test_prefetch_uses_the_bulk_lookup():
+    backend = FakeBackend()
+    bulk_lookups = []
+
+    def get_passwords(keys):
+        bulk_lookups.append(list(keys))
+        return {key: f'bulk:{key[1]}' for key in keys if key[1] != 'missing'}
+
+    pw = SecretProvider(types.SimpleNamespace(get_password=backend.get_password, get_passwords=get_passwords))
+    pw.prefetch([('account', 'first'), ('account', 'second'), ('account', 'first'), ('account', 'missing')])
+
+    # duplicates are only looked up once, and cached secrets are served without another lookup
+    assert bulk_lookups == [[('account', 'first'), ('account', 'second'), ('account', 'missing')]]
+    assert pw('account', 'first') == 'bulk:first'
+    assert pw('account', 'second') == 'bulk:second'
+    assert backend.lookups == []
+    # a secret the bulk lookup did not return is looked up on its own when it is needed
+    assert pw('account', 'missing') == 'account:missing'
+
+    pw.prefetch([('account', 'first')])
+    assert len(bulk_lookups) == 1
+
+def test_prefetch_without_a_bulk_lookup_looks_up_each_secret():
+    backend = FakeBackend()
+    pw = SecretProvider(backend)
+
+    pw.prefetch([('account', 'first'), ('account', 'second')])
+
+    assert backend.lookups == [('account', 'first'), ('account', 'second')]
+    assert pw('account', 'first') == 'account:first'
+    assert len(backend.lookups) == 2
@@ -0,0 +1,62 @@
+"""Sharepoint rules are cached, and the last known rules are kept when Sharepoint cannot be read"""
+import pytest
+
+# pylint: disable=import-error
+from fake_graph import build_workbook
+# pylint: enable=import-error
+
+SHAREPOINT_ACCOUNT = {
+    'account_name': 'test_sharepoint',
+    'o365_username': 'sharepoint@test.example',
+    'o365_site_address': 'test.sharepoint.com',
+    'o365_site_name': 'test',
+    'o365_site_folderpath': 'Documents/Rules',
+    'o365_user_id': 'test-sharepoint-user',
+    'o365_tenant_id': 'test-tenant',
+    'o365_client_id': 'test-client',
+    'o365_password_key': 'test-password'
+}
+
+@pytest.fixture
+def sharepoint(processor, settings, graph_state):
+    """Read the rules once, so the folder address and the workbook are cached.  Returns a function reading them again"""
+    settings['graph_max_retries'] = 0
+    graph_state.add_workbook('rules.xlsx', build_workbook([('forward_invoices', '@partner.example', 'invoice', 'please', '.pdf', 'accounts@test.example', 'Forwarded')]))
+    pw = processor.get_password_method('custom', settings)
+    return lambda: processor.retrieve_sharepoint_rules(SHAREPOINT_ACCOUNT, pw, settings)
+
+def test_rules_are_read_and_cached(sharepoint, graph_state):
+    conditions, version = sharepoint()
+    assert [condition['name'] for condition in conditions] == ['forward_invoices']
+
+    assert sharepoint() == (conditions, version)
+    # the folder is only looked up, and the workbook only downloaded, the first time
+    assert graph_state.counts['sharepoint_site'] == 1
+    assert graph_state.counts['sharepoint_download'] == 1
+
+@pytest.mark.parametrize('status', [500, 503, 401])
+def test_transient_failure_keeps_cached_rules(sharepoint, graph_state, status):
+    conditions, version = sharepoint()
+    graph_state.failing_routes['sharepoint_files'] = status
+
+    assert sharepoint() == (conditions, version)
+    # a failure other than 404 does not mean the folder has moved
+    assert graph_state.counts['sharepoint_site'] == 1
+
+def test_missing_folder_is_looked_up_again(sharepoint, graph_state):
+    conditions, version = sharepoint()
+    graph_state.failing_routes['sharepoint_files'] = 404
+
+    # the folder is looked up again, and as it is still missing the last known rules are kept
+    assert sharepoint() == (conditions, version)
+    assert graph_state.counts['sharepoint_site'] == 2
+
+    del graph_state.failing_routes['sharepoint_files']
+    assert sharepoint() == (conditions, version)
+
+def test_failed_folder_lookup_keeps_cached_rules(sharepoint, graph_state):
+    conditions, version = sharepoint()
+    graph_state.failing_routes['sharepoint_files'] = 404
+    graph_state.failing_routes['sharepoint_site'] = 503
+
+    assert sharepoint() == (conditions, version)
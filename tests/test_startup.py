@@ -0,0 +1,42 @@
+"""Startup cost: heavy dependencies are only imported once an account or rule needs them"""
+import sys
+import subprocess
+
+import pytest
+
+# pylint: disable=import-error
+from .conftest import SRC_DIR
+# pylint: enable=import-error
+
+HEAVY_PACKAGES = {'boto3', 'botocore', 'openpyxl', 'msgraph', 'azure', 'keyring', 'paramiko'}
+
+def imported_packages(code):
+    """Run 'code' in a fresh interpreter with -X importtime, returning the top-level packages it imported and the total import time in microseconds"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    packages = set()
+    total = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        # nested imports are indented, so only the unindented ones add up to the total
+        if not name.startswith('  '):
+            total += int(cumulative)
+        packages.add(name.strip().split('.')[0])
+    return packages, total
+
+@pytest.mark.parametrize('module', ['main', 'daemon'])
+def test_import_skips_heavy_packages(module):
+    packages, total = imported_packages(f'import {module}')
+
+    assert module in packages
+    assert packages & HEAVY_PACKAGES == set()
+    print(f'import {module}: {total / 1000:.1f} ms')
+
+def test_custom_password_method_skips_secret_store_clients():
+    packages, _ = imported_packages("import main; main.get_password_method('custom', main.DEFAULT_SETTINGS)")
+
+    assert packages & HEAVY_PACKAGES == set()
@@ -0,0 +1,68 @@
+"""Attachments are streamed from Graph and written to their targets in chunks, without holding them in memory"""
+import io
+import os
+
+# pylint: disable=import-error
+from .conftest import USER_ID, make_message
+# pylint: enable=import-error
+
+MB = 1024 * 1024
+
+class RecordingReader(io.BytesIO):
+    """File object remembering the size of every read made from it"""
+
+    def __init__(self, content):
+        super().__init__(content)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+def test_large_s3_delivery_uses_multipart_upload(processor, settings, s3):
+    settings['s3_part_size_mb'] = 5
+    content = os.urandom(12 * MB)
+    pw = processor.get_password_method('custom', settings)
+    delivery_details = {'target': 's3', 'region': 'us-east-1', 'bucket': 'delivery-bucket', 'subfolder': 'reports/'}
+
+    processor.transmit_files(pw, 'test_reports', 's3', delivery_details, '2023-01-01T00:00:00Z', 'large.bin', io.BytesIO(content), settings)
+
+    uploaded = s3.head_object(Bucket='delivery-bucket', Key='reports/large.bin')
+    # multipart ETags end with the number of parts
+    assert uploaded['ETag'].strip('"').endswith('-3')
+    assert s3.get_object(Bucket='delivery-bucket', Key='reports/large.bin')['Body'].read() == content
+
+def test_small_s3_delivery_is_a_single_put(processor, settings, s3):
+    pw = processor.get_password_method('custom', settings)
+    delivery_details = {'target': 's3', 'region': 'us-east-1', 'bucket': 'delivery-bucket'}
+
+    processor.transmit_files(pw, 'test_reports', 's3', delivery_details, '2023-01-01T00:00:00Z', 'small.csv', b'id,value\n1,2\n', settings)
+
+    uploaded = s3.head_object(Bucket='delivery-bucket', Key='small.csv')
+    assert '-' not in uploaded['ETag']
+    assert s3.get_object(Bucket='delivery-bucket', Key='small.csv')['Body'].read() == b'id,value\n1,2\n'
+
+def test_local_delivery_is_written_in_chunks(processor, settings, tmp_path):
+    settings['attachment_chunk_size_mb'] = 1
+    content = os.urandom(3 * MB + 100)
+    reader = RecordingReader(content)
+    delivery_details = {'target': 'local', 'path': str(tmp_path / 'out')}
+
+    processor.transmit_files(None, 'test_reports', 'local', delivery_details, '2023-01-01T00:00:00Z', 'large.bin', reader, settings)
+
+    assert (tmp_path / 'out' / 'large.bin').read_bytes() == content
+    assert all(0 < size <= MB for size in reader.reads)
+    assert len(reader.reads) >= 4
+
+def test_download_spools_large_attachments_to_disk(processor, settings, graph_server, graph_state):
+    settings['attachment_spool_mb'] = 1
+    graph_state.add_message(USER_ID, make_message('large'), [('large.bin', 3 * MB)])
+    email_client = processor.authenticate('test-tenant', 'test-client', '', settings)
+
+    with processor.download_attachment(email_client, USER_ID, 'large', 'large-att0', settings) as attachment_file:
+        # past the spool size the content is moved to a temporary file instead of being kept in memory
+        assert attachment_file._rolled
+        content = attachment_file.read()
+
+    assert len(content) == 3 * MB
+    assert graph_state.bytes_served == 3 * MB
@@ -0,0 +1,83 @@
+"""The daemon receiving change notifications from the fake Graph server, end to end"""
+import json
+import time
+import socket
+import threading
+
+import pytest
+
+# pylint: disable=import-error
+from .conftest import USER_ID, make_message, delivered_files, wait_for
+# pylint: enable=import-error
+
+@pytest.fixture
+def daemon(processor, account, graph_state, tmp_path):
+    """Run the daemon with notifications enabled, polling only when it starts or a lifecycle notification asks for it.  Returns the subscription once it has been created"""
+    import daemon as daemon_module
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    (tmp_path / 'o365_accounts.json').write_text(json.dumps({
+        'settings': {
+            'state_file': str(tmp_path / 'processor_state.json'),
+            'rules_cache_file': str(tmp_path / 'rules_cache.json'),
+            'ledger_file': str(tmp_path / 'delivery_ledger.db'),
+            'prefetch_secrets': False,
+            'poll_interval_seconds': 3600,
+            'poll_jitter_seconds': 0,
+            'webhook_url': f'http://127.0.0.1:{port}/notifications',
+            'webhook_listen_host': '127.0.0.1',
+            'webhook_listen_port': port,
+            'webhook_fallback_poll_seconds': 3600
+        },
+        'o365_accounts': [account]
+    }), encoding='utf-8')
+
+    stop_event = threading.Event()
+    thread = threading.Thread(target=daemon_module.run_daemon, args=(stop_event,), daemon=True)
+    thread.start()
+    try:
+        # the first poll creates the subscription, after the listener has passed the validation handshake
+        wait_for(lambda: graph_state.subscriptions and graph_state.counts['list_messages'])
+        yield next(iter(graph_state.subscriptions.values()))
+    finally:
+        stop_event.set()
+        thread.join(10)
+
+def test_subscription_is_created_after_validation_handshake(daemon, account):
+    assert daemon['notificationUrl'].endswith('/notifications')
+    assert daemon['resource'] == f"/users/{USER_ID}/mailFolders('inbox')/messages"
+    assert daemon['changeType'] == 'created'
+
+def test_notified_message_is_delivered_without_polling(daemon, graph_state, tmp_path):
+    graph_state.add_message(USER_ID, make_message('pushed'), [('pushed.csv', 10)])
+
+    assert graph_state.notify(daemon['id'], 'pushed') == 202
+    wait_for(lambda: graph_state.read_count() == 1)
+
+    assert delivered_files(tmp_path) == ['pushed.csv']
+    assert graph_state.counts['get_message'] == 1
+    assert graph_state.counts['list_messages'] == 1
+
+def test_notification_with_wrong_client_state_is_dropped(daemon, graph_state, tmp_path):
+    graph_state.add_message(USER_ID, make_message('forged'), [('forged.csv', 10)])
+
+    # still acknowledged, as Graph would otherwise keep sending it
+    assert graph_state.notify(daemon['id'], 'forged', client_state='not the client state') == 202
+    time.sleep(0.5)
+
+    assert graph_state.counts['get_message'] == 0
+    assert graph_state.read_count() == 0
+    assert delivered_files(tmp_path) == []
+
+def test_lifecycle_notification_polls_and_renews(daemon, graph_state, tmp_path):
+    # a message whose notification was missed is only found by polling
+    graph_state.add_message(USER_ID, make_message('missed'), [('missed.csv', 10)])
+
+    assert graph_state.notify(daemon['id'], lifecycle_event='missed') == 202
+    wait_for(lambda: graph_state.read_count() == 1)
+
+    assert graph_state.counts['list_messages'] == 2
+    assert graph_state.counts['renew_subscription'] == 1
+    assert delivered_files(tmp_path) == ['missed.csv']